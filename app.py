@@ -1,39 +1,664 @@
+import base64
+import binascii
+import json
 import os
-from flask import Flask, request, abort, jsonify
-from models import setup_db, Actor, Movie
+from datetime import date, datetime, timedelta
+from flask import Flask, Response, current_app, request, abort, jsonify, stream_with_context
+from models import database_path, setup_db, pool_stats, change_listeners, bulk_insert, bulk_update, bulk_delete, existing_ids, Actor, Movie
+from models import cast_query, cast_dicts, add_cast, remove_cast, read_stats, rebuild_stats, live, row_columns, update_row, get_row
 from flask_cors import CORS
-from auth.auth import AuthError, requires_auth
+from sqlalchemy import tuple_
+from auth.auth import AuthError, requires_auth, check_permissions, token_cache, admission
+from cache import ResponseCache, record_cache, response_cache
+import search
+import warmup
+from replicas import router
+from outbox import outbox
+from snapshot import catalog
+from compression import compression, decoded_etag
+from serialization import ISODateJSONEncoder, dumps, json_response, row_dicts
+import metrics
+
+#Writes through the models bump the table version of the response cache, drop the
+#written records of the record cache, mark the rows of the in-process search indexes
+#and of the catalog snapshot and keep the reads of the written tables on the primary
+#while the read replicas catch up
+change_listeners.append(response_cache.invalidate)
+change_listeners.append(record_cache.invalidate)
+change_listeners.append(search.invalidate)
+change_listeners.append(catalog.invalidate)
+change_listeners.append(router.mark_written)
+
+#Pool, token cache and admission control state of this worker on /metrics
+for name in ('checked_out', 'overflow', 'checkouts', 'connects', 'timeouts', 'wait_seconds_total'):
+    metrics.registry.gauge('db_pool_' + name, 'Connection pool %s, see /health.' % name,
+                           lambda name=name: pool_stats().get(name, 0))
+for name in ('size', 'hits', 'misses'):
+    metrics.registry.gauge('token_cache_' + name, 'Verified token cache %s.' % name,
+                           lambda name=name: token_cache.stats()[name])
+for name, help in (('active', 'Requests holding an admission slot.'),
+                   ('queued', 'Requests waiting for an admission slot.')):
+    metrics.registry.gauge('admission_' + name, help, lambda name=name: admission.stats()[name])
+
+#Page size of the list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+#Reads the limit and cursor query parameters, aborts 400 if they are invalid
+def get_page_args():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        abort(400)
+
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400)
+
+    return limit, cursor
+
+#Reads an optional query parameter with the given type, aborts 400 if it can't be converted
+def get_filter_arg(name, type):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+
+    try:
+        return type(value)
+    except ValueError:
+        abort(400)
+
+#Longest accepted search query
+MAX_SEARCH_LENGTH = 200
+
+#Reads the q query parameter of the search endpoints, aborts 400 unless it has a word to search for
+def get_search_arg():
+    query = request.args.get('q', '')
+    if len(query) > MAX_SEARCH_LENGTH or not search.words(query):
+        abort(400)
+
+    return query
+
+#Reads the embed query parameter, a comma separated list of the related records to
+#embed in each row, aborts 400 on names that can't be embedded
+def get_embed_arg(allowed):
+    value = request.args.get('embed')
+    if not value:
+        return set()
+
+    names = set(value.split(','))
+    if not names <= set(allowed):
+        abort(400)
+
+    return names
+
+#Width in years of the age groups of /stats
+DEFAULT_AGE_BUCKET = 10
+
+#Turns a {group: count} dict into a list of {name: group, 'count': count}, ordered by group with NULL last
+def stat_groups(groups, name):
+    return [{name: group, 'count': groups[group]}
+            for group in sorted(groups, key=lambda group: (group is None, group))]
+
+#Merges the counts per age of /stats into the age groups of the given width
+def age_groups(ages, width):
+    groups = {}
+    for age, count in ages.items():
+        group = None if age is None else age // width * width
+        groups[group] = groups.get(group, 0) + count
+
+    return [{
+        'min_age': group,
+        'max_age': None if group is None else group + width - 1,
+        'count': groups[group]
+    } for group in sorted(groups, key=lambda group: (group is None, group))]
+
+#Adds the cast records related to each row dict under the given name, with one query for the page
+def embed_cast(model, rows, name):
+    related = cast_dicts(model, [row['id'] for row in rows])
+    for row in rows:
+        row[name] = related[row['id']]
+
+    return rows
+
+#Returns one page of the query ordered by id, starting after the cursor id, as column
+#tuples rather than model instances, and the cursor of the next page (None on the last page)
+def paginate(query, model, limit, cursor):
+    if cursor is not None:
+        query = query.filter(model.id > cursor)
+
+    rows = query.with_entities(*row_columns(model)) \
+        .order_by(model.id).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+
+    return rows[:limit], next_cursor
+
+#Rows fetched per round trip by the export endpoints
+EXPORT_BATCH_SIZE = 1000
+
+#Streams every row of the query, ordered by id, as NDJSON or as a JSON array (?format=json).
+#Column tuples are read through a server-side cursor in batches so memory stays flat.
+def export_response(query, model):
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'json'):
+        abort(400)
+
+    columns = row_columns(model)
+    rows = query.with_entities(*columns) \
+        .order_by(model.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(EXPORT_BATCH_SIZE)
+
+    names = [column.name for column in columns]
+
+    def batches():
+        batch = []
+        for row in rows:
+            batch.append(dict(zip(names, row)))
+            if len(batch) == EXPORT_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def generate_ndjson():
+        for batch in batches():
+            yield b'\n'.join([dumps(row) for row in batch]) + b'\n'
+
+    #Each batch is encoded as one array, whose brackets are dropped
+    def generate_json():
+        yield b'['
+        separator = b''
+        for batch in batches():
+            yield separator + dumps(batch)[1:-1]
+            separator = b','
+        yield b']'
+
+    if export_format == 'json':
+        return Response(stream_with_context(generate_json()), mimetype='application/json')
+    return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+
+#Tables of /changes and their keys in the response
+CHANGE_TABLES = ((Actor, 'actors'), (Movie, 'movies'))
+
+#Reads the since token of /changes, the (updated_at, id) of the last change returned of each
+#table, aborts 400 if it can't be decoded.  No token starts from the first row
+def get_since_arg():
+    token = request.args.get('since')
+    if not token:
+        return {}
+
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return {table: (datetime.fromisoformat(updated_at), int(id))
+                for table, (updated_at, id) in positions.items()}
+    except (ValueError, TypeError, AttributeError, binascii.Error):
+        abort(400)
+
+def since_token(positions):
+    positions = {table: [updated_at.isoformat(), id] for table, (updated_at, id) in positions.items()}
+    return base64.urlsafe_b64encode(json.dumps(positions, sort_keys=True).encode('ascii')).decode('ascii')
+
+#Returns the rows of the model changed after the position and up to the cutoff time, ordered
+#by (updated_at, id), deleted rows included, and whether there are more after them
+def changed_rows(model, position, cutoff, limit):
+    query = model.query.filter(model.updated_at <= cutoff)
+    if position is not None:
+        updated_at, id = position
+        query = query.filter(tuple_(model.updated_at, model.id) > tuple_(updated_at, id))
+
+    rows = query.with_entities(*model.__table__.columns) \
+        .order_by(model.updated_at, model.id).limit(limit + 1).all()
+
+    return rows[:limit], len(rows) > limit
+
+#Largest batch the bulk endpoints accept
+MAX_BULK_ITEMS = 1000
+
+#Reads the json array of a bulk request, aborts 400 unless it is a non-empty array within the batch limit
+def get_bulk_items():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or len(items) == 0 or len(items) > MAX_BULK_ITEMS:
+        abort(400)
+
+    return items
+
+#Response for a batch that failed validation, nothing has been written
+def bulk_rejected(results):
+    return jsonify({
+        "success": False,
+        "error": 422,
+        "message": "unprocessable",
+        "results": results
+    }), 422
+
+#Validates every item of the batch, returns the column values (None for invalid items),
+#the per item results and whether any item failed
+def validate_bulk_items(model, items, partial):
+    rows = []
+    results = []
+    failed = False
+    for index, item in enumerate(items):
+        try:
+            rows.append(model.validate(item, partial=partial))
+            results.append({"index": index})
+        except ValueError as e:
+            rows.append(None)
+            results.append({"index": index, "error": str(e)})
+            failed = True
+
+    return rows, results, failed
+
+#Checks the ids of a bulk update or delete against the table, marking invalid,
+#duplicate and missing ids as failed items. Returns whether any item failed
+def check_bulk_ids(model, ids, results):
+    valid_ids = [id for id in ids if isinstance(id, int) and not isinstance(id, bool)]
+    found = existing_ids(model, valid_ids)
+    seen = set()
+    failed = False
+    for id, result in zip(ids, results):
+        if "error" in result:
+            failed = True
+            continue
+
+        if id not in valid_ids:
+            result["error"] = "id must be an integer"
+        elif id in seen:
+            result["error"] = "duplicate id"
+        elif id not in found:
+            result["error"] = "not found"
+        else:
+            result["id"] = id
+        seen.add(id)
+        failed = failed or "error" in result
+
+    return failed
+
+#Returns one row, from the record cache of the worker when it is there. The ETag is the
+#version of the row, so If-None-Match is answered with 304 as long as the row is unchanged
+def record_response(model, id, name):
+    table = model.__tablename__
+    entry = record_cache.get(table, id)
+    if entry is None:
+        generation = record_cache.generation()
+        row = get_row(model, id)
+        if row is None:
+            abort(404)
+
+        with metrics.timed('serialize'):
+            entry = (str(row['version']), dumps({"success": True, name: row}))
+        record_cache.set(table, id, entry[0], entry[1], generation)
+
+    etag, body = entry
+    return ResponseCache.respond(body, etag)
+
+#Reads the If-Match header of a PATCH as the row versions it accepts, None if any version will do
+def get_if_match_versions():
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+
+    versions = []
+    for etag in if_match.as_set():
+        try:
+            versions.append(int(decoded_etag(etag)))
+        except ValueError:
+            pass
+
+    return versions
+
+#Applies the fields of the json body to one row with a single UPDATE, aborts 404 if the row
+#doesn't exist and 412 if it isn't at a version given in If-Match. Fields the model doesn't
+#have are ignored. The response carries the updated row and its version as ETag
+def update_response(model, id, name):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+
+    try:
+        id = int(id)
+        values = model.validate({field: body[field] for field in model.FIELDS if field in body}, partial=True)
+    except ValueError:
+        abort(400)
+    if not values:
+        abort(400)
+
+    row = update_row(model, id, values, get_if_match_versions())
+    if row is None:
+        abort(412 if existing_ids(model, [id]) else 404)
+
+    response = json_response({
+        "success": True,
+        name: {column.name: row[column.name] for column in row_columns(model)}
+    })
+    response.set_etag(str(row['version']))
+    return response
+
+#With the write-behind outbox on, mutations of requests sending Prefer: respond-async (or
+#all of them with OUTBOX_MODE=always) are queued instead of committed, see outbox.py
+def write_behind():
+    if not outbox.enabled:
+        return False
+    return outbox.mode == 'always' or 'respond-async' in request.headers.get('Prefer', '')
+
+#The column values of a POST body checked by Model.validate, a refused body gets a 422 naming
+#the field. The synchronous and the queued creates both take their values from here
+def get_create_values(model):
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = {field: body[field] for field in model.FIELDS if field in body}
+    try:
+        return model.validate(body)
+    except ValueError as e:
+        abort(422, str(e))
+
+#Validates a mutation like its synchronous route, queues it and returns 202 with the job id.
+#The job is applied by the flusher, GET /jobs/<id> has its result. An update keeps the
+#versions of If-Match, its job fails with 412 if the row isn't at one of them any more
+def enqueue_response(payload, permission, model, operation, id=None):
+    values = None
+    if id is not None:
+        try:
+            id = int(id)
+        except ValueError:
+            abort(404)
+        if not existing_ids(model, [id]):
+            abort(404)
+
+    if operation == 'create':
+        values = get_create_values(model)
+    elif operation == 'update':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        try:
+            values = model.validate({field: body[field] for field in model.FIELDS if field in body},
+                                    partial=True)
+        except ValueError:
+            abort(400)
+        if not values:
+            abort(400)
+
+    versions = get_if_match_versions() if operation == 'update' else None
+    job_id = outbox.enqueue(operation, model.__tablename__, id, values, payload.get('sub'), permission, versions)
+    outbox.start(current_app._get_current_object())
+    response = json_response({"success": True, "job": job_id, "status": "queued"}, status=202)
+    response.headers['Location'] = '/jobs/%d' % job_id
+    return response
+
+def bulk_create_response(model):
+    items = get_bulk_items()
+    rows, results, failed = validate_bulk_items(model, items, partial=False)
+    if failed:
+        return bulk_rejected(results)
+
+    ids = bulk_insert(model, rows)
+    for result, id in zip(results, ids):
+        result.update(id=id, status="created")
+
+    return jsonify({
+        "success": True,
+        "created": len(ids),
+        "results": results
+    })
+
+def bulk_update_response(model):
+    items = get_bulk_items()
+    rows, results, failed = validate_bulk_items(model, items, partial=True)
+    for row, result in zip(rows, results):
+        if row == {}:
+            result["error"] = "no fields to update"
+
+    ids = [item.get("id") if isinstance(item, dict) else None for item in items]
+    if check_bulk_ids(model, ids, results) or failed:
+        return bulk_rejected(results)
+
+    for row, result in zip(rows, results):
+        row["id"] = result["id"]
+        result["status"] = "updated"
+    bulk_update(model, rows)
+
+    return jsonify({
+        "success": True,
+        "updated": len(rows),
+        "results": results
+    })
+
+def bulk_delete_response(model):
+    ids = get_bulk_items()
+    results = [{"index": index} for index in range(len(ids))]
+    if check_bulk_ids(model, ids, results):
+        return bulk_rejected(results)
+
+    bulk_delete(model, ids)
+    for result in results:
+        result["status"] = "deleted"
+
+    return jsonify({
+        "success": True,
+        "deleted": len(ids),
+        "results": results
+    })
 
 def create_app(test_config=None):
     app = Flask(__name__)
-    setup_db(app)
+    app.json_encoder = ISODateJSONEncoder
+    if test_config is not None:
+        app.config.update(test_config)
+    setup_db(app, app.config.get("SQLALCHEMY_DATABASE_URI", database_path))
+    router.init_app(app)
+    outbox.init_app(app)
+    catalog.init_app(app)
+    compression.init_app(app)
+    metrics.init_app(app)
     CORS(app)
 
+    #  Health check with the DB pool metrics and the read replicas of this worker
+    @app.route('/health')
+    def health():
+        return jsonify({
+            'success': True,
+            'pool': pool_stats(),
+            'read_replicas': router.stats(),
+            'catalog_snapshot': catalog.info()
+        })
+
+    #  Status and result of a write-behind job, only for the token subject that queued it
+    @app.route('/jobs/<int:job_id>')
+    @requires_auth()
+    def get_job(payload, job_id):
+        job = outbox.job(job_id) if outbox.enabled else None
+        if job is None or job['sub'] != payload.get('sub'):
+            abort(404)
+        check_permissions(job['permission'], payload)
+
+        return json_response({
+            "success": True,
+            "job": {name: job[name] for name in
+                    ('id', 'operation', 'table', 'row_id', 'status', 'result', 'queued_at', 'finished_at')}
+        })
+
+    #  Whether this worker finished its warmup (see warmup.py), 503 until then.  A worker
+    #  that nothing warmed up starts on the first check
+    @app.route('/ready')
+    def ready():
+        if not warmup.is_ready():
+            warmup.warm_up_in_background(app)
+        is_ready = warmup.is_ready()
+        return jsonify({
+            'success': is_ready,
+            'ready': is_ready,
+            'warmup': warmup.timings
+        }), 200 if is_ready else 503
+
+    #  Request, stage and pool metrics of this worker in the Prometheus text format
+    @app.route('/metrics')
+    def get_metrics():
+        return metrics.metrics_response()
+
+    #  Actor and movie counts per gender, age group and release year, read from the
+    #  stat_count summaries.  ?age_bucket sets the width of the age groups
+    @app.route('/stats')
+    @requires_auth('get:actors', 'get:movies')
+    @router.reads('actor', 'movie')
+    @response_cache.cached(('actor', 'movie'), scope='get:actors+get:movies')
+    def get_stats(payload):
+        age_bucket = get_filter_arg('age_bucket', int)
+        if age_bucket is None:
+            age_bucket = DEFAULT_AGE_BUCKET
+        if age_bucket < 1 or age_bucket > 100:
+            abort(400)
+
+        stats = catalog.read_stats() if catalog.enabled else read_stats()
+
+        with metrics.timed('serialize'):
+            return json_response({
+                'success': True,
+                'actors': {
+                    'count': sum(stats['actor_gender'].values()),
+                    'by_gender': stat_groups(stats['actor_gender'], 'gender'),
+                    'by_age': age_groups(stats['actor_age'], age_bucket)
+                },
+                'movies': {
+                    'count': sum(stats['movie_release_year'].values()),
+                    'by_release_year': stat_groups(stats['movie_release_year'], 'release_year')
+                }
+            })
+
+    #  Rows created, updated or deleted since the `since` token of the previous call, per table.
+    #  Changes of the last CHANGES_SETTLE_SECONDS are left for the next call, so that the
+    #  transactions still in flight commit before the token moves past them.  Responses are
+    #  cached for the settle window at most, so a row held back is delivered once it has settled
+    changes_settle = timedelta(seconds=float(
+        app.config.get('CHANGES_SETTLE_SECONDS', os.environ.get('CHANGES_SETTLE_SECONDS', 5))))
+
+    @app.route('/changes')
+    @requires_auth('get:actors', 'get:movies')
+    @response_cache.cached(('actor', 'movie'), scope='get:actors+get:movies',
+                           ttl=min(response_cache.ttl, changes_settle.total_seconds()))
+    def get_changes(payload):
+        limit, _ = get_page_args()
+        positions = get_since_arg()
+        cutoff = datetime.utcnow() - changes_settle
+
+        body = {'success': True, 'more': False}
+        for model, name in CHANGE_TABLES:
+            table = model.__tablename__
+            rows, more = changed_rows(model, positions.get(table), cutoff, limit)
+            if rows:
+                positions[table] = (rows[-1].updated_at, rows[-1].id)
+            body[name] = row_dicts(rows)
+            body['more'] = body['more'] or more
+        body['since'] = since_token(positions)
+
+        with metrics.timed('serialize'):
+            return json_response(body)
+
+    #  Recounts the /stats summaries from the tables: `flask rebuild-stats`
+    @app.cli.command('rebuild-stats')
+    def rebuild_stats_command():
+        rebuild_stats()
+
     #  Actor Endpoints
     #  ----------------------------------------------------------------
 
-    #  Get all actors
+    #  Get a page of actors, optionally filtered by gender and age range
     @app.route('/actors')
     @requires_auth('get:actors')
+    @router.reads('actor', 'movie_cast', 'movie')
+    @response_cache.cached('actor', scope='get:actors', embeds={'movies': ('movie_cast', 'movie')})
     def get_actors(payload):
-    #def get_actors():
-        actors=Actor.query.all()
+        limit, cursor = get_page_args()
+        embed = get_embed_arg(('movies',))
+        filters = {
+            'gender': get_filter_arg('gender', str),
+            'min_age': get_filter_arg('min_age', int),
+            'max_age': get_filter_arg('max_age', int),
+        }
+        if catalog.enabled and not embed:
+            actors, next_cursor = catalog.table(Actor).page(limit, cursor, **filters)
+        else:
+            actors, next_cursor = paginate(Actor.filtered(**filters), Actor, limit, cursor)
+            actors = row_dicts(actors)
 
         if len(actors) == 0:
             abort(404)
 
-        formatted_actors = [actor.format() for actor in actors]
-        
-        return jsonify({
-            'success': True,
-            'actors': formatted_actors
-        })
+        if 'movies' in embed:
+            embed_cast(Actor, actors, 'movies')
+
+        with metrics.timed('serialize'):
+            return json_response({
+                'success': True,
+                'actors': actors,
+                'next_cursor': next_cursor
+            })
+
+    #  Search actors by name, ranked, the cursor is the offset of the next page
+    @app.route('/actors/search')
+    @requires_auth('get:actors')
+    @router.reads('actor')
+    @response_cache.cached('actor', scope='get:actors')
+    def search_actors(payload):
+        limit, offset = get_page_args()
+        query = get_search_arg()
+        actors, next_cursor = search.search(Actor, 'name', query, offset or 0, limit)
+
+        with metrics.timed('serialize'):
+            return json_response({
+                'success': True,
+                'actors': row_dicts(actors),
+                'next_cursor': next_cursor
+            })
+
+    #  Get one actor, revalidated with its ETag
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth('get:actors')
+    @router.reads('actor')
+    def get_actor(payload, actor_id):
+        return record_response(Actor, actor_id, 'actor')
+
+    #  Get a page of the movies an actor is cast in
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth('get:movies')
+    @router.reads('actor', 'movie_cast', 'movie')
+    @response_cache.cached(('movie', 'movie_cast'), scope='get:movies')
+    def get_actor_movies(payload, actor_id):
+        limit, cursor = get_page_args()
+        if not existing_ids(Actor, [actor_id]):
+            abort(404)
+
+        movies, next_cursor = paginate(cast_query(Movie, Actor, actor_id), Movie, limit, cursor)
+
+        with metrics.timed('serialize'):
+            return json_response({
+                'success': True,
+                'actor': actor_id,
+                'movies': row_dicts(movies),
+                'next_cursor': next_cursor
+            })
+
+    #  Export all actors
+    @app.route('/actors/export')
+    @requires_auth('get:actors')
+    @router.reads('actor')
+    def export_actors(payload):
+        query = Actor.filtered(
+            gender=get_filter_arg('gender', str),
+            min_age=get_filter_arg('min_age', int),
+            max_age=get_filter_arg('max_age', int),
+        )
+        return export_response(query, Actor)
 
     #  Delete an actor
     @app.route('/actors/<actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(payload, actor_id):
-        actor=Actor.query.get(actor_id)
+        if write_behind():
+            return enqueue_response(payload, 'delete:actors', Actor, 'delete', actor_id)
+
+        actor=live(Actor).filter(Actor.id == actor_id).one_or_none()
             
         #Deletes the actor, aborts 404 if actor ID is not found
         if actor is None:
@@ -51,15 +676,15 @@ def create_app(test_config=None):
     @app.route('/actors',methods=['POST'])
     @requires_auth('post:actors')
     def create_actor(payload):
-        #Gets the json body and attributes from the form
-        body = request.get_json()
-        new_name = body.get("name", None)
-        new_gender = body.get("gender", None)
-        new_age = body.get("age", None)
+        if write_behind():
+            return enqueue_response(payload, 'post:actors', Actor, 'create')
+
+        #Gets the checked attributes from the json body
+        values = get_create_values(Actor)
 
         try:
             #Creates a new entry in the DB
-            actor = Actor(name=new_name, gender=new_gender, age=new_age)
+            actor = Actor(**values)
             actor.insert()
 
             #Returns the json object
@@ -76,65 +701,155 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    #  Bulk actor endpoints, each batch is validated up front and written in one transaction
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def bulk_create_actors(payload):
+        return bulk_create_response(Actor)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def bulk_update_actors(payload):
+        return bulk_update_response(Actor)
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def bulk_delete_actors(payload):
+        return bulk_delete_response(Actor)
+
     # Update actor details
     @app.route("/actors/<actor_id>", methods=["PATCH"])
     @requires_auth('patch:actors')
     def update_actor(payload, actor_id):
-        #Get body from Json
-        body = request.get_json()
-
-        try:
-            #Find the actor by actor id
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-            if actor is None:
-                abort(404)
-
-            #Update name if included
-            if "name" in body:
-                actor.name = body.get("name")
-            
-            #Update gender if included
-            if "gender" in body:
-                actor.gender = body.get("gender")
-
-            #Update age if included
-            if "age" in body:
-                actor.age = int(body.get("age"))
-
-            #Apply to the DB
-            actor.update()
-
-            return jsonify(
-                {
-                    "success": True,
-                }
-            )
-
-        except:
-            abort(400)
+        if write_behind():
+            return enqueue_response(payload, 'patch:actors', Actor, 'update', actor_id)
+        return update_response(Actor, actor_id, 'actor')
 
     #  Movie Endpoints
     #  ----------------------------------------------------------------
 
+    #  Get a page of movies, optionally filtered by release date range
     @app.route('/movies')
     @requires_auth('get:movies')
+    @router.reads('movie', 'movie_cast', 'actor')
+    @response_cache.cached('movie', scope='get:movies', embeds={'actors': ('movie_cast', 'actor')})
     def get_movies(payload):
-        movies=Movie.query.all()
+        limit, cursor = get_page_args()
+        embed = get_embed_arg(('actors',))
+        filters = {
+            'released_after': get_filter_arg('released_after', date.fromisoformat),
+            'released_before': get_filter_arg('released_before', date.fromisoformat),
+        }
+        if catalog.enabled and not embed:
+            movies, next_cursor = catalog.table(Movie).page(limit, cursor, **filters)
+        else:
+            movies, next_cursor = paginate(Movie.filtered(**filters), Movie, limit, cursor)
+            movies = row_dicts(movies)
 
         if len(movies) == 0:
             abort(404)
 
-        formatted_movies = [movie.format() for movie in movies]
-        
+        if 'actors' in embed:
+            embed_cast(Movie, movies, 'actors')
+
+        with metrics.timed('serialize'):
+            return json_response({
+                'success': True,
+                'movies': movies,
+                'next_cursor': next_cursor
+            })
+
+    #  Search movies by title, ranked, the cursor is the offset of the next page
+    @app.route('/movies/search')
+    @requires_auth('get:movies')
+    @router.reads('movie')
+    @response_cache.cached('movie', scope='get:movies')
+    def search_movies(payload):
+        limit, offset = get_page_args()
+        query = get_search_arg()
+        movies, next_cursor = search.search(Movie, 'title', query, offset or 0, limit)
+
+        with metrics.timed('serialize'):
+            return json_response({
+                'success': True,
+                'movies': row_dicts(movies),
+                'next_cursor': next_cursor
+            })
+
+    #  Get one movie, revalidated with its ETag
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth('get:movies')
+    @router.reads('movie')
+    def get_movie(payload, movie_id):
+        return record_response(Movie, movie_id, 'movie')
+
+    #  Get a page of the actors cast in a movie
+    @app.route('/movies/<int:movie_id>/actors')
+    @requires_auth('get:actors')
+    @router.reads('movie', 'movie_cast', 'actor')
+    @response_cache.cached(('actor', 'movie_cast'), scope='get:actors')
+    def get_movie_actors(payload, movie_id):
+        limit, cursor = get_page_args()
+        if not existing_ids(Movie, [movie_id]):
+            abort(404)
+
+        actors, next_cursor = paginate(cast_query(Actor, Movie, movie_id), Actor, limit, cursor)
+
+        with metrics.timed('serialize'):
+            return json_response({
+                'success': True,
+                'movie': movie_id,
+                'actors': row_dicts(actors),
+                'next_cursor': next_cursor
+            })
+
+    #  Cast an actor in a movie
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['PUT'])
+    @requires_auth('patch:movies')
+    def add_movie_actor(payload, movie_id, actor_id):
+        if not existing_ids(Movie, [movie_id]) or not existing_ids(Actor, [actor_id]):
+            abort(404)
+
+        created = add_cast(movie_id, actor_id)
+
         return jsonify({
-            'success': True,
-            'movies': formatted_movies
-        })    
+            "success": True,
+            "movie": movie_id,
+            "actor": actor_id,
+            "created": created
+        })
+
+    #  Remove an actor from the cast of a movie
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def remove_movie_actor(payload, movie_id, actor_id):
+        if not remove_cast(movie_id, actor_id):
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "movie": movie_id,
+            "actor": actor_id
+        })
+
+    #  Export all movies
+    @app.route('/movies/export')
+    @requires_auth('get:movies')
+    @router.reads('movie')
+    def export_movies(payload):
+        query = Movie.filtered(
+            released_after=get_filter_arg('released_after', date.fromisoformat),
+            released_before=get_filter_arg('released_before', date.fromisoformat),
+        )
+        return export_response(query, Movie)
 
     @app.route('/movies/<movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
-        movie=Movie.query.get(movie_id)
+        if write_behind():
+            return enqueue_response(payload, 'delete:movies', Movie, 'delete', movie_id)
+
+        movie=live(Movie).filter(Movie.id == movie_id).one_or_none()
             
         #Deletes the actor, aborts 404 if actor ID is not found
         if movie is None:
@@ -151,14 +866,15 @@ def create_app(test_config=None):
     @app.route('/movies',methods=['POST'])
     @requires_auth('post:movies')
     def create_movie(payload):
-        #Gets the json body and attributes from the form
-        body = request.get_json()
-        new_title = body.get("title", None)
-        new_release_date = body.get("release_date", None)
+        if write_behind():
+            return enqueue_response(payload, 'post:movies', Movie, 'create')
+
+        #Gets the checked attributes from the json body, with the release date parsed
+        values = get_create_values(Movie)
 
         try:
             #Creates a new entry in the DB
-            movie = Movie(title=new_title, release_date=new_release_date)
+            movie = Movie(**values)
             movie.insert()
 
             #Returns the json object
@@ -174,38 +890,29 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    #  Bulk movie endpoints, each batch is validated up front and written in one transaction
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def bulk_create_movies(payload):
+        return bulk_create_response(Movie)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def bulk_update_movies(payload):
+        return bulk_update_response(Movie)
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def bulk_delete_movies(payload):
+        return bulk_delete_response(Movie)
+
     # Update movie details
     @app.route("/movies/<int:movie_id>", methods=["PATCH"])
     @requires_auth('patch:movies')
     def update_movie(payload, movie_id):
-        #Get body from Json
-        body = request.get_json()
-
-        #try:
-        #Find the actor by actor id
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        if movie is None:
-            abort(404)
-
-        #Update title if included
-        if "title" in body:
-            movie.title = body.get("title")
-        
-        #Update release date if included
-        if "release_date" in body:
-            movie.release_date = body.get("release_date")
-
-        #Apply to the DB
-        movie.update()
-
-        return jsonify(
-            {
-                "success": True,
-            }
-        )
-
-        #except:
-        #    abort(400)
+        if write_behind():
+            return enqueue_response(payload, 'patch:movies', Movie, 'update', movie_id)
+        return update_response(Movie, movie_id, 'movie')
 
     #-----------  ERROR HANDLERS  --------------
     """
@@ -223,7 +930,13 @@ def create_app(test_config=None):
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({"success": False, "error": 422, "message": "unprocessable"}),422
+        #abort(422, message) names what was refused
+        message = error.description if error.description != type(error).description else "unprocessable"
+        return jsonify({"success": False, "error": 422, "message": message}),422
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({"success": False, "error": 412, "message": "precondition failed"}), 412
 
     @app.errorhandler(400)
     def bad_request(error):
@@ -238,6 +951,7 @@ def create_app(test_config=None):
     def handle_auth_error(error):
         response = jsonify(error.error)
         response.status_code = error.status_code
+        response.headers.extend(error.headers)
         return response
     
     return app
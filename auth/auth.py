@@ -1,13 +1,81 @@
-import json
-from flask import request, _request_ctx_stack
+import math
+import os
+from flask import Response, request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from .jwks import JWKSCache, JWKSError
+from .keys import Issuer, issuer_from_config, jwk_key, load_issuers_file, load_key_file
+from .token_cache import TokenCache
+from .rate_limit import AdmissionControl, RateLimiter, store_from_url
+from metrics import rejected_requests, timed
 
-##Auth0 Application Info
-AUTH0_DOMAIN = 'capstone-casting-k44.us.auth0.com'
-ALGORITHMS = ['RS256']
-API_AUDIENCE = 'casting-info'
+##Auth0 Application Info, the default issuer of the tokens
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'capstone-casting-k44.us.auth0.com')
+ALGORITHMS = os.environ.get('JWT_ALGORITHMS', 'RS256').split(',')
+API_AUDIENCE = os.environ.get('API_AUDIENCE', 'casting-info')
+
+##JWKS source and cache settings. JWKS_URL can point at a local file (file:// URL or path)
+##to run without reaching Auth0
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_OPTIONS = {
+    'ttl': int(os.environ.get('JWKS_CACHE_TTL', 600)),
+    'refresh_ahead': int(os.environ.get('JWKS_REFRESH_AHEAD', 60)),
+    'min_refetch_interval': int(os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30)),
+}
+jwks_cache = JWKSCache(JWKS_URL, parse_key=lambda key_data: jwk_key(key_data, ALGORITHMS), **JWKS_OPTIONS)
+
+##The issuers whose tokens are accepted, by iss claim:
+##- Auth0, with the keys of JWKS_URL, or of the JWKS or PEM file JWT_KEYS_FILE, parsed once
+##  at startup (JWT_KEY_ID names the key of a PEM file)
+##- with SERVICE_TOKEN_SECRET set, HS256 tokens of internal services, issued as
+##  SERVICE_TOKEN_ISSUER
+##- the issuers listed in the JSON file AUTH_ISSUERS_FILE, see auth.keys.issuer_from_config
+def configured_issuers():
+    if os.environ.get('JWT_KEYS_FILE'):
+        keys = load_key_file(os.environ['JWT_KEYS_FILE'], ALGORITHMS, os.environ.get('JWT_KEY_ID'))
+        issuers = [Issuer('https://' + AUTH0_DOMAIN + '/', API_AUDIENCE, ALGORITHMS, keys=keys)]
+    else:
+        issuers = [Issuer('https://' + AUTH0_DOMAIN + '/', API_AUDIENCE, ALGORITHMS, jwks=jwks_cache)]
+
+    if os.environ.get('SERVICE_TOKEN_SECRET'):
+        issuers.append(issuer_from_config({
+            'issuer': os.environ.get('SERVICE_TOKEN_ISSUER', 'casting-internal'),
+            'secret_env': 'SERVICE_TOKEN_SECRET',
+        }, API_AUDIENCE))
+
+    if os.environ.get('AUTH_ISSUERS_FILE'):
+        issuers.extend(load_issuers_file(os.environ['AUTH_ISSUERS_FILE'], API_AUDIENCE, JWKS_OPTIONS))
+
+    return {issuer.issuer: issuer for issuer in issuers}
+
+issuers = configured_issuers()
+
+##Loads the JWKS of every issuer before the first request, the keys are otherwise fetched lazily
+def load_keys():
+    for issuer in issuers.values():
+        try:
+            issuer.load()
+        except JWKSError:
+            pass
+
+##Verified tokens are cached until they expire, TOKEN_CACHE_SIZE=0 disables the cache
+token_cache = TokenCache(max_entries=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)))
+
+##Requests per second allowed per token subject (RATE_LIMIT_KEY), 0 turns the limit off.
+##RATE_LIMIT_URL shares the buckets between workers, like RESPONSE_CACHE_URL
+rate_limiter = RateLimiter(
+    store_from_url(os.environ.get('RATE_LIMIT_URL', 'memory://')),
+    rate=float(os.environ.get('RATE_LIMIT_PER_SECOND', 0)),
+    burst=int(os.environ.get('RATE_LIMIT_BURST', 0)),
+    key=os.environ.get('RATE_LIMIT_KEY', 'sub'),
+)
+
+##Requests handled at once by a worker process, 0 turns the cap off
+admission = AdmissionControl(
+    max_concurrent=int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0)),
+    max_queued=int(os.environ.get('MAX_QUEUED_REQUESTS', 0)),
+    queue_timeout=float(os.environ.get('QUEUE_TIMEOUT', 1)),
+)
 
 ## AuthError Exception
 '''
@@ -15,9 +83,10 @@ AuthError Exception
 A standardized way to communicate auth failure modes
 '''
 class AuthError(Exception):
-    def __init__(self, error, status_code):
+    def __init__(self, error, status_code, headers=None):
         self.error = error
         self.status_code = status_code
+        self.headers = headers or {}
 
 
 ## Auth Header
@@ -59,8 +128,8 @@ def get_token_auth_header():
     token = parts[1]
     return token
    
-##Check the permissions of the token
-def check_permissions(permission, payload):
+##Check the permissions of the token, permissions can be passed in as a precomputed frozenset
+def check_permissions(permission, payload, permissions=None):
     if 'permissions' not in payload:
         ##Raise Auth Error if permissions were not included in payload
         raise AuthError({
@@ -68,7 +137,11 @@ def check_permissions(permission, payload):
             'description': 'Permissions were not included in the payload.'
         }, 400)
     
-    if permission not in payload['permissions']:
+    if permissions is None:
+        ##A claim that isn't a list grants nothing, as in the token cache
+        permissions = payload['permissions'] if isinstance(payload['permissions'], list) else ()
+
+    if permission not in permissions:
         ##Raise Auth Error if permission string is not in payload permissions array
         raise AuthError({
             'code': 'invalid_permission',
@@ -79,71 +152,136 @@ def check_permissions(permission, payload):
 
 ##Function to verify the decoded jwt
 def verify_decode_jwt(token):
-    ## Connects with the auth0 domain
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    ## verifies the RSA Key
-    rsa_key = {}
-    if 'kid' not in unverified_header:
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+        unverified_claims = jwt.get_unverified_claims(token)
+    except jwt.JWTError:
         raise AuthError({
             'code': 'invalid_header',
-            'description': 'Authorization malformed.'
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+    ## Finds the issuer the token claims to come from, its keys, audience and algorithms
+    issuer = issuers.get(unverified_claims.get('iss'))
+    if issuer is None:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    ## Formats the payload of the RSA Key
-    if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-            return payload
-        ## Checks for expired token
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-        ## Checks for invalid claims
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims. Please, check the audience and issuer.'
-            }, 401)
-         ## Checks for valid header
-        except Exception:
+    ## Looks the key up among the keys parsed when they were loaded
+    try:
+        key = issuer.get_key(unverified_header.get('kid'))
+    except JWKSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+    if key is None:
+        ## verifies the RSA Key
+        if 'kid' not in unverified_header:
             raise AuthError({
                 'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
-    raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to find the appropriate key.'
-            }, 400)
+                'description': 'Authorization malformed.'
+            }, 401)
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to find the appropriate key.'
+        }, 400)
+
+    ## Formats the payload of the key
+    try:
+        payload = jwt.decode(
+            token,
+            key,
+            algorithms=issuer.algorithms,
+            audience=issuer.audience,
+            issuer=issuer.issuer
+        )
+        return payload
+    ## Checks for expired token
+    except jwt.ExpiredSignatureError:
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, 401)
+    ## Checks for invalid claims
+    except jwt.JWTClaimsError:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
+        }, 401)
+    ## Checks for valid header
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+
+##Returns the (payload, permissions) of the token, only verifying tokens that aren't cached
+def verify_cached_jwt(token):
+    entry = token_cache.get(token)
+    if entry is None:
+        with timed('auth.decode'):
+            payload = verify_decode_jwt(token)
+        entry = token_cache.put(token, payload)
+    return entry
+
+
+##Raises a 429 AuthError if the client is over its rate limit, or a 503 one if the worker
+##is at its concurrency cap and queue.  Otherwise the caller holds an admission slot
+def admit_request(payload, permission):
+    wait = rate_limiter.check(payload, permission)
+    if wait:
+        rejected_requests.inc('rate_limited')
+        raise AuthError({
+            'code': 'rate_limited',
+            'description': 'Too many requests, retry later.'
+        }, 429, {'Retry-After': str(math.ceil(wait))})
+
+    if not admission.acquire():
+        rejected_requests.inc('overloaded')
+        raise AuthError({
+            'code': 'overloaded',
+            'description': 'The server is busy, retry later.'
+        }, 503, {'Retry-After': str(admission.retry_after())})
 
 
 ## Decorator method to implement authorization for the associated route
-def requires_auth(permission=''):
+## Each stage is timed into the http_request_stage_seconds histogram of /metrics.
+## Requests are admitted after the permission check, before the route touches the DB.
+## With no permission any valid token is let through, for routes checking their own.
+## Routes reading several tables pass every permission they need, so that all of them are
+## checked before the route, and its response cache, run.  The first one is the rate limit key
+def requires_auth(permission='', *more_permissions):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with timed('auth.header'):
+                token = get_token_auth_header()
+            with timed('auth.verify'):
+                payload, permissions = verify_cached_jwt(token)
+            with timed('auth.permissions'):
+                for required in (permission,) + more_permissions:
+                    if required:
+                        check_permissions(required, payload, permissions)
+            with timed('auth.admission'):
+                admit_request(payload, permission)
+
+            try:
+                with timed('handler'):
+                    response = f(payload, *args, **kwargs)
+            except BaseException:
+                admission.release()
+                raise
+
+            ## A streamed body still reads from the DB, its slot is released when it is closed
+            if isinstance(response, Response) and response.is_streamed:
+                response.call_on_close(admission.release)
+            else:
+                admission.release()
+            return response
 
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,132 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+
+## JWKSError Exception
+'''
+JWKSError Exception
+Raised when the JWKS document can't be loaded and no cached keys are left
+'''
+class JWKSError(Exception):
+    pass
+
+
+## JWKS key cache
+'''
+JWKSCache(source, ttl, refresh_ahead, min_refetch_interval, timeout)
+    keeps the signing keys of a JWKS document in memory, indexed by kid.
+    - source can be an https:// or file:// URL, or a plain path to a local JWKS file
+    - keys are reused for `ttl` seconds; once less than `refresh_ahead` seconds
+      are left they are refreshed on a background thread while the old keys keep serving
+    - an unknown kid triggers one refetch, at most once per `min_refetch_interval` seconds
+    - if a refresh fails the stale keys keep serving until the next retry
+    - parse_key, if given, turns each JWK dict into the key that is cached, see auth.keys.
+      Keys it returns None for are dropped
+'''
+class JWKSCache:
+    def __init__(self, source, ttl=600, refresh_ahead=60, min_refetch_interval=30, timeout=5,
+                 parse_key=None):
+        self.source = source
+        self.parse_key = parse_key
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+
+        self._keys = None
+        self._expires_at = 0.0
+        self._last_fetch = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    ## Reads and parses the JWKS document from the configured source
+    def fetch(self):
+        if '://' in self.source:
+            with urlopen(self.source, timeout=self.timeout) as jsonurl:
+                jwks = json.loads(jsonurl.read())
+        else:
+            with open(self.source) as jwks_file:
+                jwks = json.load(jwks_file)
+
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key:
+                continue
+            if self.parse_key is not None:
+                parsed = self.parse_key(key)
+                if parsed is not None:
+                    keys[key['kid']] = parsed
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    ## Fetches the keys and swaps them in, keeping the stale keys if the fetch fails.
+    ## Passing if_older_than skips the fetch when another thread refreshed since then.
+    def refresh(self, if_older_than=None):
+        with self._lock:
+            if (if_older_than is not None and self._keys is not None
+                    and self._last_fetch >= if_older_than):
+                return True
+
+            now = time.monotonic()
+            self._last_fetch = now
+            try:
+                keys = self.fetch()
+            except Exception as e:
+                if self._keys is None:
+                    raise JWKSError('Unable to fetch the JWKS from %s: %s' % (self.source, e))
+                ## Retry no sooner than the refetch interval, serving the stale keys meanwhile
+                self._expires_at = now + self.min_refetch_interval
+                return False
+
+            self._keys = keys
+            self._expires_at = now + self.ttl
+            return True
+
+    def _refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except JWKSError:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def _can_refetch(self, now):
+        return self._last_fetch is None or now - self._last_fetch >= self.min_refetch_interval
+
+    ## Returns the key for the given kid, or None if the JWKS doesn't contain it
+    def get_key(self, kid):
+        now = time.monotonic()
+        if self._keys is None or now >= self._expires_at:
+            self.refresh(if_older_than=now)
+        elif now >= self._expires_at - self.refresh_ahead:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._can_refetch(now):
+            ## Keys may have been rotated, refetch once
+            self.refresh(if_older_than=now)
+            key = self._keys.get(kid)
+        return key
+
+    ## Drops the cached keys so that the next lookup refetches them
+    def clear(self):
+        with self._lock:
+            self._keys = None
+            self._expires_at = 0.0
+            self._last_fetch = None
@@ -0,0 +1,138 @@
+import json
+import os
+
+from jose import jwk
+from jose.exceptions import JWKError
+
+from .jwks import JWKSCache
+
+
+## Key parsing
+'''
+Signing keys are parsed into jose Key objects once, when they are loaded, and reused for
+every token.  jwt.decode would otherwise construct the key from its JWK dict on each call.
+'''
+## Algorithm of a JWK that doesn't name its own, the first one of `algorithms` for its key type
+def key_algorithm(key_data, algorithms):
+    if key_data.get('alg'):
+        return key_data['alg']
+    prefixes = {'RSA': ('RS', 'PS'), 'EC': ('ES',), 'oct': ('HS',)}.get(key_data.get('kty'), ())
+    for algorithm in algorithms:
+        if algorithm.startswith(prefixes):
+            return algorithm
+    return None
+
+## Returns the Key of a JWK dict, or None if it can't be used with the algorithms
+def jwk_key(key_data, algorithms=('RS256',)):
+    algorithm = key_algorithm(key_data, algorithms)
+    if algorithm is None or algorithm not in algorithms:
+        return None
+    try:
+        return jwk.construct(key_data, algorithm)
+    except JWKError:
+        return None
+
+'''
+load_key_file(path, algorithms, kid)
+    reads the public keys of a JWKS file, or the single key of a PEM file, indexed by kid.
+    A PEM key is stored under `kid`, None when tokens signed by it carry no kid
+'''
+def load_key_file(path, algorithms, kid=None):
+    with open(path) as key_file:
+        contents = key_file.read()
+
+    if contents.lstrip().startswith('{'):
+        keys = {}
+        for key_data in json.loads(contents).get('keys', []):
+            key = jwk_key(key_data, algorithms)
+            if key is not None:
+                keys[key_data.get('kid')] = key
+        return keys
+
+    algorithm = next((a for a in algorithms if not a.startswith('HS')), None)
+    if algorithm is None:
+        raise ValueError('%s holds a PEM key but no public key algorithm is allowed' % path)
+    return {kid: jwk.construct(contents, algorithm)}
+
+
+## Issuers
+'''
+Issuer(issuer, audience, algorithms, keys, jwks)
+    the tokens of one issuer, checked against its audience and algorithms.  Its keys are
+    either a fixed dict of Key objects by kid, or a JWKSCache refetched as the keys rotate.
+    A key stored under the kid None verifies the tokens without a kid
+'''
+class Issuer:
+    def __init__(self, issuer, audience, algorithms, keys=None, jwks=None):
+        if (keys is None) == (jwks is None):
+            raise ValueError('issuer %s needs either keys or a jwks source' % issuer)
+        self.issuer = issuer
+        self.audience = audience
+        self.algorithms = list(algorithms)
+        self.keys = keys
+        self.jwks = jwks
+
+    ## Returns the Key for the kid of a token, None if the issuer has none.  Raises
+    ## JWKSError if the JWKS can't be loaded
+    def get_key(self, kid):
+        if self.jwks is not None:
+            return self.jwks.get_key(kid) if kid is not None else None
+        key = self.keys.get(kid)
+        if key is None and kid is not None:
+            key = self.keys.get(None)
+        return key
+
+    ## Loads the JWKS ahead of the first token, raises JWKSError if it can't be loaded
+    def load(self):
+        if self.jwks is not None:
+            self.jwks.refresh()
+
+
+'''
+issuer_from_config(config, default_audience)
+    builds an Issuer from one entry of the AUTH_ISSUERS_FILE list:
+    - issuer: the iss claim of the tokens
+    - audience: their aud claim, API_AUDIENCE by default
+    - algorithms: allowed algorithms, ["RS256"] by default (["HS256"] for a secret)
+    - one key source:
+        jwks_url   - https:// or file:// URL or path of a JWKS, cached like JWKS_URL
+        keys_file  - JWKS or PEM file, parsed once; "kid" names the key of a PEM file
+        secret_env - environment variable holding a shared HMAC secret
+'''
+def issuer_from_config(config, default_audience, jwks_options=None):
+    issuer = config['issuer']
+    audience = config.get('audience', default_audience)
+
+    if 'secret_env' in config:
+        algorithms = config.get('algorithms', ['HS256'])
+        if any(not algorithm.startswith('HS') for algorithm in algorithms):
+            raise ValueError('issuer %s signs with a secret, only HS algorithms are allowed' % issuer)
+        secret = os.environ.get(config['secret_env'])
+        if not secret:
+            raise ValueError('issuer %s: %s is not set' % (issuer, config['secret_env']))
+        key = jwk.construct(secret.encode('utf-8'), algorithms[0])
+        return Issuer(issuer, audience, algorithms, keys={config.get('kid'): key})
+
+    algorithms = config.get('algorithms', ['RS256'])
+    if any(algorithm.startswith('HS') for algorithm in algorithms):
+        ## A public key must never be usable as an HMAC secret
+        raise ValueError('issuer %s uses public keys, HS algorithms need secret_env' % issuer)
+
+    if 'keys_file' in config:
+        keys = load_key_file(config['keys_file'], algorithms, config.get('kid'))
+        return Issuer(issuer, audience, algorithms, keys=keys)
+
+    if 'jwks_url' in config:
+        jwks = JWKSCache(config['jwks_url'], parse_key=lambda key_data: jwk_key(key_data, algorithms),
+                         **(jwks_options or {}))
+        return Issuer(issuer, audience, algorithms, jwks=jwks)
+
+    raise ValueError('issuer %s needs jwks_url, keys_file or secret_env' % issuer)
+
+## Reads the list of issuer entries of a JSON file, a list or {"issuers": [...]}
+def load_issuers_file(path, default_audience, jwks_options=None):
+    with open(path) as config_file:
+        config = json.load(config_file)
+    if isinstance(config, dict):
+        config = config.get('issuers', [])
+    return [issuer_from_config(entry, default_audience, jwks_options) for entry in config]
@@ -0,0 +1,212 @@
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+## Token bucket stores
+'''
+A store keeps one token bucket per key:
+    take(key, rate, burst) -> seconds until a token is available, 0 if one was taken
+A bucket starts full with `burst` tokens and refills at `rate` tokens per second.
+MemoryStore is private to the worker process, SQLiteStore is shared by the processes of one
+host and RedisStore by every host.
+'''
+def _take(tokens, updated, now, rate, burst):
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryStore:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, wait = _take(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            ## An evicted bucket is the least recently used one, it comes back full
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute('CREATE TABLE IF NOT EXISTS rate_bucket '
+                                '(key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        connection = self._connect()
+        ## The write lock is taken up front so that the read and the write of a bucket are atomic
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated FROM rate_bucket WHERE key = ?',
+                                     (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, wait = _take(tokens, updated, now, rate, burst)
+            connection.execute('INSERT OR REPLACE INTO rate_bucket VALUES (?, ?, ?)',
+                               (key, tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RedisStore:
+    ## The whole update runs in redis, the wait is returned as a string to keep its fraction
+    SCRIPT = '''
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+    def __init__(self, url):
+        ## redis is optional, only needed when the limiter is configured with a redis:// url
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self._script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._script(keys=[key], args=[rate, burst, time.time()]))
+
+
+'''
+store_from_url(url)
+    memory:// (default), sqlite:///path/to/limits.db or redis://host:port/db
+'''
+def store_from_url(url):
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisStore(url)
+    return MemoryStore()
+
+
+## Rate limiter
+'''
+RateLimiter(store, rate, burst, key)
+    token bucket rate limit of `rate` requests per second on average, in bursts of up to `burst`
+    requests.  key is what a bucket is shared by: 'sub' (each token subject), 'permission'
+    (every client of the permission a route requires) or 'sub+permission'.
+    A rate of 0 turns the limiter off
+'''
+class RateLimiter:
+    KEYS = ('sub', 'permission', 'sub+permission')
+
+    def __init__(self, store, rate=0, burst=None, key='sub'):
+        if key not in self.KEYS:
+            raise ValueError('rate limit key must be one of %s' % ', '.join(self.KEYS))
+        self.store = store
+        self.rate = rate
+        self.burst = burst or max(1, math.ceil(rate))
+        self.key = key
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def bucket(self, payload, permission):
+        parts = []
+        if self.key != 'permission':
+            parts.append('sub=' + str(payload.get('sub', '')))
+        if self.key != 'sub':
+            parts.append('permission=' + permission)
+        return 'rate:' + ':'.join(parts)
+
+    ## Returns 0 if the request may go on, or the seconds to wait before retrying
+    def check(self, payload, permission):
+        if not self.enabled:
+            return 0
+        return self.store.take(self.bucket(payload, permission), self.rate, self.burst)
+
+
+## Admission control
+'''
+AdmissionControl(max_concurrent, max_queued, queue_timeout)
+    caps the requests the worker process handles at once.  Once `max_concurrent` are running,
+    up to `max_queued` more wait for a slot for at most `queue_timeout` seconds, and the
+    others are shed right away.  max_concurrent 0 turns it off
+'''
+class AdmissionControl:
+    def __init__(self, max_concurrent=0, max_queued=0, queue_timeout=1.0):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.shed = 0
+
+        self._slots = threading.Semaphore(max_concurrent) if max_concurrent > 0 else None
+        self._lock = threading.Lock()
+
+    ## Takes a slot, returns False if the request is shed
+    def acquire(self):
+        if self._slots is None:
+            return True
+
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                if self.queued >= self.max_queued:
+                    self.shed += 1
+                    return False
+                self.queued += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.queued -= 1
+
+        with self._lock:
+            if acquired:
+                self.active += 1
+            else:
+                self.shed += 1
+        return acquired
+
+    def release(self):
+        if self._slots is None:
+            return
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    ## Seconds a shed client is asked to wait before retrying
+    def retry_after(self):
+        return max(1, math.ceil(self.queue_timeout))
+
+    def stats(self):
+        return {
+            'max_concurrent': self.max_concurrent,
+            'active': self.active,
+            'queued': self.queued,
+            'shed': self.shed,
+        }
@@ -0,0 +1,79 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+## Verified token cache
+'''
+TokenCache(max_entries, max_token_size)
+    bounded LRU of verified JWT payloads, keyed by the SHA-256 of the token.
+    - an entry is dropped once the token's exp claim has passed, tokens without exp are not cached
+    - at most `max_entries` tokens no longer than `max_token_size` bytes are kept, which caps memory use
+    - each entry also carries the token's permissions as a frozenset for check_permissions,
+      empty unless the claim is a list
+'''
+class TokenCache:
+    def __init__(self, max_entries=10000, max_token_size=8192):
+        self.max_entries = max_entries
+        self.max_token_size = max_token_size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    ## Returns the cached (payload, permissions) of the token, or None
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            exp, payload, permissions = entry
+            if time.time() >= exp:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    ## Stores a verified payload and returns its (payload, permissions)
+    def put(self, token, payload):
+        claim = payload.get('permissions')
+        permissions = frozenset(permission for permission in claim if isinstance(permission, str)) \
+            if isinstance(claim, list) else frozenset()
+        exp = payload.get('exp')
+        if (self.max_entries <= 0 or not isinstance(exp, (int, float))
+                or len(token) > self.max_token_size):
+            return payload, permissions
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, payload, permissions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload, permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
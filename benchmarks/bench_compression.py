@@ -0,0 +1,72 @@
+'''
+Response compression benchmark
+
+Requests pages of GET /actors in-process with each Accept-Encoding, and reports the body
+size and the time per request once the response is cached, when the compressed body comes
+from the response cache, against the time it takes to compress the body on every request:
+
+    python -m benchmarks.bench_compression --rows 10000 --limit 1000
+'''
+
+import argparse
+import json
+import tempfile
+import time
+
+from benchmarks.harness import prepare_environment, seed_database
+
+
+## Best time of the runs, in milliseconds
+def best_ms(function, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return round(best * 1000, 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--limit', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    auth = prepare_environment(tempfile.mkdtemp(prefix='casting-bench-'))
+    seed_database(args.rows, 0)
+
+    from app import create_app
+    from compression import compression
+
+    app = create_app()
+    client = app.test_client()
+    token = auth.sign()
+    results = {'settings': vars(args), 'encodings': compression.encodings, 'runs': []}
+    for limit in args.limit:
+        path = '/actors?limit=%d' % limit
+        for encoding in ['identity'] + compression.encodings:
+            headers = {'Authorization': 'Bearer ' + token, 'Accept-Encoding': encoding}
+            response = client.get(path, headers=headers)
+            identity = client.get(path, headers={'Authorization': 'Bearer ' + token})
+            summary = {
+                'limit': limit,
+                'encoding': encoding,
+                'bytes': len(response.data),
+                'cached_ms': best_ms(lambda: client.get(path, headers=headers), args.runs),
+                'compress_ms': best_ms(lambda: compression.compress(identity.data, encoding), args.runs)
+                if encoding != 'identity' else 0.0,
+            }
+            results['runs'].append(summary)
+            print('limit %5d  %-8s %9d bytes  cached request %7.3f ms  compressing the body %7.3f ms' % (
+                limit, encoding, summary['bytes'], summary['cached_ms'], summary['compress_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
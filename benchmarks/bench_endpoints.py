@@ -0,0 +1,220 @@
+'''
+Endpoint load benchmark
+
+Runs offline: tokens are signed with a local RSA key served to the app as a JWKS file, and
+the database is a temporary SQLite file unless DATABASE_URL is set (use a scratch postgres
+database for realistic numbers, the harness writes to it).  Seeds N actors and movies,
+starts the app under gunicorn or serve.py and drives every route at the given concurrency,
+one endpoint after the other.  Reports throughput and p50/p95/p99 latency per endpoint:
+
+    python -m benchmarks.bench_endpoints --seed-rows 10000 --concurrency 32 --duration 10 \\
+        --output results.json
+'''
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.harness import SYLLABLES, prepare_environment, seed_database, seed_cast, insert_rows, actor_rows, movie_rows
+from benchmarks.load import free_port, run_load, server_command, start_server, stop_server, wait_until_ready
+
+
+class Scenarios:
+    def __init__(self, args, auth, actor_ids, movie_ids):
+        self.args = args
+        self.actor_ids = actor_ids
+        self.movie_ids = movie_ids
+        self.subs = ['bench|%d' % index for index in range(args.tokens)]
+        tokens = [auth.sign(sub=sub) for sub in self.subs]
+        self.headers = [{'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
+                        for token in tokens]
+
+    def headers_for(self, worker):
+        return self.headers[worker % len(self.headers)]
+
+    def get(self, path):
+        return lambda worker, i: ('GET', path, self.headers_for(worker), None)
+
+    def send(self, method, path, make_body):
+        return lambda worker, i: (method, path(worker, i) if callable(path) else path,
+                                  self.headers_for(worker), json.dumps(make_body(worker, i)))
+
+    def pick(self, ids, worker, i):
+        return ids[(worker * 7919 + i) % len(ids)]
+
+    ## Searches for two-syllable word prefixes of the seeded names and titles
+    def search(self, path):
+        prefixes = [first + second for first in SYLLABLES for second in SYLLABLES]
+        return lambda worker, i: ('GET', '%s?q=%s&limit=20' % (path, self.pick(prefixes, worker, i)),
+                                  self.headers_for(worker), None)
+
+    ## Requests consuming ids seeded just for them, each worker takes its own share
+    def consume(self, ids, batch, make_request):
+        concurrency = self.args.concurrency
+
+        def request(worker, i):
+            share = ids[worker::concurrency]
+            chunk = share[i * batch:(i + 1) * batch]
+            if not chunk:
+                return None
+            return make_request(worker, chunk)
+        return request
+
+    ## Reads the status of jobs queued in the outbox of the server, each worker those of its token
+    def jobs(self, per_token=100):
+        from outbox import Outbox
+        queue = Outbox(os.environ['OUTBOX_PATH'])
+        job_ids = [[queue.enqueue('update', 'actor', id, {'age': 30}, sub, 'patch:actors')
+                    for id in self.actor_ids[:per_token]] for sub in self.subs]
+        return lambda worker, i: ('GET', '/jobs/%d' % self.pick(job_ids[worker % len(job_ids)], worker, i),
+                                  self.headers_for(worker), None)
+
+    ## (name, method, make_request or factory of make_request) for every route in app.py
+    def all(self):
+        batch = self.args.batch
+        actor = {'name': 'Bench Actor', 'gender': 'Female', 'age': 30}
+        movie = {'title': 'Bench Movie', 'release_date': '2001-02-03'}
+        return [
+            ('GET /health', lambda: lambda worker, i: ('GET', '/health', {}, None)),
+            ('GET /ready', lambda: lambda worker, i: ('GET', '/ready', {}, None)),
+            ('GET /metrics', lambda: lambda worker, i: ('GET', '/metrics', {}, None)),
+            ('GET /stats', lambda: self.get('/stats')),
+            ('GET /changes', lambda: self.get('/changes?limit=100')),
+            ('GET /jobs/<id>', lambda: self.jobs()),
+            ('GET /actors', lambda: self.get('/actors?limit=100')),
+            ('GET /actors filtered', lambda: self.get('/actors?gender=Female&min_age=30&max_age=50&limit=100')),
+            ('GET /actors/export', lambda: self.get('/actors/export')),
+            ('GET /actors/search', lambda: self.search('/actors/search')),
+            ('GET /actors embed', lambda: self.get('/actors?embed=movies&limit=100')),
+            ('GET /actors/<id>', lambda: lambda w, i: (
+                'GET', '/actors/%d' % self.pick(self.actor_ids, w, i), self.headers_for(w), None)),
+            ('GET /actors/<id>/movies', lambda: lambda w, i: (
+                'GET', '/actors/%d/movies' % self.pick(self.actor_ids, w, i), self.headers_for(w), None)),
+            ('POST /actors', lambda: self.send('POST', '/actors', lambda w, i: actor)),
+            ('PATCH /actors/<id>', lambda: self.send(
+                'PATCH', lambda w, i: '/actors/%d' % self.pick(self.actor_ids, w, i),
+                lambda w, i: {'age': 20 + i % 50})),
+            ('DELETE /actors/<id>', lambda: self.consume(
+                self.seed_deletable('actor'), 1,
+                lambda w, ids: ('DELETE', '/actors/%d' % ids[0], self.headers_for(w), None))),
+            ('POST /actors/bulk', lambda: self.send('POST', '/actors/bulk', lambda w, i: [actor] * batch)),
+            ('PATCH /actors/bulk', lambda: self.send('PATCH', '/actors/bulk', lambda w, i: [
+                {'id': id, 'age': 20 + i % 50}
+                for id in self.actor_ids[(w * batch) % len(self.actor_ids):][:batch]])),
+            ('DELETE /actors/bulk', lambda: self.consume(
+                self.seed_deletable('actor'), batch,
+                lambda w, ids: ('DELETE', '/actors/bulk', self.headers_for(w), json.dumps(ids)))),
+            ('GET /movies', lambda: self.get('/movies?limit=100')),
+            ('GET /movies filtered', lambda: self.get('/movies?released_after=1990-01-01&released_before=2000-12-31&limit=100')),
+            ('GET /movies/export', lambda: self.get('/movies/export')),
+            ('GET /movies/search', lambda: self.search('/movies/search')),
+            ('GET /movies embed', lambda: self.get('/movies?embed=actors&limit=100')),
+            ('GET /movies/<id>', lambda: lambda w, i: (
+                'GET', '/movies/%d' % self.pick(self.movie_ids, w, i), self.headers_for(w), None)),
+            ('GET /movies/<id>/actors', lambda: lambda w, i: (
+                'GET', '/movies/%d/actors' % self.pick(self.movie_ids, w, i), self.headers_for(w), None)),
+            ('PUT /movies/<id>/actors/<id>', lambda: lambda w, i: (
+                'PUT', '/movies/%d/actors/%d' % (self.pick(self.movie_ids, w, i), self.pick(self.actor_ids, w, i + 1)),
+                self.headers_for(w), None)),
+            ('DELETE /movies/<id>/actors/<id>', lambda: self.consume(
+                self.seed_deletable_cast(), 1,
+                lambda w, pairs: ('DELETE', '/movies/%d/actors/%d' % pairs[0], self.headers_for(w), None))),
+            ('POST /movies', lambda: self.send('POST', '/movies', lambda w, i: movie)),
+            ('PATCH /movies/<id>', lambda: self.send(
+                'PATCH', lambda w, i: '/movies/%d' % self.pick(self.movie_ids, w, i),
+                lambda w, i: {'title': 'Bench Movie %d' % i})),
+            ('DELETE /movies/<id>', lambda: self.consume(
+                self.seed_deletable('movie'), 1,
+                lambda w, ids: ('DELETE', '/movies/%d' % ids[0], self.headers_for(w), None))),
+            ('POST /movies/bulk', lambda: self.send('POST', '/movies/bulk', lambda w, i: [movie] * batch)),
+            ('PATCH /movies/bulk', lambda: self.send('PATCH', '/movies/bulk', lambda w, i: [
+                {'id': id, 'title': 'Bench Movie %d' % i}
+                for id in self.movie_ids[(w * batch) % len(self.movie_ids):][:batch]])),
+            ('DELETE /movies/bulk', lambda: self.consume(
+                self.seed_deletable('movie'), batch,
+                lambda w, ids: ('DELETE', '/movies/bulk', self.headers_for(w), json.dumps(ids)))),
+        ]
+
+    ## Inserts the rows a delete scenario consumes
+    def seed_deletable(self, table):
+        from app import create_app
+        from models import Actor, Movie
+
+        rng = random.Random(self.args.delete_pool)
+        app = create_app()
+        with app.app_context():
+            if table == 'actor':
+                return insert_rows(Actor, actor_rows(self.args.delete_pool, rng))
+            return insert_rows(Movie, movie_rows(self.args.delete_pool, rng))
+
+    ## Casts actors inserted for it in the seeded movies, the (movie id, actor id) pairs a delete scenario consumes
+    def seed_deletable_cast(self):
+        from app import create_app
+        from models import db, movie_cast, notify_change
+
+        pairs = [(self.pick(self.movie_ids, 0, i), actor_id)
+                 for i, actor_id in enumerate(self.seed_deletable('actor'))]
+        app = create_app()
+        with app.app_context():
+            db.session.execute(movie_cast.insert(), [{'movie_id': movie_id, 'actor_id': actor_id}
+                                                     for movie_id, actor_id in pairs])
+            db.session.commit()
+            notify_change(movie_cast.name)
+            db.session.remove()
+        return pairs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed-rows', type=int, default=10000, help='actors and movies to seed')
+    parser.add_argument('--reset', action='store_true', help='delete existing actors and movies first')
+    parser.add_argument('--server', choices=('sync', 'serve'), default='sync')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint')
+    parser.add_argument('--tokens', type=int, default=1, help='distinct bearer tokens to spread requests over')
+    parser.add_argument('--batch', type=int, default=100, help='items per bulk request')
+    parser.add_argument('--delete-pool', type=int, default=5000, help='rows seeded for each delete endpoint')
+    parser.add_argument('--only', help='only run endpoints whose name contains this text')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='casting-bench-')
+    auth = prepare_environment(directory)
+    actor_ids, movie_ids = seed_database(args.seed_rows, args.seed_rows, reset=args.reset)
+    seed_cast(actor_ids, movie_ids)
+    ## Queued writes only for the requests asking for them (Prefer: respond-async), so /jobs has jobs to read
+    os.environ.setdefault('OUTBOX_PATH', os.path.join(directory, 'outbox.db'))
+    scenarios = Scenarios(args, auth, actor_ids, movie_ids)
+
+    port = free_port()
+    base_url = 'http://127.0.0.1:%d' % port
+    server = start_server(server_command(args.server, port, args.workers))
+    results = {
+        'settings': dict(vars(args), database=os.environ['DATABASE_URL'].split('@')[-1]),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'endpoints': {},
+    }
+    try:
+        wait_until_ready(base_url)
+        for name, scenario in scenarios.all():
+            if args.only and args.only not in name:
+                continue
+            summary = run_load(base_url, scenario(), args.concurrency, args.duration)
+            results['endpoints'][name] = summary
+            print('%-32s %8.1f req/s  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  errors %d  statuses %s' % (
+                name, summary['requests_per_second'] or 0, summary['p50_ms'] or 0,
+                summary['p95_ms'] or 0, summary['p99_ms'] or 0, summary['errors'], summary['statuses']))
+    finally:
+        stop_server(server)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
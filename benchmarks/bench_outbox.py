@@ -0,0 +1,94 @@
+'''
+Write-behind benchmark
+
+Drives the same mutations through the commit-per-request path and through the write-behind
+outbox (Prefer: respond-async, see outbox.py) of one server, and reports for each the
+requests/sec and latency seen by the clients.  For the outbox it also reports how long the
+flusher took to apply the queued jobs after the load stopped, and the rate at which jobs
+reached the database over the whole run:
+
+    python -m benchmarks.bench_outbox --workers 2 --concurrency 32 --duration 10
+'''
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.harness import prepare_environment, seed_database
+from benchmarks.load import free_port, run_load, server_command, start_server, stop_server, wait_until_ready
+
+
+def scenarios(actor_ids):
+    actor = json.dumps({'name': 'Bench Actor', 'gender': 'Female', 'age': 30})
+    return [
+        ('POST /actors', lambda w, i: ('POST', '/actors', actor)),
+        ('PATCH /actors/<id>', lambda w, i: (
+            'PATCH', '/actors/%d' % actor_ids[(w * 7919 + i) % len(actor_ids)],
+            json.dumps({'age': 20 + i % 50}))),
+    ]
+
+
+## Seconds until the outbox has no queued job left
+def wait_for_drain(outbox, timeout=300):
+    start = time.perf_counter()
+    while outbox.queued() and time.perf_counter() - start < timeout:
+        time.sleep(0.05)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--seed-rows', type=int, default=1000)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='casting-bench-')
+    auth = prepare_environment(directory)
+    actor_ids, _ = seed_database(args.seed_rows, args.seed_rows)
+    token = auth.sign()
+
+    os.environ['OUTBOX_PATH'] = os.path.join(directory, 'outbox.db')
+    from outbox import Outbox
+    outbox = Outbox(os.environ['OUTBOX_PATH'])
+
+    port = free_port()
+    base_url = 'http://127.0.0.1:%d' % port
+    server = start_server(server_command('sync', port, args.workers))
+    results = {'settings': vars(args), 'endpoints': {}}
+    try:
+        wait_until_ready(base_url)
+        for name, make in scenarios(actor_ids):
+            for mode, extra in (('commit', {}), ('outbox', {'Prefer': 'respond-async'})):
+                headers = dict({'Authorization': 'Bearer ' + token,
+                                'Content-Type': 'application/json'}, **extra)
+
+                def make_request(worker, i):
+                    method, path, body = make(worker, i)
+                    return method, path, headers, body
+
+                summary = run_load(base_url, make_request, args.concurrency, args.duration)
+                if mode == 'outbox':
+                    summary['drain_seconds'] = round(wait_for_drain(outbox), 3)
+                    summary['applied_per_second'] = round(
+                        summary['requests'] / (summary['seconds'] + summary['drain_seconds']), 1)
+                results['endpoints']['%s %s' % (name, mode)] = summary
+                print('%-20s %-6s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  statuses %s%s' % (
+                    name, mode, summary['requests_per_second'] or 0, summary['p50_ms'] or 0,
+                    summary['p99_ms'] or 0, summary['statuses'],
+                    '  drained in %.2f s, %.1f applied/s' % (summary['drain_seconds'], summary['applied_per_second'])
+                    if mode == 'outbox' else ''))
+    finally:
+        stop_server(server)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Query count benchmark
+
+Counts the SQL statements of a page of actors with their movies, and of movies with their
+actors, at each page size: lazy loading the relationship of every row (N+1 queries) against
+the ?embed= parameter of the list routes, which loads the related records of the whole page
+in one query:
+
+    python -m benchmarks.bench_queries --limits 10 100 1000
+'''
+
+import argparse
+import json
+import tempfile
+
+from benchmarks.harness import prepare_environment, seed_cast, seed_database
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def after_cursor_execute(self, *args):
+        self.count += 1
+
+
+def lazy_page(model, relationship, limit):
+    rows = model.query.order_by(model.id).limit(limit).all()
+    return [dict(row.format(), **{relationship: [related.format() for related in getattr(row, relationship)]})
+            for row in rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--limits', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--per-actor', type=int, default=3, help='movies each seeded actor is cast in')
+    parser.add_argument('--reset', action='store_true', help='delete existing actors and movies first')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    auth = prepare_environment(tempfile.mkdtemp(prefix='casting-bench-'))
+    actor_ids, movie_ids = seed_database(max(args.limits), max(args.limits), reset=args.reset)
+    seed_cast(actor_ids, movie_ids, args.per_actor)
+
+    from app import create_app
+    from models import db, Actor, Movie
+
+    app = create_app({'TESTING': True})
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + auth.sign()}
+    results = []
+    with app.app_context():
+        counter = StatementCounter(db.engine)
+        for path, model, relationship in (('/actors', Actor, 'movies'), ('/movies', Movie, 'actors')):
+            for limit in args.limits:
+                counter.count = 0
+                lazy_page(model, relationship, limit)
+                db.session.remove()
+                lazy = counter.count
+
+                counter.count = 0
+                response = client.get('%s?embed=%s&limit=%d' % (path, relationship, limit), headers=headers)
+                assert response.status_code == 200, response.status_code
+                embedded = counter.count
+
+                results.append({'path': path, 'limit': limit, 'lazy_queries': lazy, 'embed_queries': embedded})
+                print('%-8s limit %5d  lazy loading %5d queries  ?embed=%s %3d queries' % (
+                    path, limit, lazy, relationship, embedded))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+Search latency benchmark
+
+Seeds N actors and movies and times search.search() for queries made of the prefixes of
+seeded words, one or two terms each.  Reports p50/p95/p99 per table.  Use a scratch postgres
+DATABASE_URL for the indexed search, the default SQLite file exercises the in-process index:
+
+    DATABASE_URL=postgresql://... python -m benchmarks.bench_search --rows 1000000
+'''
+
+import argparse
+import json
+import random
+import tempfile
+import time
+
+from benchmarks.harness import prepare_environment, seed_database
+from benchmarks.load import percentile
+
+
+## Queries of one or two word prefixes from random rows of the column
+def make_queries(model, column_name, count, rng):
+    from models import db
+    from search import words
+
+    column = getattr(model, column_name)
+    texts = [value for (value,) in db.session.query(column).order_by(model.id).limit(10000)]
+    queries = []
+    for _ in range(count):
+        terms = words(rng.choice(texts))
+        picked = rng.sample(terms, min(len(terms), rng.randint(1, 2)))
+        queries.append(' '.join(term[:rng.randint(3, max(3, len(term)))] for term in picked))
+    return queries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='actors and movies to seed')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--limit', type=int, default=20, help='page size')
+    parser.add_argument('--reset', action='store_true', help='delete existing actors and movies first')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    prepare_environment(tempfile.mkdtemp(prefix='casting-bench-'))
+    seed_database(args.rows, args.rows, reset=args.reset)
+
+    from app import create_app
+    from models import db, Actor, Movie
+    import search
+
+    rng = random.Random(0)
+    results = {}
+    app = create_app()
+    with app.app_context():
+        for model, column_name in ((Actor, 'name'), (Movie, 'title')):
+            queries = make_queries(model, column_name, args.queries, rng)
+            ## The first search loads the in-process index, it isn't counted
+            search.search(model, column_name, queries[0], 0, args.limit)
+
+            latencies = []
+            matched = 0
+            for query in queries:
+                start = time.perf_counter()
+                rows, next_cursor = search.search(model, column_name, query, 0, args.limit)
+                latencies.append(time.perf_counter() - start)
+                matched += bool(rows)
+                db.session.remove()
+
+            latencies.sort()
+            summary = {
+                'queries': len(queries),
+                'matched': matched,
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            }
+            results[model.__tablename__] = summary
+            print('%-6s %d queries  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms' % (
+                model.__tablename__, summary['queries'], summary['p50_ms'],
+                summary['p95_ms'], summary['p99_ms']))
+    results['database'] = db.engine.dialect.name
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Serialization micro-benchmark
+
+Times the per-row cost of turning a page of actors or movies into a JSON body, the old way
+(model instances, format() dicts and Flask's default encoder, which writes dates as RFC 1123
+strings) against the column tuples and serialization.dumps used by the list routes.  The
+fetch and the encoding are timed separately, at each row count:
+
+    python -m benchmarks.bench_serialization --rows 10000 100000
+'''
+
+import argparse
+import json
+import tempfile
+import time
+
+from benchmarks.harness import prepare_environment, seed_database
+
+
+def format_before(model, size):
+    from flask import json as flask_json
+    from flask.json import JSONEncoder
+
+    start = time.perf_counter()
+    rows = model.query.order_by(model.id).limit(size).all()
+    fetched = time.perf_counter()
+    body = flask_json.dumps({'success': True, 'rows': [row.format() for row in rows]},
+                            cls=JSONEncoder, sort_keys=True).encode('utf-8')
+    return len(rows), fetched - start, time.perf_counter() - fetched, len(body)
+
+
+def format_after(model, size):
+    from models import row_columns
+    from serialization import dumps, row_dicts
+
+    start = time.perf_counter()
+    rows = model.query.with_entities(*row_columns(model)) \
+        .order_by(model.id).limit(size).all()
+    fetched = time.perf_counter()
+    body = dumps({'success': True, 'rows': row_dicts(rows)})
+    return len(rows), fetched - start, time.perf_counter() - fetched, len(body)
+
+
+## Best of the runs, in microseconds per row
+def measure(function, model, size, runs):
+    best = None
+    for _ in range(runs):
+        count, fetch, encode, length = function(model, size)
+        if best is None or fetch + encode < best[0] + best[1]:
+            best = (fetch, encode)
+    return {
+        'rows': count,
+        'fetch_us_per_row': round(best[0] / count * 1e6, 3),
+        'encode_us_per_row': round(best[1] / count * 1e6, 3),
+        'total_us_per_row': round((best[0] + best[1]) / count * 1e6, 3),
+        'body_bytes': length,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--reset', action='store_true', help='delete existing actors and movies first')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    prepare_environment(tempfile.mkdtemp(prefix='casting-bench-'))
+    seed_database(max(args.rows), max(args.rows), reset=args.reset)
+
+    from app import create_app
+    from models import Actor, Movie
+    from serialization import JSON_BACKEND
+
+    results = {'json_backend': JSON_BACKEND, 'runs': []}
+    app = create_app()
+    with app.app_context():
+        for model in (Actor, Movie):
+            for size in args.rows:
+                for name, function in (('before', format_before), ('after', format_after)):
+                    summary = dict(measure(function, model, size, args.runs),
+                                   table=model.__tablename__, path=name)
+                    results['runs'].append(summary)
+                    print('%-6s %-6s %7d rows  fetch %7.2f us/row  encode %7.2f us/row  total %7.2f us/row' % (
+                        summary['table'], name, summary['rows'], summary['fetch_us_per_row'],
+                        summary['encode_us_per_row'], summary['total_us_per_row']))
+    print('json backend: %s' % JSON_BACKEND)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
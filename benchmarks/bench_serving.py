@@ -0,0 +1,78 @@
+'''
+Serving benchmark
+
+Starts the app under gunicorn (sync workers) and under serve.py (gunicorn with workers warmed
+up before they accept) with the same number of worker processes, drives the same GET
+endpoint at the given concurrency and reports requests/sec and p50/p95/p99 latency of each
+mode, and the latency of the first request once the server answers /health.  Runs offline
+with the benchmark harness (local signing key, seeded database), or against the configured
+DATABASE_URL and the token in BENCH_TOKEN when it is set:
+
+    python -m benchmarks.bench_serving --workers 2 --concurrency 64 --duration 15
+'''
+
+import argparse
+import json
+import os
+import tempfile
+
+from benchmarks.harness import prepare_environment, seed_database
+from benchmarks.load import free_port, run_load, server_command, start_server, stop_server, wait_until_ready
+
+
+def bench_mode(mode, args, token):
+    port = free_port()
+    base_url = 'http://127.0.0.1:%d' % port
+    server = start_server(server_command(mode, port, args.workers))
+    try:
+        wait_until_ready(base_url)
+        headers = {'Authorization': 'Bearer ' + token}
+
+        def make_request(worker, i):
+            return 'GET', args.path, headers, None
+
+        ## The first request pays for whatever the worker didn't warm up
+        first = run_load(base_url, lambda worker, i: make_request(worker, i) if i == 0 else None, 1, 30)
+
+        ## Warm up connections, caches and pools before measuring
+        run_load(base_url, make_request, args.concurrency, 2)
+        summary = run_load(base_url, make_request, args.concurrency, args.duration)
+        summary['first_request_ms'] = first['p50_ms']
+        return summary
+    finally:
+        stop_server(server)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--path', default='/actors')
+    parser.add_argument('--seed-rows', type=int, default=1000)
+    parser.add_argument('--modes', nargs='+', choices=('sync', 'serve'), default=['sync', 'serve'])
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    token = os.environ.get('BENCH_TOKEN')
+    if token is None:
+        auth = prepare_environment(tempfile.mkdtemp(prefix='casting-bench-'))
+        seed_database(args.seed_rows, args.seed_rows)
+        token = auth.sign()
+
+    results = {
+        'settings': vars(args),
+        'modes': {mode: bench_mode(mode, args, token) for mode in args.modes},
+    }
+
+    for mode, summary in results['modes'].items():
+        print('%-5s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  first request %8.2f ms  errors %d' % (
+            mode, summary['requests_per_second'], summary['p50_ms'], summary['p99_ms'],
+            summary['first_request_ms'], summary['errors']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Catalog snapshot benchmark
+
+Compares the memory per row of the actors and movies held as model instances, as column
+tuples and in the columnar catalog snapshot (see snapshot.py), and the time to read a page
+of the list routes with paginate() against the snapshot, unfiltered and filtered:
+
+    python -m benchmarks.bench_snapshot --rows 100000 --limit 100
+'''
+
+import argparse
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.harness import prepare_environment, seed_database
+
+FILTERS = {
+    'actor': {'gender': 'Female', 'min_age': 40, 'max_age': 49},
+    'movie': {'released_after': '1990-01-01', 'released_before': '1999-12-31'},
+}
+
+
+## Bytes allocated per row by load(), which returns what it loaded
+def memory_per_row(load, rows):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        loaded = load()
+        gc.collect()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del loaded
+    return round(allocated / rows, 1)
+
+
+## Best time of the runs, in milliseconds
+def best_ms(function, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return round(best * 1000, 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--reset', action='store_true', help='delete existing actors and movies first')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    prepare_environment(tempfile.mkdtemp(prefix='casting-bench-'))
+    seed_database(args.rows, args.rows, reset=args.reset)
+
+    from datetime import date
+    from app import create_app, paginate
+    from models import db, live, row_columns, Actor, Movie
+    from serialization import row_dicts
+    from snapshot import ColumnarTable
+
+    results = {'settings': vars(args), 'tables': {}}
+    app = create_app()
+    with app.app_context():
+        for model in (Actor, Movie):
+            name = model.__tablename__
+            rows = live(model).count()
+            filters = dict(FILTERS[name])
+            for key in ('released_after', 'released_before'):
+                if key in filters:
+                    filters[key] = date.fromisoformat(filters[key])
+
+            def load_snapshot():
+                table = ColumnarTable(model)
+                table.load()
+                return table
+
+            summary = results['tables'][name] = {
+                'rows': rows,
+                'bytes_per_row': {
+                    'instances': memory_per_row(lambda: live(model).all(), rows),
+                    'tuples': memory_per_row(lambda: live(model).with_entities(*row_columns(model)).all(), rows),
+                    'snapshot': memory_per_row(load_snapshot, rows),
+                },
+            }
+            db.session.remove()
+
+            table = load_snapshot()
+            summary['page_ms'] = {
+                'query': best_ms(lambda: row_dicts(paginate(live(model), model, args.limit, None)[0]), args.runs),
+                'snapshot': best_ms(lambda: table.page(args.limit), args.runs),
+                'query_filtered': best_ms(
+                    lambda: row_dicts(paginate(model.filtered(**filters), model, args.limit, None)[0]), args.runs),
+                'snapshot_filtered': best_ms(lambda: table.page(args.limit, **filters), args.runs),
+            }
+            print('%-6s %7d rows  bytes/row: instances %7.1f  tuples %7.1f  snapshot %7.1f' % (
+                name, rows, summary['bytes_per_row']['instances'], summary['bytes_per_row']['tuples'],
+                summary['bytes_per_row']['snapshot']))
+            print('%-6s page of %d: query %.3f ms  snapshot %.3f ms  filtered: query %.3f ms  snapshot %.3f ms' % (
+                name, args.limit, summary['page_ms']['query'], summary['page_ms']['snapshot'],
+                summary['page_ms']['query_filtered'], summary['page_ms']['snapshot_filtered']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
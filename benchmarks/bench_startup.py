@@ -0,0 +1,64 @@
+'''
+Startup time benchmark
+
+Times create_app() against create_app() followed by the schema check that setup_db used to
+run on every call (db.create_all(), which connects and inspects every table).  This is the
+work saved on each worker boot and test setUp.  Needs DATABASE_URL:
+
+    python -m benchmarks.bench_startup --runs 20
+'''
+
+import argparse
+import json
+import time
+
+from app import create_app
+from models import db
+
+
+def create_app_only():
+    create_app()
+
+
+def create_app_with_schema_check():
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        ## Drop the connection like a fresh worker process would not have it
+        db.get_engine(app).dispose()
+
+
+def time_runs(function, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        'runs': runs,
+        'mean_ms': round(sum(timings) / runs * 1000, 3),
+        'min_ms': round(min(timings) * 1000, 3),
+        'max_ms': round(max(timings) * 1000, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    results = {
+        'create_app': time_runs(create_app_only, args.runs),
+        'create_app_with_schema_check': time_runs(create_app_with_schema_check, args.runs),
+    }
+    for name, summary in results.items():
+        print('%-30s mean %8.3f ms  min %8.3f ms  max %8.3f ms' % (
+            name, summary['mean_ms'], summary['min_ms'], summary['max_ms']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import base64
+import json
+import os
+import random
+import time
+from datetime import date, timedelta
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+from benchmarks.load import ROOT
+
+'''
+Offline benchmark setup
+
+LocalAuth signs tokens with a locally generated RSA key and publishes the public key as a
+JWKS file, which the app reads through JWKS_URL instead of reaching Auth0.
+prepare_environment() points DATABASE_URL (a temporary SQLite file unless it is already
+set) and JWKS_URL at the local stand-ins, seed_database() creates the schema and N actors
+and movies.
+'''
+
+ALL_PERMISSIONS = [
+    'delete:actors', 'delete:movies', 'get:actors', 'get:movies',
+    'patch:actors', 'patch:movies', 'post:actors', 'post:movies',
+]
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class LocalAuth:
+    def __init__(self, directory, kid='bench-key'):
+        self.kid = kid
+        key = RSA.generate(2048)
+        self.private_pem = key.exportKey('PEM').decode('ascii')
+        self.jwks_path = os.path.join(directory, 'jwks.json')
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+                'n': b64url_uint(key.n), 'e': b64url_uint(key.e),
+            }]}, f)
+
+    @property
+    def jwks_url(self):
+        return 'file://' + self.jwks_path
+
+    ## Returns a token accepted by verify_decode_jwt with the given permissions
+    def sign(self, permissions=ALL_PERMISSIONS, sub='bench|0', lifetime=3600):
+        from auth.auth import AUTH0_DOMAIN, API_AUDIENCE
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + AUTH0_DOMAIN + '/',
+            'aud': API_AUDIENCE,
+            'sub': sub,
+            'iat': now,
+            'exp': now + lifetime,
+            'permissions': list(permissions),
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+
+## Sets up the environment of the harness and of the servers it starts, returns LocalAuth
+def prepare_environment(directory):
+    auth = LocalAuth(directory)
+    os.environ['JWKS_URL'] = auth.jwks_url
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(directory, 'bench.db'))
+    return auth
+
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ne', 'so', 'ti', 'van', 'der', 'el', 'an', 'mar',
+             'jo', 'li', 'sa', 'ber', 'ton', 'is', 'co', 'ru', 'wen', 'da', 'fe', 'gor']
+
+
+## A made-up word of 2 to 4 syllables, so names and titles spread over many search terms
+def word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+
+
+def actor_rows(count, rng):
+    genders = ['Female', 'Male', 'Non-binary']
+    return [{'name': '%s %s' % (word(rng), word(rng)), 'gender': rng.choice(genders),
+             'age': rng.randint(18, 90)} for _ in range(count)]
+
+
+def movie_rows(count, rng):
+    first = date(1950, 1, 1)
+    return [{'title': ' '.join(word(rng) for _ in range(rng.randint(1, 4))),
+             'release_date': first + timedelta(days=rng.randrange(365 * 70))}
+            for _ in range(count)]
+
+
+'''
+seed_database(actors, movies, reset, seed)
+    upgrades the schema and inserts the rows in batches, reset=True deletes the existing
+    actors and movies first. Returns the ids of the inserted actors and movies
+'''
+def seed_database(actors, movies, reset=False, seed=0):
+    from flask_migrate import upgrade
+    from app import create_app
+    from models import db, rebuild_stats, Actor, Movie
+
+    rng = random.Random(seed)
+    app = create_app()
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        if reset:
+            Actor.query.delete()
+            Movie.query.delete()
+            db.session.commit()
+            rebuild_stats()
+
+        actor_ids = insert_rows(Actor, actor_rows(actors, rng))
+        movie_ids = insert_rows(Movie, movie_rows(movies, rng))
+        db.session.remove()
+    return actor_ids, movie_ids
+
+
+## Casts each actor in `per_actor` random movies, returns the number of movie_cast rows
+def seed_cast(actor_ids, movie_ids, per_actor=3, seed=0):
+    from app import create_app
+    from models import db, movie_cast, notify_change
+
+    rng = random.Random(seed)
+    rows = [{'movie_id': movie_id, 'actor_id': actor_id}
+            for actor_id in actor_ids
+            for movie_id in rng.sample(movie_ids, min(per_actor, len(movie_ids)))]
+    app = create_app()
+    with app.app_context():
+        for start in range(0, len(rows), 1000):
+            db.session.execute(movie_cast.insert(), rows[start:start + 1000])
+        db.session.commit()
+        notify_change(movie_cast.name)
+        db.session.remove()
+    return len(rows)
+
+
+## Inserts the rows in batches of 1000, needs an app context
+def insert_rows(model, rows, batch_size=1000):
+    from models import bulk_insert
+    ids = []
+    for start in range(0, len(rows), batch_size):
+        ids.extend(bulk_insert(model, rows[start:start + batch_size]))
+    return ids
@@ -0,0 +1,145 @@
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+'''
+Load driver shared by the benchmarks
+
+run_load(base_url, make_request, concurrency, duration)
+    runs `concurrency` threads, each with its own keep-alive connection, for `duration`
+    seconds. make_request(worker, i) returns the (method, path, headers, body) of the i-th
+    request of a worker, or None once the worker has nothing left to send.
+    Returns the summary of summarize().
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+## Throughput, latency percentiles (in milliseconds) and response status counts of a run
+def summarize(latencies, errors, elapsed, statuses=None):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'statuses': dict(sorted((statuses or {}).items())),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(count / elapsed, 1) if elapsed else None,
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if count else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if count else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if count else None,
+    }
+
+
+def run_load(base_url, make_request, concurrency, duration):
+    url = urlsplit(base_url)
+    latencies = []
+    errors = [0]
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        local_latencies = []
+        local_errors = 0
+        local_statuses = {}
+        i = 0
+        while time.perf_counter() < deadline:
+            request = make_request(index, i)
+            if request is None:
+                break
+            method, path, headers, body = request
+            i += 1
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                local_statuses[response.status] = local_statuses.get(response.status, 0) + 1
+                if not 200 <= response.status < 300:
+                    ## Only successful responses count towards the throughput and latency of the route
+                    local_errors += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+                continue
+            local_latencies.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, errors[0], time.perf_counter() - started, statuses)
+
+
+## Polls GET <path> until it answers 200, raises RuntimeError after `timeout` seconds
+def wait_until_ready(base_url, path='/health', timeout=30):
+    url = urlsplit(base_url)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            connection = http.client.HTTPConnection(url.hostname, url.port, timeout=2)
+            connection.request('GET', path)
+            if connection.getresponse().status == 200:
+                connection.close()
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('%s did not become ready within %s seconds' % (base_url, timeout))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+## Command line of the app server: gunicorn sync workers or serve.py (gunicorn with warmed up workers)
+def server_command(mode, port, workers):
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', 'app:app', '--workers', str(workers),
+                '--bind', '127.0.0.1:%d' % port, '--log-level', 'warning']
+    return [sys.executable, 'serve.py', '--workers', str(workers),
+            '--bind', '127.0.0.1:%d' % port, '--log-level', 'warning']
+
+
+## Starts the server in its own process group so that its workers can be stopped with it
+def start_server(command, env=None):
+    return subprocess.Popen(command, cwd=ROOT, env=env or os.environ.copy(),
+                            start_new_session=True)
+
+
+def stop_server(server):
+    os.killpg(server.pid, signal.SIGTERM)
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
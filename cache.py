@@ -0,0 +1,285 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from compression import compression, encoded_etag
+from metrics import timed
+
+
+## Cache backends
+'''
+A backend stores byte values with a TTL and integer counters:
+    get(key), set(key, value, ttl), incr(key), counter(key)
+MemoryBackend is private to the worker process, SQLiteBackend is shared by the processes
+of one host and stands in for a shared store like RedisBackend.
+'''
+class MemoryBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._values = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ttl)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+
+class SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_value '
+                               '(key TEXT PRIMARY KEY, value BLOB, expires_at REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_counter '
+                               '(key TEXT PRIMARY KEY, value INTEGER)')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM cache_value WHERE key = ? AND expires_at > ?',
+            (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM cache_value WHERE expires_at <= ?', (time.time(),))
+            connection.execute('INSERT OR REPLACE INTO cache_value VALUES (?, ?, ?)',
+                               (key, value, time.time() + ttl))
+
+    def incr(self, key):
+        with self._connect() as connection:
+            connection.execute('INSERT OR IGNORE INTO cache_counter VALUES (?, 0)', (key,))
+            connection.execute('UPDATE cache_counter SET value = value + 1 WHERE key = ?', (key,))
+            return connection.execute('SELECT value FROM cache_counter WHERE key = ?',
+                                      (key,)).fetchone()[0]
+
+    def counter(self, key):
+        row = self._connect().execute('SELECT value FROM cache_counter WHERE key = ?',
+                                      (key,)).fetchone()
+        return row[0] if row else 0
+
+
+class RedisBackend:
+    def __init__(self, url):
+        ## redis is optional, only needed when the cache is configured with a redis:// url
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=max(int(ttl), 1))
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def counter(self, key):
+        return int(self.client.get(key) or 0)
+
+
+'''
+backend_from_url(url)
+    memory:// (default), sqlite:///path/to/cache.db or redis://host:port/db
+'''
+def backend_from_url(url):
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisBackend(url)
+    return MemoryBackend(int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)))
+
+
+## Read-through response cache
+'''
+ResponseCache(backend, ttl)
+    caches the serialized body of successful GET responses per table version, permission scope
+    and query string, and answers If-None-Match requests with 304.
+    invalidate(table) bumps the version of the table so that older entries are never read again.
+    A response read from several tables is keyed on the versions of all of them.
+    The compressed bodies are cached under the key of the body and the encoding, see compression.py
+'''
+class ResponseCache:
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+
+    def version(self, table):
+        return self.backend.counter('version:' + table)
+
+    def invalidate(self, table, ids=None):
+        self.backend.incr('version:' + table)
+
+    def key(self, tables, scope):
+        query = '&'.join(sorted(request.query_string.decode().split('&')))
+        versions = ','.join(str(self.version(table)) for table in tables)
+        return 'response:%s:%s:%s:%s?%s' % ('+'.join(tables), versions, scope, request.path, query)
+
+    ## The body compressed with the encoding, compressed once per cached body
+    def encoded(self, key, body, encoding, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        key = '%s;%s' % (key, encoding)
+        value = self.backend.get(key) if ttl > 0 else None
+        if value is None:
+            value = compression.compress(body, encoding)
+            if ttl > 0:
+                self.backend.set(key, value, ttl)
+        return bytes(value)
+
+    ## Responds with the body, compressed in the encoding the client accepts.
+    ## encoded(encoding) returns the compressed body, by default it is compressed for this response
+    @staticmethod
+    def respond(body, etag, encoded=None):
+        vary = compression.compresses(len(body))
+        encoding = compression.negotiate(len(body))
+        etag = encoded_etag(etag, encoding)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        elif encoding is None:
+            response = Response(body, mimetype='application/json')
+        else:
+            body = encoded(encoding) if encoded is not None else compression.compress(body, encoding)
+            response = Response(body, mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if vary:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    ## Decorator caching the responses of a list route, placed below requires_auth.
+    ## table is a table name or a tuple of them, embeds maps the values of the embed
+    ## query parameter to the extra tables the embedded records are read from.
+    ## ttl overrides the cache TTL for the route, 0 doesn't cache its responses
+    def cached(self, table, scope, embeds=None, ttl=None):
+        tables = (table,) if isinstance(table, str) else tuple(table)
+        embeds = embeds or {}
+        ttl = self.ttl if ttl is None else ttl
+
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with timed('cache'):
+                    key_tables = tables
+                    for name in request.args.get('embed', '').split(','):
+                        key_tables += embeds.get(name, ())
+                    key = self.key(key_tables, scope)
+                    entry = self.backend.get(key) if ttl > 0 else None
+                if entry is not None:
+                    etag, body = bytes(entry).split(b' ', 1)
+                    return self.respond(body, etag.decode(),
+                                        lambda encoding: self.encoded(key, body, encoding, ttl))
+
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+
+                body = response.get_data()
+                etag = hashlib.sha1(body).hexdigest()
+                if ttl > 0:
+                    self.backend.set(key, etag.encode() + b' ' + body, ttl)
+                return self.respond(body, etag, lambda encoding: self.encoded(key, body, encoding, ttl))
+
+            return wrapper
+        return cached_decorator
+
+
+## Per-worker record cache
+'''
+RecordCache(max_entries, ttl)
+    LRU of the serialized single-record responses of this worker process, by table and id,
+    each with the ETag of the record.  invalidate(table, ids) drops the written records, and
+    entries expire after `ttl` seconds to bound how long writes of other workers go unseen.
+    A record read before an invalidation isn't stored after it: set() takes the generation
+    returned by generation() before the read.  max_entries 0 turns the cache off
+'''
+class RecordCache:
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        return self._generation
+
+    def get(self, table, id):
+        with self._lock:
+            entry = self._entries.get((table, id))
+            if entry is None:
+                return None
+            etag, body, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[(table, id)]
+                return None
+            self._entries.move_to_end((table, id))
+            return etag, body
+
+    def set(self, table, id, etag, body, generation):
+        with self._lock:
+            if self.max_entries <= 0 or generation != self._generation:
+                return
+            self._entries[(table, id)] = (etag, body, time.monotonic() + self.ttl)
+            self._entries.move_to_end((table, id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table, ids=None):
+        with self._lock:
+            self._generation += 1
+            if ids is None:
+                for key in [key for key in self._entries if key[0] == table]:
+                    del self._entries[key]
+            else:
+                for id in ids:
+                    self._entries.pop((table, id), None)
+
+
+response_cache = ResponseCache(
+    backend_from_url(os.environ.get('RESPONSE_CACHE_URL', 'memory://')),
+    ttl=int(os.environ.get('RESPONSE_CACHE_TTL', 60)),
+)
+
+record_cache = RecordCache(
+    max_entries=int(os.environ.get('RECORD_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('RECORD_CACHE_TTL', 60)),
+)
@@ -0,0 +1,112 @@
+import gzip
+import os
+
+from flask import request
+
+from metrics import timed
+
+try:
+    ## brotli is optional, br is offered when it is installed
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+
+Response bodies of at least COMPRESSION_MIN_SIZE bytes (default 1024) are compressed with
+the encoding of COMPRESSION_ENCODINGS (default "br,gzip", br only when the brotli package is
+installed) that the client accepts with the highest quality, ties going to the first one.
+An empty COMPRESSION_ENCODINGS turns compression off.
+
+The cached responses of cache.ResponseCache are compressed once per encoding and the
+compressed body is cached next to the JSON, so a repeated request sends the stored bytes.
+Their ETag gets the encoding as a suffix ("<etag>-gzip"), so each encoding of a body is
+validated on its own.  Other responses, like /health or /metrics, are compressed on the way
+out by an after_request hook.  Streamed exports are sent uncompressed.
+'''
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain')
+
+
+def _gzip(body):
+    return gzip.compress(body, compresslevel=6)
+
+def _brotli(body):
+    return brotli.compress(body, quality=5)
+
+COMPRESSORS = {'gzip': _gzip}
+if brotli is not None:
+    COMPRESSORS['br'] = _brotli
+
+
+def encoded_etag(etag, encoding):
+    return etag if encoding is None else '%s-%s' % (etag, encoding)
+
+## The ETag of the body before it was compressed, e.g. a row version sent back in If-Match
+def decoded_etag(etag):
+    base, _, encoding = etag.rpartition('-')
+    return base if base and encoding in ('br', 'gzip') else etag
+
+
+class Compression:
+    def __init__(self, encodings=('br', 'gzip'), min_size=1024):
+        self.configure(encodings, min_size)
+
+    def configure(self, encodings, min_size):
+        if isinstance(encodings, str):
+            encodings = [encoding.strip() for encoding in encodings.split(',') if encoding.strip()]
+        unknown = set(encodings) - {'br', 'gzip'}
+        if unknown:
+            raise ValueError('unknown COMPRESSION_ENCODINGS: %s' % ', '.join(sorted(unknown)))
+        self.encodings = [encoding for encoding in encodings if encoding in COMPRESSORS]
+        self.min_size = min_size
+
+    ## Takes COMPRESSION_ENCODINGS and COMPRESSION_MIN_SIZE from the app config and compresses its responses
+    def init_app(self, app):
+        self.configure(
+            app.config.get('COMPRESSION_ENCODINGS', os.environ.get('COMPRESSION_ENCODINGS', 'br,gzip')),
+            int(app.config.get('COMPRESSION_MIN_SIZE', os.environ.get('COMPRESSION_MIN_SIZE', 1024))))
+        if self.compress_response not in app.after_request_funcs.get(None, []):
+            app.after_request(self.compress_response)
+
+    ## Whether a body of this size is compressed for the clients that accept it
+    def compresses(self, size):
+        return bool(self.encodings) and size >= self.min_size
+
+    ## The encoding of a body of this size for the current request, None to send it as is
+    def negotiate(self, size):
+        if not self.compresses(size):
+            return None
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compress(self, body, encoding):
+        with timed('compress'):
+            return COMPRESSORS[encoding](body)
+
+    ## after_request hook compressing the responses that weren't compressed by the response cache
+    def compress_response(self, response):
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+
+        body = response.get_data()
+        if not self.compresses(len(body)):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate(len(body))
+        if encoding is None:
+            return response
+
+        response.set_data(self.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(encoded_etag(etag, encoding), weak)
+        return response
+
+
+compression = Compression(
+    os.environ.get('COMPRESSION_ENCODINGS', 'br,gzip'),
+    min_size=int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)),
+)
@@ -1 +1,2 @@
-psql -U postgres -d postgres -f db_data.sql
\ No newline at end of file
+psql -U postgres -d postgres -f db_data.sql
+flask rebuild-stats
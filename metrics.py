@@ -0,0 +1,300 @@
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+## In-process metrics
+'''
+Counters and histograms of this worker process, rendered in the Prometheus text format
+by GET /metrics.  Recording a value is a bisect and a lock, so they stay on in production.
+Each worker keeps its own values, scrape every worker or aggregate per process.
+'''
+
+## Bucket bounds in seconds, fine enough to tell a cached token lookup from an RS256 verification
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_string(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name + _label_string(self.labels, label_values), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    ## Returns the (count, sum) of a series
+    def totals(self, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            return 0, 0.0
+        return sum(series[0]), series[1]
+
+    def samples(self):
+        with self._lock:
+            series = sorted((label_values, (list(counts), total))
+                            for label_values, (counts, total) in self._series.items())
+        names = self.labels + ('le',)
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (self.name + '_bucket' + _label_string(names, label_values + (_number(bound),)),
+                       cumulative)
+            yield self.name + '_sum' + _label_string(self.labels, label_values), total
+            yield self.name + '_count' + _label_string(self.labels, label_values), cumulative
+
+
+## A gauge read from a function when the metrics are rendered
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        yield self.name, self.function()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, function):
+        return self.add(Gauge(name, help, function))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('%s %s' % (sample, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Time from the start of a request to the end of its response.',
+    labels=('method', 'endpoint', 'status'))
+stage_seconds = registry.histogram(
+    'http_request_stage_seconds', 'Time spent in each stage of a request.',
+    labels=('endpoint', 'stage'))
+db_statements = registry.counter(
+    'db_statements_total', 'SQL statements executed.', labels=('endpoint',))
+slow_requests = registry.counter(
+    'http_slow_requests_total', 'Requests slower than PROFILE_SLOW_MS.', labels=('endpoint',))
+profiled_requests = registry.counter(
+    'http_profiled_requests_total', 'Slow requests whose profile was captured.', labels=('endpoint',))
+rejected_requests = registry.counter(
+    'http_rejected_requests_total', 'Requests rejected before their handler ran.', labels=('reason',))
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'none'
+
+
+## Records the time of a stage of the current request
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, _endpoint(), stage)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+## SQL statement timing, summed per request into the "db" stage.  A connection runs one
+## statement at a time, the start of a statement that raised is replaced by the next one
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_statement_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('metrics_statement_start', None)
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    if has_request_context():
+        g.metrics_db_seconds = g.get('metrics_db_seconds', 0.0) + seconds
+        g.metrics_db_statements = g.get('metrics_db_statements', 0) + 1
+    else:
+        stage_seconds.observe(seconds, 'none', 'db')
+        db_statements.inc('none')
+
+
+## Sampled profiler
+'''
+SlowRequestProfiler(sample_rate, slow_seconds, directory, logger)
+    runs a sampled fraction of the requests under cProfile and keeps the profile of the
+    ones slower than slow_seconds, as a .prof file in `directory` or as a summary in the log.
+    sample_rate=0 (the default) turns it off, requests that aren't sampled pay nothing.
+'''
+class SlowRequestProfiler:
+    def __init__(self, sample_rate=0.0, slow_seconds=0.5, directory=None, logger=None):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.directory = directory
+        self.logger = logger
+
+    def start(self):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            ## Another profiler is active in this process
+            return None
+        return profile
+
+    def finish(self, profile, seconds, endpoint):
+        profile.disable()
+        if seconds < self.slow_seconds:
+            return
+        profiled_requests.inc(endpoint)
+
+        if self.directory:
+            name = '%s-%d-%dms.prof' % (endpoint, time.time() * 1000, seconds * 1000)
+            profile.dump_stats(os.path.join(self.directory, name))
+        elif self.logger is not None:
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(25)
+            self.logger.warning('Slow request to %s took %.0fms\n%s',
+                                endpoint, seconds * 1000, output.getvalue())
+
+
+'''
+init_app(app)
+    times every request of the app and its SQL statements.  The profiler is configured with
+    PROFILE_SAMPLE_RATE (0 to 1), PROFILE_SLOW_MS (default 500) and PROFILE_DIR, read from the
+    app config first and from the environment otherwise
+'''
+def init_app(app):
+    def setting(name, default=None):
+        value = app.config.get(name, os.environ.get(name))
+        return default if value is None or value == '' else value
+
+    slow_seconds = float(setting('PROFILE_SLOW_MS', 500)) / 1000
+    profiler = SlowRequestProfiler(
+        sample_rate=float(setting('PROFILE_SAMPLE_RATE', 0)),
+        slow_seconds=slow_seconds,
+        directory=setting('PROFILE_DIR'),
+        logger=app.logger,
+    )
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_profile = profiler.start()
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    ## Runs once the response is sent, after the body of streamed responses
+    @app.teardown_request
+    def record_request(exception=None):
+        start = g.get('metrics_start')
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        endpoint = _endpoint()
+
+        request_seconds.observe(seconds, request.method, endpoint,
+                                g.get('metrics_status', 500 if exception else 200))
+        if 'metrics_db_seconds' in g:
+            stage_seconds.observe(g.metrics_db_seconds, endpoint, 'db')
+            db_statements.inc(endpoint, amount=g.metrics_db_statements)
+        if seconds >= slow_seconds:
+            slow_requests.inc(endpoint)
+        if g.get('metrics_profile') is not None:
+            profiler.finish(g.metrics_profile, seconds, endpoint)
+
+
+def metrics_response():
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,55 @@
+"""add search indexes
+
+Revision ID: 3f2d7c1e9a4b
+Revises: 6beb8b82b2e1
+Create Date: 2026-10-18 13:20:41.118032
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2d7c1e9a4b'
+down_revision = '6beb8b82b2e1'
+branch_labels = None
+depends_on = None
+
+# (table, column) searched by search.py
+SEARCHED_COLUMNS = [
+    ('actor', 'name'),
+    ('movie', 'title'),
+]
+
+
+# Postgres 12+ only, other databases are searched through the in-process index of search.py.
+# The words of the column are kept in a generated tsvector column so that matching rows
+# doesn't parse the text again
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    for table, column in SEARCHED_COLUMNS:
+        op.execute("ALTER TABLE %s ADD COLUMN search_vector tsvector "
+                   "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(%s, ''))) STORED" % (table, column))
+        op.execute('CREATE INDEX ix_%s_search_vector ON %s USING gin (search_vector)' % (table, table))
+
+    # Substring matching needs the pg_trgm extension, it is skipped where it isn't available
+    available = bind.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first()
+    if available is not None:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, column in SEARCHED_COLUMNS:
+            op.execute('CREATE INDEX ix_%s_%s_trgm ON %s USING gin (lower(%s) gin_trgm_ops)' % (table, column, table, column))
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    for table, column in SEARCHED_COLUMNS:
+        op.execute('DROP INDEX IF EXISTS ix_%s_%s_trgm' % (table, column))
+        op.execute('DROP INDEX IF EXISTS ix_%s_search_vector' % table)
+        op.execute('ALTER TABLE %s DROP COLUMN search_vector' % table)
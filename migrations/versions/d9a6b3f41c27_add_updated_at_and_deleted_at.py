@@ -0,0 +1,46 @@
+"""add updated_at and deleted_at
+
+Revision ID: d9a6b3f41c27
+Revises: 8c41e5d2b7f0
+Create Date: 2026-10-18 16:11:08.903215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9a6b3f41c27'
+down_revision = '8c41e5d2b7f0'
+branch_labels = None
+depends_on = None
+
+
+# Existing rows, and rows inserted with plain SQL like db_data.sql, get the current UTC time.
+# SQLite can't add a column with a non-constant default, the table is copied there instead
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        now = sa.text("timezone('utc', now())")
+    else:
+        now = sa.text('CURRENT_TIMESTAMP')
+    recreate = 'always' if bind.dialect.name == 'sqlite' else 'auto'
+
+    for table in ('actor', 'movie'):
+        with op.batch_alter_table(table, recreate=recreate) as batch_op:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), server_default=now, nullable=False))
+            batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+            batch_op.create_index('ix_%s_updated_at_id' % table, ['updated_at', 'id'], unique=False)
+
+
+def downgrade():
+    bind = op.get_bind()
+    recreate = 'always' if bind.dialect.name == 'sqlite' else 'auto'
+
+    for table in ('movie', 'actor'):
+        # The tombstones have no movie_cast rows left
+        op.execute(sa.text('DELETE FROM %s WHERE deleted_at IS NOT NULL' % table))
+        with op.batch_alter_table(table, recreate=recreate) as batch_op:
+            batch_op.drop_index('ix_%s_updated_at_id' % table)
+            batch_op.drop_column('deleted_at')
+            batch_op.drop_column('updated_at')
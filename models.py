@@ -1,48 +1,541 @@
 import os
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from datetime import date, datetime
+from sqlalchemy import Column, ForeignKey, String, bindparam, create_engine, event, extract, func, inspect, literal_column, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool, NullPool, StaticPool, SingletonThreadPool
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.orm import sessionmaker
+from flask_migrate import Migrate
 import json
 
 database_path = os.environ['DATABASE_URL']
 if database_path.startswith("postgres://"):
   database_path = database_path.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
+'''
+include_object(object, name, type_, reflected, compare_to)
+    leaves the postgres search columns and indexes of the add_search_indexes revision,
+    which aren't part of the models, out of `flask db migrate`
+'''
+def include_object(object, name, type_, reflected, compare_to):
+    if reflected and compare_to is None:
+        return not (name == 'search_vector' or name.endswith(('_search_vector', '_trgm')))
+    return True
+
+'''
+RoutingSession
+    sends the statements of a request to the read replica engine that replicas.py put in
+    flask.g.read_engine for it, and everything else, including any flush, to the primary
+    DATABASE_URL engine
+'''
+def read_engine():
+    return g.get('read_engine') if has_app_context() else None
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        engine = read_engine()
+        if engine is not None and not self._flushing:
+            return engine
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+migrate = Migrate(include_object=include_object)
+
+'''
+change_listeners
+    functions called as listener(table, ids) after rows of a table were written
+'''
+change_listeners = []
+
+def notify_change(table, ids=None):
+    for listener in change_listeners:
+        listener(table, ids)
+
+'''
+PoolMetrics
+    counts checkouts, checkins, new connections and checkout timeouts, and the time spent
+    waiting for a free connection, for the pools of this worker process
+'''
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        return {
+            'checkouts': self.checkouts,
+            'checkins': self.checkins,
+            'connects': self.connects,
+            'timeouts': self.timeouts,
+            'wait_seconds_total': round(self.wait_seconds_total, 6),
+            'wait_seconds_max': round(self.wait_seconds_max, 6),
+        }
+
+pool_metrics = PoolMetrics()
+
+'''
+InstrumentedQueuePool
+    QueuePool that records how long each checkout waited for a connection
+'''
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+@event.listens_for(InstrumentedQueuePool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics.increment('checkouts')
+
+@event.listens_for(InstrumentedQueuePool, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    pool_metrics.increment('checkins')
+
+@event.listens_for(InstrumentedQueuePool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    pool_metrics.increment('connects')
+
+POOL_CLASSES = {
+    'queue': InstrumentedQueuePool,
+    'null': NullPool,
+    'static': StaticPool,
+    'singleton': SingletonThreadPool,
+}
+
+'''
+engine_options(config, database_path)
+    builds SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings, read from the app config
+    (create_app(test_config)) first and from the environment otherwise:
+    DB_POOL_CLASS, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING and DB_STATEMENT_TIMEOUT (milliseconds, postgres only)
+'''
+def engine_options(config, database_path):
+    def setting(name, convert=int):
+        value = config.get(name, os.environ.get(name))
+        if value is None or value == '':
+            return None
+        if convert is bool and isinstance(value, str):
+            return value.lower() in ('1', 'true', 'yes')
+        return convert(value)
+
+    backend = make_url(database_path).get_backend_name()
+    options = {}
+
+    pool_class = setting('DB_POOL_CLASS', str)
+    if pool_class is None and backend != 'sqlite':
+        pool_class = 'queue'
+    if pool_class is not None:
+        options['poolclass'] = POOL_CLASSES[pool_class.lower()]
+
+    if options.get('poolclass') is InstrumentedQueuePool:
+        for name, option in (('DB_POOL_SIZE', 'pool_size'),
+                             ('DB_MAX_OVERFLOW', 'max_overflow'),
+                             ('DB_POOL_TIMEOUT', 'pool_timeout')):
+            value = setting(name)
+            if value is not None:
+                options[option] = value
+
+    pool_recycle = setting('DB_POOL_RECYCLE')
+    if pool_recycle is not None:
+        options['pool_recycle'] = pool_recycle
+
+    pool_pre_ping = setting('DB_POOL_PRE_PING', bool)
+    options['pool_pre_ping'] = True if pool_pre_ping is None else pool_pre_ping
+
+    statement_timeout = setting('DB_STATEMENT_TIMEOUT')
+    if statement_timeout is not None and backend == 'postgresql':
+        options['connect_args'] = {'options': '-c statement_timeout=%d' % statement_timeout}
+
+    return options
+
+'''
+pool_stats()
+    current state of the connection pool of this worker plus the checkout metrics
+'''
+def pool_stats():
+    pool = db.engine.pool
+    stats = {'pool_class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+    stats.update(pool_metrics.as_dict())
+    return stats
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    No connection is opened here, the schema is managed with `flask db upgrade`
 '''
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config, database_path))
     db.app = app
     db.init_app(app)
-    db.create_all()
+    migrate.init_app(app, db)
+
+
+'''
+bulk_insert(model, rows)
+    inserts all the rows in a single statement and transaction, returns the new ids in row order
+'''
+def bulk_insert(model, rows):
+    table = model.__table__
+    if db.engine.dialect.name == 'postgresql':
+        ## One multi-row INSERT ... RETURNING, postgres returns the ids in VALUES order
+        result = db.session.execute(table.insert().values(rows).returning(table.c.id))
+        ids = [row[0] for row in result]
+    else:
+        db.session.bulk_insert_mappings(model, rows, return_defaults=True)
+        ids = [row['id'] for row in rows]
+    deltas = {}
+    for row in rows:
+        add_stat_deltas(deltas, model, row, 1)
+    apply_stat_deltas(db.session.connection(), deltas)
+    db.session.commit()
+    notify_change(model.__tablename__, ids)
+    return ids
+
+'''
+bulk_update(model, rows)
+    updates the rows, each a dict with the id and the changed columns, with executemany in one transaction
+'''
+def bulk_update(model, rows):
+    deltas = {}
+    new_values = {row['id']: row for row in rows}
+    for old in locked_stat_values(db.session.connection(), model, list(new_values)):
+        add_stat_deltas(deltas, model, old, -1)
+        add_stat_deltas(deltas, model, dict(old, **new_values[old['id']]), 1)
+    apply_stat_deltas(db.session.connection(), deltas)
+    db.session.bulk_update_mappings(model, rows)
+    db.session.commit()
+    notify_change(model.__tablename__, [row['id'] for row in rows])
+
+'''
+bulk_delete(model, ids)
+    marks the rows with the given ids deleted and removes their movie_cast rows in one transaction
+'''
+def bulk_delete(model, ids):
+    deltas = {}
+    for old in locked_stat_values(db.session.connection(), model, ids):
+        add_stat_deltas(deltas, model, old, -1)
+    apply_stat_deltas(db.session.connection(), deltas)
+    db.session.execute(movie_cast.delete().where(cast_column(model).in_(ids)))
+    now = datetime.utcnow()
+    live(model).filter(model.id.in_(ids)) \
+        .update({'deleted_at': now, 'updated_at': now}, synchronize_session=False)
+    db.session.commit()
+    notify_change(model.__tablename__, ids)
+    notify_change(movie_cast.name)
+
+'''
+existing_ids(model, ids)
+    returns the subset of the ids that exist in the model table and aren't deleted
+'''
+def existing_ids(model, ids):
+    return {id for (id,) in live(model).with_entities(model.id).filter(model.id.in_(ids))}
+
+## Query of the rows of the model that aren't deleted
+def live(model):
+    return model.query.filter(model.deleted_at.is_(None))
+
+'''
+row_columns(model)
+    the columns of the model returned by the list, search and export endpoints, every
+    column but deleted_at, which is always NULL on the rows they return
+'''
+def row_columns(model):
+    return [column for column in model.__table__.columns if column.name != 'deleted_at']
+
+## Largest value of the Integer columns, larger ones are rejected by postgres
+MAX_INTEGER = 2 ** 31 - 1
+
+def _check_string(item, field, required, max_length=None):
+    value = item.get(field)
+    if value is None:
+        if required:
+            raise ValueError('%s is required' % field)
+        return None
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('%s must be a non-empty string' % field)
+    if max_length is not None and len(value) > max_length:
+        raise ValueError('%s must be at most %d characters' % (field, max_length))
+    return value
+
+def _check_fields(item, fields):
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+    unknown = set(item) - set(fields) - {'id'}
+    if unknown:
+        raise ValueError('unknown fields: %s' % ', '.join(sorted(unknown)))
+
+
+'''
+update_row(model, id, values, versions)
+    applies the column values to the row with the given id, unless it is deleted or its version
+    isn't one of `versions` when they are given.  On postgres this is a single UPDATE ... RETURNING
+    statement, which also returns the grouped columns as they were before for the stat_count
+    deltas.  Returns the updated row as a dict, or None if no row matched
+'''
+def update_row(model, id, values, versions=None):
+    table = model.__table__
+    conditions = [table.c.id == id, table.c.deleted_at.is_(None)]
+    if versions is not None:
+        conditions.append(table.c.version.in_(versions))
+    values = dict(values, updated_at=datetime.utcnow(), version=table.c.version + 1)
+    names = stat_columns(model)
+
+    if db.engine.dialect.name == 'postgresql':
+        ## The subquery locks the row, so the old values are those of the version being replaced
+        old = select([table.c.id] + [table.c[name] for name in names]) \
+            .where(*conditions).with_for_update().subquery('old')
+        statement = table.update().where(table.c.id == old.c.id).values(values) \
+            .returning(*table.columns, *[old.c[name].label('old_' + name) for name in names])
+        row = db.session.execute(statement).first()
+        if row is None:
+            db.session.rollback()
+            return None
+        row = dict(row._mapping)
+        old_values = {name: row.pop('old_' + name) for name in names}
+    else:
+        old = db.session.execute(select(table.columns).where(*conditions)).first()
+        if old is None or db.session.execute(table.update().where(*conditions).values(values)).rowcount == 0:
+            db.session.rollback()
+            return None
+        old_values = dict(old._mapping)
+        row = dict(old_values, **values)
+        row['version'] = old_values['version'] + 1
+
+    deltas = {}
+    add_stat_deltas(deltas, model, old_values, -1)
+    add_stat_deltas(deltas, model, row, 1)
+    apply_stat_deltas(db.session.connection(), deltas)
+    db.session.commit()
+    notify_change(model.__tablename__, [id])
+    return row
+
+'''
+get_row(model, id)
+    returns the row with the given id as a dict of its row_columns, or None if it doesn't exist
+    or is deleted.  The SELECT is built once per model with the id as a bound parameter, so
+    each lookup reuses the statement and its compiled SQL
+'''
+_row_statements = {}
+
+def get_row(model, id):
+    statement = _row_statements.get(model)
+    if statement is None:
+        statement = _row_statements[model] = select(row_columns(model)) \
+            .where(model.id == bindparam('id'), model.deleted_at.is_(None))
+    row = db.session.execute(statement, {'id': id}).first()
+    return dict(row._mapping) if row is not None else None
+
+'''
+movie_cast
+    many-to-many association of movies and the actors cast in them.  The primary key indexes
+    the actors of a movie, ix_movie_cast_actor_id_movie_id the movies of an actor
+'''
+movie_cast = db.Table(
+    'movie_cast',
+    Column('movie_id', db.Integer, ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', db.Integer, ForeignKey('actor.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_movie_cast_actor_id_movie_id', 'actor_id', 'movie_id'),
+)
+
+## The movie_cast column holding the ids of the model
+def cast_column(model):
+    return movie_cast.c.movie_id if model.__tablename__ == 'movie' else movie_cast.c.actor_id
+
+'''
+cast_query(model, other, other_id)
+    query of the model rows cast with the `other` row of id other_id,
+    e.g. cast_query(Actor, Movie, 1) for the actors of movie 1
+'''
+def cast_query(model, other, other_id):
+    return model.query \
+        .join(movie_cast, cast_column(model) == model.id) \
+        .filter(cast_column(other) == other_id)
+
+'''
+cast_dicts(model, ids)
+    the related rows of each of the model ids as dicts, e.g. the movies of each actor id, ordered
+    by id.  One query for the whole page, the same batching as selectinload but on column tuples
+'''
+def cast_dicts(model, ids):
+    other = Movie if model.__tablename__ == 'actor' else Actor
+    own_column = cast_column(model)
+    related = {id: [] for id in ids}
+    if not ids:
+        return related
+
+    columns = row_columns(other)
+    rows = db.session.query(own_column, *columns) \
+        .join(other, other.id == cast_column(other)) \
+        .filter(own_column.in_(ids)) \
+        .order_by(own_column, other.id)
+    names = [column.name for column in columns]
+    for row in rows:
+        related[row[0]].append(dict(zip(names, row[1:])))
+    return related
+
+'''
+add_cast(movie_id, actor_id), remove_cast(movie_id, actor_id)
+    link or unlink an actor and a movie, return False if there was nothing to change
+'''
+def add_cast(movie_id, actor_id):
+    exists = db.session.query(movie_cast).filter_by(movie_id=movie_id, actor_id=actor_id).first()
+    if exists is not None:
+        return False
+    try:
+        db.session.execute(movie_cast.insert().values(movie_id=movie_id, actor_id=actor_id))
+        db.session.commit()
+    except IntegrityError:
+        ## Linked by a concurrent request in the meantime
+        db.session.rollback()
+        return False
+    notify_change(movie_cast.name, [movie_id])
+    return True
+
+def remove_cast(movie_id, actor_id):
+    result = db.session.execute(movie_cast.delete().where(
+        (movie_cast.c.movie_id == movie_id) & (movie_cast.c.actor_id == actor_id)))
+    db.session.commit()
+    if result.rowcount == 0:
+        return False
+    notify_change(movie_cast.name, [movie_id])
+    return True
 
 
+## Every UPDATE of an actor or movie increments its version, checked by If-Match on PATCH
+NEXT_VERSION = literal_column('version') + 1
+
 '''
 Person
 Have title and release year
 '''
 class Actor(db.Model):  
   __tablename__ = 'actor'
+  __table_args__ = (
+      db.Index('ix_actor_gender_id', 'gender', 'id'),
+      db.Index('ix_actor_age_id', 'age', 'id'),
+      db.Index('ix_actor_updated_at_id', 'updated_at', 'id'),
+  )
 
   id = Column(db.Integer, primary_key=True)
   name = Column(db.String(120), nullable=False)
   gender = Column(db.String(120))
   age = Column(db.Integer)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+  deleted_at = Column(db.DateTime)
+  version = Column(db.Integer, nullable=False, default=1, onupdate=NEXT_VERSION)
+
+  ## The fields of the json objects written by the API
+  FIELDS = ('name', 'gender', 'age')
 
   def insert(self):
       db.session.add(self)
+      db.session.flush()
+      id = self.id
       db.session.commit()
+      notify_change(self.__tablename__, [id])
 
   def update(self):
+      id = self.id
       db.session.commit()
+      notify_change(self.__tablename__, [id])
 
+  ## The row is kept as a tombstone for GET /changes, its movie_cast rows are removed
   def delete(self):
-      db.session.delete(self)
+      id = self.id
+      self.mark_deleted()
       db.session.commit()
+      notify_change(self.__tablename__, [id])
+      notify_change(movie_cast.name)
+
+  ## Deletes the row like delete() in the current transaction, without committing it
+  def mark_deleted(self):
+      self.deleted_at = self.updated_at = datetime.utcnow()
+      db.session.execute(movie_cast.delete().where(cast_column(type(self)) == self.id))
+
+  '''
+  validate(item, partial)
+      checks a json object and returns the column values it sets, raises ValueError if it is invalid.
+      partial=True validates an update, where every field is optional
+  '''
+  @classmethod
+  def validate(cls, item, partial=False):
+      _check_fields(item, cls.FIELDS)
+      values = {}
+      if not partial or 'name' in item:
+          values['name'] = _check_string(item, 'name', required=True, max_length=cls.name.type.length)
+      if not partial or 'gender' in item:
+          values['gender'] = _check_string(item, 'gender', required=False, max_length=cls.gender.type.length)
+      if not partial or 'age' in item:
+          age = item.get('age')
+          if age is not None:
+              ## Only a JSON number without a fraction, so the stored age is the one sent
+              if isinstance(age, float) and age.is_integer():
+                  age = int(age)
+              if isinstance(age, bool) or not isinstance(age, int):
+                  raise ValueError('age must be an integer')
+              if age < 0:
+                  raise ValueError('age must not be negative')
+              if age > MAX_INTEGER:
+                  raise ValueError('age must be at most %d' % MAX_INTEGER)
+          values['age'] = age
+      return values
+
+  '''
+  filtered(gender, min_age, max_age)
+      returns the actor query narrowed down by the filters that are given
+  '''
+  @classmethod
+  def filtered(cls, gender=None, min_age=None, max_age=None):
+      query = live(cls)
+      if gender is not None:
+          query = query.filter(cls.gender == gender)
+      if min_age is not None:
+          query = query.filter(cls.age >= min_age)
+      if max_age is not None:
+          query = query.filter(cls.age <= max_age)
+      return query
 
   def format(self):
       return {
@@ -54,25 +547,288 @@ class Actor(db.Model):
 
 class Movie(db.Model):  
   __tablename__ = 'movie'
+  __table_args__ = (
+      db.Index('ix_movie_release_date_id', 'release_date', 'id'),
+      db.Index('ix_movie_updated_at_id', 'updated_at', 'id'),
+  )
 
   id = Column(db.Integer, primary_key=True)
   title = Column(db.String(120), nullable=False)
   release_date = Column(db.Date)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+  deleted_at = Column(db.DateTime)
+  version = Column(db.Integer, nullable=False, default=1, onupdate=NEXT_VERSION)
+
+  ## The fields of the json objects written by the API
+  FIELDS = ('title', 'release_date')
+  actors = db.relationship('Actor', secondary=movie_cast, order_by='Actor.id',
+                           backref=db.backref('movies', order_by='Movie.id'))
 
   def insert(self):
       db.session.add(self)
+      db.session.flush()
+      id = self.id
       db.session.commit()
+      notify_change(self.__tablename__, [id])
 
   def update(self):
+      id = self.id
       db.session.commit()
+      notify_change(self.__tablename__, [id])
 
+  ## The row is kept as a tombstone for GET /changes, its movie_cast rows are removed
   def delete(self):
-      db.session.delete(self)
+      id = self.id
+      self.mark_deleted()
       db.session.commit()
-      
+      notify_change(self.__tablename__, [id])
+      notify_change(movie_cast.name)
+
+  ## Deletes the row like delete() in the current transaction, without committing it
+  def mark_deleted(self):
+      self.deleted_at = self.updated_at = datetime.utcnow()
+      db.session.execute(movie_cast.delete().where(cast_column(type(self)) == self.id))
+
+  '''
+  validate(item, partial)
+      checks a json object and returns the column values it sets, raises ValueError if it is invalid.
+      partial=True validates an update, where every field is optional
+  '''
+  @classmethod
+  def validate(cls, item, partial=False):
+      _check_fields(item, cls.FIELDS)
+      values = {}
+      if not partial or 'title' in item:
+          values['title'] = _check_string(item, 'title', required=True, max_length=cls.title.type.length)
+      if not partial or 'release_date' in item:
+          release_date = item.get('release_date')
+          if release_date is not None:
+              try:
+                  release_date = date.fromisoformat(release_date)
+              except (TypeError, ValueError):
+                  raise ValueError('release_date must be a YYYY-MM-DD date')
+          values['release_date'] = release_date
+      return values
+
+  '''
+  filtered(released_after, released_before)
+      returns the movie query narrowed down to the release date range that is given
+  '''
+  @classmethod
+  def filtered(cls, released_after=None, released_before=None):
+      query = live(cls)
+      if released_after is not None:
+          query = query.filter(cls.release_date >= released_after)
+      if released_before is not None:
+          query = query.filter(cls.release_date <= released_before)
+      return query
+
   def format(self):
       return {
           'id': self.id,
           'title': self.title,
           'release_date': self.release_date
           }
+
+
+## Materialized statistics
+'''
+stat_count
+    the number of actors and movies in each group of the STATS groupings, e.g. the actors of
+    each gender.  Every write updates it in its own transaction, the flush of the insert,
+    update and delete methods and the bulk functions add their deltas, so that /stats reads
+    one row per group instead of scanning the tables.  value is the group as text, '' for NULL
+'''
+stat_count = db.Table(
+    'stat_count',
+    Column('stat', db.String(40), primary_key=True),
+    Column('value', db.String(120), primary_key=True),
+    Column('total', db.Integer, nullable=False),
+)
+
+'''
+outbox_position
+    the id of the last job of each write-behind outbox (see outbox.py) applied to the
+    database, written in the transaction of the jobs so that none is applied twice
+'''
+outbox_position = db.Table(
+    'outbox_position',
+    Column('outbox', db.String(64), primary_key=True),
+    Column('job_id', db.Integer, nullable=False),
+)
+
+'''
+outbox_result
+    the status and result of each job applied from a write-behind outbox, written in the
+    transaction of the job and kept until the queue has recorded them
+'''
+outbox_result = db.Table(
+    'outbox_result',
+    Column('outbox', db.String(64), primary_key=True),
+    Column('job_id', db.Integer, primary_key=True),
+    Column('status', db.String(16), nullable=False),
+    Column('result', db.Text, nullable=False),
+)
+
+## stat -> (model, column name) of the groupings counted in stat_count
+STATS = {
+    'actor_gender': (Actor, 'gender'),
+    'actor_age': (Actor, 'age'),
+    'movie_release_year': (Movie, 'release_date'),
+}
+
+## The columns a row of the model is grouped by, and deleted_at, as deleted rows aren't counted
+def stat_columns(model):
+    names = [column_name for stat_model, column_name in STATS.values() if stat_model is model]
+    return names + ['deleted_at'] if names else names
+
+## The group of a column value, as stored in stat_count.value
+def stat_group(stat, value):
+    if value is None:
+        return ''
+    if stat == 'movie_release_year':
+        if isinstance(value, str):
+            value = date.fromisoformat(value)
+        return str(value.year if isinstance(value, date) else int(value))
+    if stat == 'actor_age':
+        return str(int(value))
+    return str(value)
+
+## The group read back from stat_count.value
+def parse_stat_group(stat, value):
+    if value == '':
+        return None
+    if stat in ('actor_age', 'movie_release_year'):
+        return int(value)
+    return value
+
+'''
+add_stat_deltas(deltas, model, values, sign)
+    counts a row of the model, a mapping of its column values, into the deltas
+    {(stat, value): delta}, with sign 1 for a new row and -1 for a removed one
+'''
+def add_stat_deltas(deltas, model, values, sign):
+    if values.get('deleted_at') is not None:
+        return
+    for stat, (stat_model, column_name) in STATS.items():
+        if stat_model is model:
+            key = (stat, stat_group(stat, values[column_name]))
+            deltas[key] = deltas.get(key, 0) + sign
+
+'''
+locked_stat_values(connection, model, ids)
+    the id and grouped columns of the rows with the given ids, locked until the end of the
+    transaction (postgres), so that two concurrent writes of a row can't both count out
+    the same old values
+'''
+def locked_stat_values(connection, model, ids):
+    table = model.__table__
+    query = select([table.c.id] + [table.c[name] for name in stat_columns(model)]) \
+        .where(table.c.id.in_(ids)) \
+        .with_for_update()
+    return [dict(row) for row in connection.execute(query).mappings()]
+
+'''
+apply_stat_deltas(connection, deltas)
+    adds the deltas to stat_count with one upsert in the transaction of the connection.
+    The rows are written in key order so that concurrent writers lock them in the same order
+'''
+def apply_stat_deltas(connection, deltas):
+    rows = [{'stat': stat, 'value': value, 'total': delta}
+            for (stat, value), delta in sorted(deltas.items()) if delta != 0]
+    if not rows:
+        return
+
+    dialect = connection.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = insert(stat_count).values(rows)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[stat_count.c.stat, stat_count.c.value],
+            set_={'total': stat_count.c.total + statement.excluded.total}))
+        return
+
+    for row in rows:
+        result = connection.execute(stat_count.update()
+            .where((stat_count.c.stat == row['stat']) & (stat_count.c.value == row['value']))
+            .values(total=stat_count.c.total + row['total']))
+        if result.rowcount == 0:
+            connection.execute(stat_count.insert().values(row))
+
+## The values of the grouped columns of a model instance
+def _object_values(obj):
+    return {name: getattr(obj, name) for name in stat_columns(type(obj))}
+
+'''
+The flush of the insert, update and delete methods counts the rows it writes.  Updated and
+deleted rows are counted out with their values read under a row lock rather than with the
+values the instance was loaded with
+'''
+@event.listens_for(db.session, 'before_flush')
+def _count_flushed_rows(session, flush_context, instances):
+    deltas = {}
+    for obj in session.new:
+        if stat_columns(type(obj)):
+            add_stat_deltas(deltas, type(obj), _object_values(obj), 1)
+
+    changed = {}
+    for obj in list(session.dirty) + list(session.deleted):
+        names = stat_columns(type(obj))
+        if not names:
+            continue
+        state = inspect(obj)
+        if obj in session.deleted or \
+                any(state.attrs[name].history.has_changes() for name in names):
+            changed.setdefault(type(obj), {})[state.identity[0]] = obj
+
+    for model, objects in changed.items():
+        for old in locked_stat_values(session.connection(), model, list(objects)):
+            obj = objects[old['id']]
+            add_stat_deltas(deltas, model, old, -1)
+            if obj not in session.deleted:
+                add_stat_deltas(deltas, model, _object_values(obj), 1)
+
+    if deltas:
+        apply_stat_deltas(session.connection(), deltas)
+
+'''
+read_stats()
+    the counts of stat_count as {stat: {group: count}}, leaving out the empty groups
+'''
+def read_stats():
+    stats = {stat: {} for stat in STATS}
+    for stat, value, total in db.session.query(stat_count).filter(stat_count.c.total > 0):
+        if stat in stats:
+            stats[stat][parse_stat_group(stat, value)] = total
+    return stats
+
+'''
+count_stats()
+    the same counts as read_stats, computed with GROUP BY over the actor and movie tables
+'''
+def count_stats():
+    stats = {}
+    for stat, (model, column_name) in STATS.items():
+        column = getattr(model, column_name)
+        if stat == 'movie_release_year':
+            column = extract('year', column)
+        groups = stats[stat] = {}
+        query = db.session.query(column, func.count()).filter(model.deleted_at.is_(None))
+        for value, total in query.group_by(column):
+            group = parse_stat_group(stat, stat_group(stat, value))
+            groups[group] = groups.get(group, 0) + total
+    return stats
+
+'''
+rebuild_stats()
+    recounts stat_count from the tables, for rows written without the models, like the
+    INSERT statements of db_data.sql
+'''
+def rebuild_stats():
+    db.session.execute(stat_count.delete())
+    rows = [{'stat': stat, 'value': stat_group(stat, group), 'total': total}
+            for stat, groups in count_stats().items()
+            for group, total in groups.items()]
+    if rows:
+        db.session.execute(stat_count.insert(), rows)
+    db.session.commit()
@@ -0,0 +1,320 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, live, notify_change, movie_cast, outbox_position, outbox_result, Actor, Movie
+from serialization import dumps
+
+'''
+Write-behind outbox
+
+With OUTBOX_PATH set, POST, PATCH and DELETE of single actors and movies can skip the commit
+of the request: the mutation is validated, appended to a local SQLite queue and acknowledged
+with 202 and a job id, and a background flusher applies the queued jobs to the database in
+batched transactions.  OUTBOX_MODE=prefer (default) only does so for requests sending
+`Prefer: respond-async`, OUTBOX_MODE=always for every one.  GET /jobs/<id> reports the result.
+
+The queue is shared by the workers of the host.  One flusher at a time holds its lease and
+applies up to OUTBOX_BATCH_SIZE jobs per transaction, in job order, each in a savepoint so
+that a failing job (e.g. an update of a deleted row) doesn't undo the others.  The id of the
+last job applied is written to outbox_position and the outcome of each job to outbox_result
+in the same transaction, so a flusher that crashes after the commit doesn't apply its jobs
+twice, and the next one records the results they had.
+
+Jobs are durable in the queue once acknowledged, against process crashes with
+OUTBOX_SYNCHRONOUS=NORMAL (default), and against power loss with FULL, at the cost of an
+fsync of the queue per job.
+'''
+
+logger = logging.getLogger(__name__)
+
+MODELS = {model.__tablename__: model for model in (Actor, Movie)}
+
+
+'''
+JobError(status, message)
+    a job that can't be applied, reported like the error responses of the API
+'''
+class JobError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+
+## Applies one job in the current transaction and returns its result
+def apply_job(job):
+    model = MODELS[job['table']]
+    values = json.loads(job['payload']) if job['payload'] else None
+    try:
+        if job['operation'] == 'create':
+            row = model(**model.validate(values))
+            db.session.add(row)
+            db.session.flush()
+            return {'created': row.id}
+
+        row = live(model).filter(model.id == job['row_id']).with_for_update().one_or_none()
+        if row is None:
+            raise JobError(404, 'resource not found')
+        if job['operation'] == 'update':
+            versions = json.loads(job['versions']) if job['versions'] else None
+            if versions is not None and row.version not in versions:
+                raise JobError(412, 'precondition failed')
+            for name, value in model.validate(values, partial=True).items():
+                setattr(row, name, value)
+            db.session.flush()
+            return {'updated': row.id, 'version': row.version}
+
+        row.mark_deleted()
+        db.session.flush()
+        return {'deleted': row.id}
+    except ValueError as e:
+        raise JobError(422, str(e))
+
+
+class Outbox:
+    MODES = ('prefer', 'always')
+
+    def __init__(self, path=None, mode='prefer', batch_size=100, lease_seconds=10,
+                 poll_interval=0.05, synchronous='NORMAL'):
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._stop = False
+        ## Held across the lease and the batch, one flush at a time in the process
+        self._flush_lock = threading.Lock()
+        self.configure(path, mode)
+
+    def configure(self, path, mode='prefer'):
+        if mode not in self.MODES:
+            raise ValueError('OUTBOX_MODE must be one of %s' % ', '.join(self.MODES))
+        self.path = path or None
+        self.mode = mode
+        self._id = None
+        self._local = threading.local()
+
+    ## Takes OUTBOX_PATH and OUTBOX_MODE from the app config, stopping the flusher of the old queue
+    def init_app(self, app):
+        path = app.config.get('OUTBOX_PATH', os.environ.get('OUTBOX_PATH'))
+        mode = app.config.get('OUTBOX_MODE', os.environ.get('OUTBOX_MODE', 'prefer'))
+        if path != self.path or mode != self.mode:
+            self.stop()
+            self.configure(path, mode)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=%s' % self.synchronous)
+            connection.execute('CREATE TABLE IF NOT EXISTS job ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, operation TEXT, "table" TEXT, '
+                               'row_id INTEGER, payload TEXT, versions TEXT, sub TEXT, permission TEXT, '
+                               "status TEXT DEFAULT 'queued', result TEXT, queued_at REAL, finished_at REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_job_queued ON job (id) WHERE status = 'queued'")
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('outbox', uuid.uuid4().hex))
+            self._local.connection = connection
+        return connection
+
+    ## The identity of the queue in outbox_position, kept with the queue
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = self._connect().execute("SELECT value FROM meta WHERE name = 'outbox'").fetchone()[0]
+        return self._id
+
+    ## Appends a job and returns its id, values are the validated column values of the job.
+    ## An update with versions, those of If-Match, only applies to a row at one of them
+    def enqueue(self, operation, table, row_id, values, sub, permission, versions=None):
+        payload = dumps(values).decode('utf-8') if values is not None else None
+        versions = json.dumps(sorted(versions)) if versions is not None else None
+        cursor = self._connect().execute(
+            'INSERT INTO job (operation, "table", row_id, payload, versions, sub, permission, queued_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (operation, table, row_id, payload, versions, sub, permission, time.time()))
+        self._wake.set()
+        return cursor.lastrowid
+
+    ## Returns the job as a dict, None if there is no such job
+    def job(self, id):
+        row = self._connect().execute('SELECT * FROM job WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        for name in ('queued_at', 'finished_at'):
+            if job[name] is not None:
+                job[name] = datetime.utcfromtimestamp(job[name])
+        return job
+
+    def queued(self):
+        return self._connect().execute("SELECT count(*) FROM job WHERE status = 'queued'").fetchone()[0]
+
+    ## Flusher
+
+    @property
+    def owner(self):
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    ## Takes or renews the flusher lease, returns False while another process holds it
+    def acquire_lease(self):
+        connection = self._connect()
+        now = time.time()
+        row = connection.execute("SELECT value FROM meta WHERE name = 'lease'").fetchone()
+        if row is not None:
+            owner, expires = row[0].rsplit(' ', 1)
+            if owner != self.owner and float(expires) > now:
+                return False
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE name = 'lease'").fetchone()
+            if row is not None:
+                owner, expires = row[0].rsplit(' ', 1)
+                if owner != self.owner and float(expires) > now:
+                    connection.execute('ROLLBACK')
+                    return False
+            connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               ('lease', '%s %f' % (self.owner, now + self.lease_seconds)))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return True
+
+    ## Applies the jobs in one transaction, returns {job id: (status, result)}
+    def apply_jobs(self, jobs):
+        position_query = select([outbox_position.c.job_id]) \
+            .where(outbox_position.c.outbox == self.id).with_for_update()
+        position = db.session.execute(position_query).scalar()
+        if position is None:
+            db.session.execute(outbox_position.insert().values(outbox=self.id, job_id=0))
+            position = 0
+
+        ## The jobs before the batch have their results in the queue already
+        mine = outbox_result.c.outbox == self.id
+        db.session.execute(outbox_result.delete().where(mine & (outbox_result.c.job_id < jobs[0]['id'])))
+        ## Applied by a flusher that stopped before recording their results
+        applied = {}
+        if jobs[0]['id'] <= position:
+            query = select([outbox_result.c.job_id, outbox_result.c.status, outbox_result.c.result]) \
+                .where(mine & (outbox_result.c.job_id <= position))
+            applied = {row.job_id: (row.status, json.loads(row.result)) for row in db.session.execute(query)}
+
+        results = {}
+        written = {}
+        for job in jobs:
+            if job['id'] <= position:
+                results[job['id']] = applied[job['id']]
+                continue
+            try:
+                with db.session.begin_nested():
+                    results[job['id']] = ('done', apply_job(job))
+                written.setdefault(job['table'], set()).add(job['row_id'] or results[job['id']][1]['created'])
+                if job['operation'] == 'delete':
+                    written.setdefault(movie_cast.name, None)
+            except JobError as e:
+                results[job['id']] = ('failed', {'error': e.status, 'message': e.message})
+            except SQLAlchemyError as e:
+                ## Rolled back with its savepoint, a job the database rejects would otherwise fail every batch
+                logger.warning('outbox job %d rejected by the database: %s', job['id'], e)
+                results[job['id']] = ('failed', {'error': 422, 'message': 'the database rejected the job'})
+
+        outcomes = [{'outbox': self.id, 'job_id': id, 'status': status, 'result': json.dumps(result)}
+                    for id, (status, result) in results.items() if id > position]
+        if outcomes:
+            db.session.execute(outbox_result.insert(), outcomes)
+        db.session.execute(outbox_position.update()
+                           .where(outbox_position.c.outbox == self.id)
+                           .values(job_id=max(position, jobs[-1]['id'])))
+        db.session.commit()
+        for table, ids in written.items():
+            notify_change(table, sorted(ids) if ids is not None else None)
+        return results
+
+    ## Applies the next batch of queued jobs if this process holds the lease, returns the
+    ## number of jobs it took
+    def flush(self, app):
+        with self._flush_lock:
+            if not self.acquire_lease():
+                return 0
+            connection = self._connect()
+            jobs = [dict(row) for row in connection.execute(
+                "SELECT * FROM job WHERE status = 'queued' ORDER BY id LIMIT ?", (self.batch_size,))]
+            if not jobs:
+                return 0
+
+            with app.app_context():
+                try:
+                    results = self.apply_jobs(jobs)
+                finally:
+                    db.session.remove()
+
+            self.record_results(results)
+            return len(jobs)
+
+    ## Writes the status and result of the applied jobs to the queue
+    def record_results(self, results):
+        connection = self._connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        for id, (status, result) in results.items():
+            connection.execute("UPDATE job SET status = ?, result = ?, finished_at = ? WHERE id = ? AND status = 'queued'",
+                               (status, json.dumps(result), now, id))
+        connection.execute('COMMIT')
+
+    def _run(self, app):
+        while not self._stop and self.enabled:
+            applied = 0
+            try:
+                applied = self.flush(app)
+            except Exception:
+                logger.exception('outbox flush failed')
+            if not applied:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    ## Starts the flusher thread of this process unless it is running
+    def start(self, app):
+        if not self.enabled:
+            return
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        self._stop = False
+        self._thread_pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, args=(app,), name='outbox-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        thread = self._thread
+        self._stop = True
+        self._wake.set()
+        if thread is not None and thread.is_alive() and self._thread_pid == os.getpid():
+            thread.join(timeout=5)
+        self._thread = None
+
+
+outbox = Outbox(
+    os.environ.get('OUTBOX_PATH'),
+    mode=os.environ.get('OUTBOX_MODE', 'prefer'),
+    batch_size=int(os.environ.get('OUTBOX_BATCH_SIZE', 100)),
+    synchronous=os.environ.get('OUTBOX_SYNCHRONOUS', 'NORMAL'),
+)
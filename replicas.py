@@ -0,0 +1,104 @@
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import g
+from sqlalchemy import create_engine, event
+
+from cache import response_cache
+from models import engine_options
+
+'''
+Read replica routing
+
+With DATABASE_READ_URLS set (comma separated database URLs, of the same kind of database as
+DATABASE_URL), the GET routes decorated with router.reads(tables) read from one of the
+replicas, picked per request:
+- round_robin (default) takes them in turn
+- least_latency takes the one with the lowest moving average statement time, and every
+  PROBE_EVERY-th request the next one in turn so that the averages of the others stay current
+
+Writes always go to the primary, see models.RoutingSession.  Replicas lag behind it, so for
+DATABASE_READ_AFTER_WRITE seconds (default 2) after a write to a table its reads stay on the
+primary too.  That lets a client read its own writes, and keeps a lagging replica from
+filling the response cache with rows older than the table version they are cached under.
+The write marks live in the response cache backend: with RESPONSE_CACHE_URL shared between
+the workers, a write through one worker moves the reads of all of them to the primary.
+'''
+
+class ReplicaRouter:
+    STRATEGIES = ('round_robin', 'least_latency')
+    PROBE_EVERY = 20
+
+    def __init__(self, backend, strategy='round_robin', read_after_write=2):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('DATABASE_READ_STRATEGY must be one of %s' % ', '.join(self.STRATEGIES))
+        self.backend = backend
+        self.strategy = strategy
+        self.read_after_write = read_after_write
+        self.engines = []
+        self.latencies = {}
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    ## Creates the replica engines from DATABASE_READ_URLS of the app config or the environment
+    def init_app(self, app):
+        urls = app.config.get('DATABASE_READ_URLS', os.environ.get('DATABASE_READ_URLS', ''))
+        if isinstance(urls, str):
+            urls = [url.strip() for url in urls.split(',') if url.strip()]
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [create_engine(url, **engine_options(app.config, url)) for url in urls]
+        self.latencies = {engine: 0.0 for engine in self.engines}
+        for engine in self.engines:
+            self._track_latency(engine)
+
+    def _track_latency(self, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('replica_statement_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after(conn, cursor, statement, parameters, context, executemany):
+            seconds = time.perf_counter() - conn.info['replica_statement_start'].pop()
+            with self._lock:
+                self.latencies[engine] = self.latencies[engine] * 0.8 + seconds * 0.2
+
+    def pick(self):
+        turn = next(self._turns)
+        if self.strategy == 'least_latency' and turn % self.PROBE_EVERY:
+            with self._lock:
+                return min(self.engines, key=self.latencies.get)
+        return self.engines[turn % len(self.engines)]
+
+    ## Change listener marking the tables that were just written
+    def mark_written(self, table, ids=None):
+        if self.engines and self.read_after_write > 0:
+            self.backend.set('written:' + table, b'1', self.read_after_write)
+
+    def recently_written(self, tables):
+        return any(self.backend.get('written:' + table) is not None for table in tables)
+
+    ## Decorator of a GET route reading the given tables, placed below requires_auth
+    def reads(self, *tables):
+        def reads_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.engines and not self.recently_written(tables):
+                    g.read_engine = self.pick()
+                return f(*args, **kwargs)
+            return wrapper
+        return reads_decorator
+
+    def stats(self):
+        return [{'url': engine.url.render_as_string(hide_password=True),
+                 'latency_seconds': round(self.latencies[engine], 6)} for engine in self.engines]
+
+
+router = ReplicaRouter(
+    response_cache.backend,
+    strategy=os.environ.get('DATABASE_READ_STRATEGY', 'round_robin'),
+    read_after_write=float(os.environ.get('DATABASE_READ_AFTER_WRITE', 2)),
+)
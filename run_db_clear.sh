@@ -1,4 +1,5 @@
 dropdb -U postgres postgres
 createdb -U postgres postgres
 source setup.sh
+flask db upgrade
 flask run
\ No newline at end of file
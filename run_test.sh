@@ -1,4 +1,5 @@
 dropdb -U postgres postgres_test
 createdb -U postgres postgres_test
 source test_setup.sh
+flask db upgrade
 python test.py
\ No newline at end of file
@@ -0,0 +1,275 @@
+import bisect
+import heapq
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import func, literal_column, not_, or_, text
+
+from models import db, row_columns
+
+'''
+Search over actor names and movie titles
+
+On postgres the words of the column are matched by prefix against the GIN index of its
+generated search_vector column, to_tsvector('simple', column), and with the pg_trgm
+extension installed, substrings are matched through a trigram index as well (see the
+add_search_indexes migration).  Other databases, like the SQLite of test deployments, use
+a PrefixIndex of the column kept in memory by each worker process.
+
+Results are ranked: rows where every search term is a whole word first, then the rows
+where some terms are only word prefixes, each by id.
+'''
+
+WORD = re.compile(r'[^\W_]+')
+
+def words(value):
+    return WORD.findall(value.lower())
+
+
+## In-process word prefix index
+'''
+PrefixIndex
+    maps the lowercased words of each text to the ids containing them.  The words are kept
+    sorted, so the words starting with a term are a bisect range.  A search returns the ids
+    containing a word starting with every term, ranked
+'''
+class PrefixIndex:
+    def __init__(self):
+        self._words = []
+        self._postings = {}
+        self._texts = {}
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, id, value):
+        self.remove(id)
+        if value is None:
+            return
+        text_words = frozenset(words(value))
+        self._texts[id] = text_words
+        for word in text_words:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                bisect.insort(self._words, word)
+            postings.add(id)
+
+    def remove(self, id):
+        text_words = self._texts.pop(id, None)
+        if text_words is None:
+            return
+        for word in text_words:
+            postings = self._postings[word]
+            postings.discard(id)
+            if not postings:
+                del self._postings[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+
+    def _prefixed(self, term):
+        start = bisect.bisect_left(self._words, term)
+        ids = set()
+        for word in self._words[start:]:
+            if not word.startswith(term):
+                break
+            ids |= self._postings[word]
+        return ids
+
+    ## Returns the ranked ids matching every term of the query, only the first `count` if it is given
+    def search(self, query, count=None):
+        terms = set(words(query))
+        if not terms:
+            return []
+
+        matches = None
+        for term in sorted(terms, key=len, reverse=True):
+            ids = self._prefixed(term)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+
+        exact = matches
+        for term in terms:
+            exact = exact & self._postings.get(term, set())
+
+        ranked = []
+        for group in (exact, matches - exact):
+            if count is not None and count - len(ranked) < len(group):
+                ranked.extend(heapq.nsmallest(count - len(ranked), group))
+                break
+            ranked.extend(sorted(group))
+        return ranked
+
+
+'''
+ColumnSearchIndex(model, column_name, ttl)
+    PrefixIndex of a model column, loaded from the database on the first search.  Writes
+    through the models mark their ids, which are reloaded by the next search.  The index is
+    rebuilt after `ttl` seconds to pick up writes made by other worker processes.  A rebuild
+    loads the new index outside the lock and swaps it in, the other searches read the
+    previous one meanwhile
+'''
+class ColumnSearchIndex:
+    def __init__(self, model, column_name, ttl=60):
+        self.model = model
+        self.column_name = column_name
+        self.ttl = ttl
+        self._index = None
+        self._built_at = None
+        self._pending = set()
+        ## Counts the invalidations of the whole index, one during a rebuild makes it stale again
+        self._generation = 0
+        ## The ids reloaded into the previous index while a new one loads, None otherwise
+        self._loading = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def invalidate(self, ids=None):
+        with self._lock:
+            if ids is None:
+                self._built_at = None
+                self._generation += 1
+            else:
+                self._pending.update(ids)
+
+    def _rows(self, ids=None):
+        column = getattr(self.model, self.column_name)
+        query = db.session.query(self.model.id, column).filter(self.model.deleted_at.is_(None))
+        if ids is not None:
+            query = query.filter(self.model.id.in_(ids))
+        return query
+
+    def _stale(self):
+        return self._built_at is None or time.monotonic() - self._built_at >= self.ttl
+
+    ## Loads a new index and swaps it in.  Only the first load is waited for, while another
+    ## search rebuilds the index the others go on with the previous one
+    def _rebuild(self):
+        if not self._build_lock.acquire(blocking=self._index is None):
+            return
+        try:
+            with self._lock:
+                if not self._stale():
+                    return
+                generation = self._generation
+                started = time.monotonic()
+                self._loading = set()
+
+            index = PrefixIndex()
+            for id, value in self._rows().yield_per(10000):
+                index.add(id, value)
+
+            with self._lock:
+                ## The rows written while it loaded are reloaded into the new index as well
+                self._pending |= self._loading
+                self._loading = None
+                self._index = index
+                if generation == self._generation:
+                    self._built_at = started
+        finally:
+            with self._lock:
+                self._loading = None
+            self._build_lock.release()
+
+    ## Reloads the rows marked by invalidate(), needs self._lock
+    def _reload_pending(self):
+        if self._index is None or not self._pending:
+            return
+        ids = list(self._pending)
+        self._pending.clear()
+        if self._loading is not None:
+            self._loading.update(ids)
+        for id in ids:
+            self._index.remove(id)
+        for id, value in self._rows(ids):
+            self._index.add(id, value)
+
+    def search(self, query, count=None):
+        with self._lock:
+            stale = self._stale()
+        if stale:
+            self._rebuild()
+        with self._lock:
+            self._reload_pending()
+            return self._index.search(query, count)
+
+
+## Postgres search
+_trigram_available = {}
+
+## Whether pg_trgm is installed in the database, checked once per engine
+def has_trigram():
+    url = str(db.engine.url)
+    if url not in _trigram_available:
+        row = db.session.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first()
+        _trigram_available[url] = row is not None
+    return _trigram_available[url]
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+'''
+postgres_search(model, column, query, offset, limit)
+    reads the whole word matches, then the other matches, each ordered by id.  Selective
+    terms are looked up in the GIN indexes, rows matching broad ones are cheaper to find
+    while scanning the primary key, and the planner picks between the two
+'''
+def postgres_search(model, column, query, offset, limit):
+    terms = words(query)
+    vector = literal_column(model.__tablename__ + '.search_vector')
+    exact = vector.op('@@')(func.to_tsquery('simple', ' & '.join(terms)))
+    match = vector.op('@@')(func.to_tsquery('simple', ' & '.join(term + ':*' for term in terms)))
+    if has_trigram():
+        match = or_(match, func.lower(column).like('%' + _escape_like(query.lower()) + '%'))
+
+    def page(condition, offset, count):
+        return db.session.query(*row_columns(model)) \
+            .filter(condition, model.deleted_at.is_(None)) \
+            .order_by(model.id) \
+            .offset(offset).limit(count).all()
+
+    exact_rows = page(exact, 0, offset + limit + 1)
+    if len(exact_rows) > offset + limit:
+        return exact_rows[offset:]
+
+    ## Every whole word match is known, the page continues with the other matches
+    rows = exact_rows[offset:]
+    skip = max(0, offset - len(exact_rows))
+    return rows + page(match & not_(exact), skip, limit + 1 - len(rows))
+
+
+SEARCH_INDEX_TTL = int(os.environ.get('SEARCH_INDEX_TTL', 60))
+_indexes = {}
+
+## The in-process index of a model column
+def column_index(model, column_name):
+    key = (model.__tablename__, column_name)
+    if key not in _indexes:
+        _indexes[key] = ColumnSearchIndex(model, column_name, ttl=SEARCH_INDEX_TTL)
+    return _indexes[key]
+
+## Change listener marking the written rows of the indexed tables
+def invalidate(table, ids=None):
+    for (indexed_table, column_name), index in list(_indexes.items()):
+        if indexed_table == table:
+            index.invalidate(ids)
+
+'''
+search(model, column_name, query, offset, limit)
+    returns one page of the ranked matches of the query as column tuples, and the offset of
+    the next page (None on the last page)
+'''
+def search(model, column_name, query, offset, limit):
+    if db.engine.dialect.name == 'postgresql':
+        rows = postgres_search(model, getattr(model, column_name), query, offset, limit)
+    else:
+        ids = column_index(model, column_name).search(query, offset + limit + 1)[offset:]
+        found = {row.id: row for row in
+                 db.session.query(*row_columns(model))
+                     .filter(model.id.in_(ids), model.deleted_at.is_(None))}
+        rows = [found[id] for id in ids if id in found]
+
+    next_cursor = offset + limit if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,61 @@
+import json
+from datetime import date
+
+from flask import Response
+from flask.json import JSONEncoder
+
+try:
+    ## orjson is optional, it is used when it is installed
+    import orjson
+except ImportError:
+    orjson = None
+
+
+## JSON encoding
+'''
+dumps(value)
+    encodes a value as UTF-8 JSON bytes, with orjson when it is installed and with the
+    standard library json module otherwise.  Both write dates in ISO 8601 form (YYYY-MM-DD).
+'''
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+_encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False)
+
+def _dumps_json(value):
+    return _encoder.encode(value).encode('utf-8')
+
+def _dumps_orjson(value):
+    return orjson.dumps(value)
+
+if orjson is not None:
+    JSON_BACKEND = 'orjson'
+    dumps = _dumps_orjson
+else:
+    JSON_BACKEND = 'json'
+    dumps = _dumps_json
+
+
+def json_response(value, status=200):
+    return Response(dumps(value), status=status, mimetype='application/json')
+
+
+'''
+row_dicts(rows)
+    turns the column tuples of a query on model columns into dicts keyed by column name
+'''
+def row_dicts(rows):
+    if not rows:
+        return []
+    names = rows[0]._fields
+    return [dict(zip(names, row)) for row in rows]
+
+
+## jsonify encoder of the app, so that every response writes dates the same way
+class ISODateJSONEncoder(JSONEncoder):
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return JSONEncoder.default(self, o)
@@ -0,0 +1,92 @@
+import argparse
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+'''
+Production entry point
+
+Serves app.py with gunicorn, pre-forked worker processes that each warm up (see warmup.py)
+before they accept connections:
+
+    python serve.py --workers 4 --threads 8
+
+Every option falls back to an environment variable, then to a default:
+- --bind        BIND, or 0.0.0.0:$PORT (PORT defaults to 8000)
+- --workers     WEB_CONCURRENCY, 2 x CPUs + 1
+- --threads     SERVE_THREADS, 1.  More than one runs gthread workers
+- --keep-alive  SERVE_KEEPALIVE, 5 seconds an idle client connection is kept open by gthread
+                workers, sync workers close every connection after its response
+- --timeout     SERVE_TIMEOUT, 30 seconds before a stuck worker is restarted
+- --max-requests SERVE_MAX_REQUESTS, 0 (off), requests after which a worker is recycled,
+                with up to 10% jitter so that workers don't restart together
+- --no-preload  app.py is imported once in the master and shared by the forked workers,
+                unless SERVE_PRELOAD=false or --no-preload.  No connection is opened
+                before the fork
+'''
+
+
+def env(name, default, convert=str):
+    value = os.environ.get(name)
+    return default if value in (None, '') else convert(value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the casting API with gunicorn.')
+    parser.add_argument('--bind', default=env('BIND', '0.0.0.0:%s' % env('PORT', '8000')))
+    parser.add_argument('--workers', type=int,
+                        default=env('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1, int))
+    parser.add_argument('--threads', type=int, default=env('SERVE_THREADS', 1, int))
+    parser.add_argument('--keep-alive', type=int, default=env('SERVE_KEEPALIVE', 5, int))
+    parser.add_argument('--timeout', type=int, default=env('SERVE_TIMEOUT', 30, int))
+    parser.add_argument('--max-requests', type=int, default=env('SERVE_MAX_REQUESTS', 0, int))
+    parser.add_argument('--no-preload', action='store_true',
+                        default=env('SERVE_PRELOAD', 'true').lower() in ('0', 'false', 'no'))
+    parser.add_argument('--log-level', default=env('LOG_LEVEL', 'info'))
+    return parser.parse_args(argv)
+
+
+## Runs in each worker once it has loaded the app, before its first accept
+def post_worker_init(worker):
+    from warmup import timings, warm_up
+    ready = warm_up(worker.wsgi)
+    worker.log.info('Worker %s warmed up (ready: %s) %s', worker.pid, ready, timings)
+
+
+def gunicorn_options(args):
+    return {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'keepalive': args.keep_alive,
+        'timeout': args.timeout,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'preload_app': not args.no_preload,
+        'loglevel': args.log_level,
+        'post_worker_init': post_worker_init,
+    }
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def main(argv=None):
+    Server(gunicorn_options(parse_args(argv))).run()
+
+
+if __name__ == '__main__':
+    main()
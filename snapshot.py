@@ -0,0 +1,298 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from array import array
+from datetime import date, datetime, timedelta
+
+from cache import response_cache
+from models import db, parse_stat_group, row_columns, stat_group, STATS, Actor, Movie
+
+'''
+Catalog snapshot
+
+With CATALOG_SNAPSHOT=true each worker process keeps the live actors and movies in memory as
+columns: one array of ids, sorted, and one array per column, with integers, dates (as day
+ordinals) and timestamps (as microseconds since the epoch) in typed `array` buffers and the
+strings interned, so repeated values like the genders are stored once.  GET /actors,
+GET /movies (without embed) and /stats are answered from it, without a query or model
+instances.
+
+The snapshot of a table is loaded on its first read, or by the warmup.  Writes through the
+models mark the ids they write, which the next read reloads, so a write costs one query by
+id rather than a reload of the table.  Every write also bumps the version of its table in
+the response cache: when the version has moved further than the writes of this worker
+account for, another worker sharing RESPONSE_CACHE_URL wrote the table and it is reloaded
+before it is read, so pages cached under the new version are never built from older rows.
+Without a shared response cache, writes made by other worker processes are picked up when
+the table is reloaded, every CATALOG_SNAPSHOT_TTL seconds (default 60).
+'''
+
+EPOCH = datetime(1970, 1, 1)
+
+'''
+Column storage of each column type: array typecode (None for a list of interned strings),
+the stored value of NULL, and the conversions of a value to and from the stored value
+'''
+INT = ('i', -2 ** 31, int, int)
+DATE = ('i', 0, date.toordinal, date.fromordinal)
+DATETIME = ('q', -2 ** 63,
+            lambda value: (value - EPOCH) // timedelta(microseconds=1),
+            lambda value: EPOCH + timedelta(microseconds=value))
+STRING = (None, None, sys.intern, str)
+
+def column_storage(column):
+    if isinstance(column.type, db.DateTime):
+        return DATETIME
+    if isinstance(column.type, db.Date):
+        return DATE
+    if isinstance(column.type, db.Integer):
+        return INT
+    return STRING
+
+
+'''
+ColumnarTable(model, ttl)
+    the live rows of a model as columns, ordered by id.  page() and read_stats() read it, the
+    rows marked by invalidate() are reloaded before the next read, and the whole table when
+    its response cache version moved past the invalidations of this worker
+'''
+class ColumnarTable:
+    ## Filters of Model.filtered, as (column name, comparison)
+    FILTERS = {
+        'gender': ('gender', 'eq'),
+        'min_age': ('age', 'ge'),
+        'max_age': ('age', 'le'),
+        'released_after': ('release_date', 'ge'),
+        'released_before': ('release_date', 'le'),
+    }
+
+    def __init__(self, model, ttl=60):
+        self.model = model
+        self.ttl = ttl
+        self.names = [column.name for column in row_columns(model) if column.name != 'id']
+        self.storage = {column.name: column_storage(column)
+                        for column in row_columns(model) if column.name != 'id'}
+        self.stats = {stat: column_name for stat, (stat_model, column_name) in STATS.items()
+                      if stat_model is model}
+        self._built_at = None
+        self._pending = set()
+        ## Response cache version of the table the snapshot has caught up with, and the
+        ## invalidations of this worker since, each of which bumped the version once
+        self._version = None
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.ids = array('q')
+        self.columns = {name: array(typecode) if typecode else []
+                        for name, (typecode, _, _, _) in self.storage.items()}
+        self.counts = {stat: {} for stat in self.stats}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def invalidate(self, ids=None):
+        with self._lock:
+            self._invalidations += 1
+            if ids is None:
+                self._built_at = None
+            else:
+                self._pending.update(ids)
+
+    def _rows(self, ids=None):
+        query = db.session.query(*row_columns(self.model)) \
+            .filter(self.model.deleted_at.is_(None)) \
+            .order_by(self.model.id)
+        if ids is not None:
+            query = query.filter(self.model.id.in_(ids))
+        return query
+
+    def _encode(self, name, value):
+        typecode, null, encode, _ = self.storage[name]
+        return null if value is None else encode(value)
+
+    def _count(self, row, sign):
+        for stat, column_name in self.stats.items():
+            group = parse_stat_group(stat, stat_group(stat, row[column_name]))
+            counts = self.counts[stat]
+            counts[group] = counts.get(group, 0) + sign
+            if not counts[group]:
+                del counts[group]
+
+    ## Adds or replaces a row, a mapping of its row_columns
+    def _put(self, row):
+        position = bisect.bisect_left(self.ids, row['id'])
+        if position < len(self.ids) and self.ids[position] == row['id']:
+            self._count(self._row(position), -1)
+            for name in self.names:
+                self.columns[name][position] = self._encode(name, row[name])
+        else:
+            self.ids.insert(position, row['id'])
+            for name in self.names:
+                self.columns[name].insert(position, self._encode(name, row[name]))
+        self._count(row, 1)
+
+    def _remove(self, id):
+        position = bisect.bisect_left(self.ids, id)
+        if position < len(self.ids) and self.ids[position] == id:
+            self._count(self._row(position), -1)
+            del self.ids[position]
+            for name in self.names:
+                del self.columns[name][position]
+
+    def _row(self, position):
+        row = {'id': self.ids[position]}
+        for name in self.names:
+            _, null, _, decode = self.storage[name]
+            value = self.columns[name][position]
+            row[name] = None if value == null else decode(value)
+        return row
+
+    def _refresh(self):
+        version = response_cache.version(self.model.__tablename__)
+        if self._version is not None and version > self._version + self._invalidations:
+            ## Written by another worker
+            self._built_at = None
+
+        if self._built_at is None or time.monotonic() - self._built_at >= self.ttl:
+            self._version, self._invalidations = version, 0
+            self._clear()
+            for row in self._rows().yield_per(10000):
+                row = row._mapping
+                self.ids.append(row['id'])
+                for name in self.names:
+                    self.columns[name].append(self._encode(name, row[name]))
+                self._count(row, 1)
+            self._built_at = time.monotonic()
+            self._pending.clear()
+        elif self._pending:
+            self._version, self._invalidations = version, 0
+            ids = sorted(self._pending)
+            self._pending.clear()
+            found = set()
+            for row in self._rows(ids):
+                found.add(row.id)
+                self._put(row._mapping)
+            for id in ids:
+                if id not in found:
+                    self._remove(id)
+
+    def load(self):
+        with self._lock:
+            self._refresh()
+
+    ## The filters as {column name: {comparison: stored value}}
+    def _bounds(self, filters):
+        bounds = {}
+        for name, value in filters.items():
+            if value is not None:
+                column_name, comparison = self.FILTERS[name]
+                bounds.setdefault(column_name, {})[comparison] = self._encode(column_name, value)
+        return bounds
+
+    ## The positions matching the bounds, one pass over the positions left per column
+    def _select(self, positions, bounds):
+        for column_name, bound in bounds.items():
+            column = self.columns[column_name]
+            if 'eq' in bound:
+                value = bound['eq']
+                positions = [position for position in positions if column[position] == value]
+            if 'ge' in bound or 'le' in bound:
+                ## NULL is stored as the lowest value of the array, so it is below any lower bound
+                low = bound.get('ge', self.storage[column_name][1] + 1)
+                high = bound.get('le', 2 ** 63)
+                positions = [position for position in positions if low <= column[position] <= high]
+        return positions
+
+    '''
+    page(limit, cursor, **filters)
+        the rows after the cursor id matching the filters of Model.filtered, like paginate in
+        app.py: at most `limit` row dicts and the cursor of the next page (None on the last page)
+    '''
+    def page(self, limit, cursor=None, **filters):
+        with self._lock:
+            self._refresh()
+            start = bisect.bisect_right(self.ids, cursor) if cursor is not None else 0
+            bounds = self._bounds(filters)
+            if not bounds:
+                positions = range(start, min(start + limit + 1, len(self.ids)))
+            else:
+                ## Filters the rows after the cursor in chunks, doubling until the page is full
+                positions = []
+                chunk = max(4 * (limit + 1), 256)
+                while start < len(self.ids) and len(positions) <= limit:
+                    end = min(start + chunk, len(self.ids))
+                    positions += self._select(range(start, end), bounds)
+                    start, chunk = end, chunk * 2
+                positions = positions[:limit + 1]
+            rows = [self._row(position) for position in positions]
+
+        next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+    ## The counts of the stats of the table, as read_stats() returns them
+    def read_stats(self):
+        with self._lock:
+            self._refresh()
+            return {stat: dict(counts) for stat, counts in self.counts.items()}
+
+    ## Bytes held by the arrays and lists of the columns, not counting the strings they refer to
+    def memory_bytes(self):
+        total = sys.getsizeof(self.ids)
+        for column in self.columns.values():
+            total += sys.getsizeof(column)
+        return total
+
+
+class CatalogSnapshot:
+    def __init__(self, enabled=False, ttl=60):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.tables = {}
+        self._reset()
+
+    def _reset(self):
+        self.tables = {model.__tablename__: ColumnarTable(model, self.ttl) for model in (Actor, Movie)}
+
+    ## Takes CATALOG_SNAPSHOT and CATALOG_SNAPSHOT_TTL from the app config, dropping the loaded snapshot
+    def init_app(self, app):
+        enabled = app.config.get('CATALOG_SNAPSHOT', os.environ.get('CATALOG_SNAPSHOT', 'false'))
+        if isinstance(enabled, str):
+            enabled = enabled.lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.ttl = float(app.config.get('CATALOG_SNAPSHOT_TTL', os.environ.get('CATALOG_SNAPSHOT_TTL', 60)))
+        self._reset()
+
+    def table(self, model):
+        return self.tables[model.__tablename__]
+
+    ## Change listener marking the written rows of the actor and movie tables
+    def invalidate(self, table, ids=None):
+        if table in self.tables:
+            self.tables[table].invalidate(ids)
+
+    ## Loads every table, a warmup step
+    def load(self):
+        if self.enabled:
+            for table in self.tables.values():
+                table.load()
+
+    ## The counts of every stat, as read_stats() returns them
+    def read_stats(self):
+        stats = {}
+        for table in self.tables.values():
+            stats.update(table.read_stats())
+        return stats
+
+    def info(self):
+        return {name: {'rows': len(table), 'memory_bytes': table.memory_bytes()}
+                for name, table in self.tables.items()} if self.enabled else None
+
+
+catalog = CatalogSnapshot(
+    os.environ.get('CATALOG_SNAPSHOT', 'false').lower() in ('1', 'true', 'yes'),
+    ttl=float(os.environ.get('CATALOG_SNAPSHOT_TTL', 60)),
+)
@@ -1,10 +1,34 @@
 import os
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import tempfile
+import time
+import gzip
+import threading
+from unittest import mock
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+from sqlalchemy import create_engine
 
 from app import create_app
-from models import setup_db, Actor, Movie
+from models import db, engine_options, read_stats, count_stats, live, row_columns, Actor, Movie
+from auth.jwks import JWKSCache
+from auth.keys import issuer_from_config
+from auth.token_cache import TokenCache
+from auth.rate_limit import AdmissionControl, MemoryStore, RateLimiter, SQLiteStore
+from auth import auth as auth_module
+from cache import MemoryBackend, SQLiteBackend, response_cache
+from metrics import Histogram, stage_seconds, db_statements
+import serialization
+import warmup
+from replicas import router
+from outbox import outbox
+from snapshot import catalog
+from compression import compression
+from search import ColumnSearchIndex, PrefixIndex
+from serialization import row_dicts
+from datetime import date
 #from dotenv import load_dotenv
 
 class CastingTestCase(unittest.TestCase):
@@ -28,15 +52,8 @@ class CastingTestCase(unittest.TestCase):
         self.jwt_exec_prod = jwt_exec_prod
         self.jwt_cast_dir = jwt_cast_dir
         self.jwt_cast_asst = jwt_cast_asst
-        
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+
+        # The schema is created once by `flask db upgrade` in run_test.sh
         
 
         # Seed the database
@@ -83,9 +100,233 @@ class CastingTestCase(unittest.TestCase):
     def tearDown(self):
         """Executed after reach test"""
         pass
+
+    # A token with only the given permissions, from a service issuer added for the test
+    def limited_token(self, permissions):
+        os.environ['TEST_SERVICE_SECRET'] = 'service-secret'
+        issuer = issuer_from_config({'issuer': 'test-service', 'secret_env': 'TEST_SERVICE_SECRET'}, auth_module.API_AUDIENCE)
+        auth_module.issuers = dict(auth_module.issuers, **{'test-service': issuer})
+        self.addCleanup(auth_module.issuers.pop, 'test-service', None)
+        claims = {'iss': 'test-service', 'aud': auth_module.API_AUDIENCE, 'sub': 'service|test',
+                  'exp': int(time.time()) + 600, 'permissions': permissions}
+        return jwt.encode(claims, 'service-secret', algorithm='HS256')
     
     
 
+    #---------------------
+    #/health Endpoint
+    #---------------------
+    # Success - pool metrics are reported
+    def test_health(self):
+        res = self.client().get('/health')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertIn("checkouts", data["pool"])
+
+    # GET routes read from the replica, except for the tables written moments ago
+    def test_read_replica(self):
+        replica_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        replica_file.close()
+        actor_id = self.actor1.id
+        replica = create_engine('sqlite:///' + replica_file.name)
+        db.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Actor.__table__.insert(), {"id": actor_id, "name": "Replica name", "version": 1})
+        replica.dispose()
+
+        app = create_app({'DATABASE_READ_URLS': 'sqlite:///' + replica_file.name})
+        try:
+            headers = dict(Authorization='bearer ' + self.jwt_cast_dir)
+            res = app.test_client().get('/actors/%d' % actor_id,headers=headers)
+            self.assertEqual(json.loads(res.data)["actor"]["name"], "Replica name")
+
+            app.test_client().patch('/actors/%d' % actor_id,json={"age": 57},headers=headers)
+            res = app.test_client().get('/actors/%d' % actor_id,headers=headers)
+            self.assertEqual(json.loads(res.data)["actor"]["name"], "Actor name 1")
+        finally:
+            router.init_app(self.app)
+            os.remove(replica_file.name)
+
+    # Mutations preferring async are queued, acknowledged with 202 and applied by the flusher
+    def test_write_behind(self):
+        outbox_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        outbox_file.close()
+        actor_id, other_actor_id, other_version = self.actor2.id, self.actor1.id, self.actor1.version
+        app = create_app({'OUTBOX_PATH': outbox_file.name})
+        # The test flushes the queue itself, without the background flusher
+        start = mock.patch.object(outbox, 'start')
+        start.start()
+        self.addCleanup(start.stop)
+        try:
+            headers = dict(Authorization='bearer ' + self.jwt_exec_prod, Prefer='respond-async')
+            res = app.test_client().post('/actors',json=self.new_actor1,headers=headers)
+            data = json.loads(res.data)
+            job_id = data["job"]
+
+            self.assertEqual(res.status_code, 202)
+            self.assertTrue(res.headers["Location"].endswith("/jobs/%d" % job_id))
+
+            res = app.test_client().patch('/actors/%d' % actor_id,json={"age": 37},headers=headers)
+            update_job_id = json.loads(res.data)["job"]
+            self.client().delete('/actors/%d' % actor_id,headers=dict(Authorization='bearer ' + self.jwt_exec_prod))
+            res = app.test_client().post('/actors',json=self.bad_actor,headers=headers)
+            self.assertEqual(res.status_code, 422)
+
+            # The synchronous and the queued create refuse the same bodies
+            for prefer in ('respond-async', ''):
+                res = app.test_client().post('/actors',json={"name": "Typed", "age": "40"},headers=dict(headers, Prefer=prefer))
+                self.assertEqual((res.status_code, json.loads(res.data)["message"]), (422, "age must be an integer"))
+
+            outbox.flush(app)
+            res = app.test_client().get('/jobs/%d' % job_id,headers=headers)
+            data = json.loads(res.data)
+            self.assertEqual(data["job"]["status"], "done")
+            self.assertEqual(Actor.query.get(data["job"]["result"]["created"]).name, "Liam Neeson")
+
+            res = app.test_client().get('/jobs/%d' % update_job_id,headers=headers)
+            data = json.loads(res.data)
+            self.assertEqual(data["job"]["status"], "failed")
+            self.assertEqual(data["job"]["result"]["error"], 404)
+
+            res = app.test_client().get('/jobs/%d' % job_id,headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+            self.assertEqual(res.status_code, 404)
+
+            # Queued updates keep their If-Match versions
+            res = app.test_client().patch('/actors/%d' % other_actor_id,json={"age": 40},
+                                          headers=dict(headers, **{"If-Match": '"%d"' % (other_version + 1)}))
+            stale_id = json.loads(res.data)["job"]
+            res = app.test_client().patch('/actors/%d' % other_actor_id,json={"age": 41},
+                                          headers=dict(headers, **{"If-Match": '"%d"' % other_version}))
+            current_id = json.loads(res.data)["job"]
+            outbox.flush(app)
+            self.assertEqual((outbox.job(stale_id)["status"], outbox.job(stale_id)["result"]["error"]), ("failed", 412))
+            self.assertEqual(outbox.job(current_id)["result"]["version"], other_version + 1)
+
+            # A job the database rejects fails on its own, the jobs after it are applied
+            res = app.test_client().post('/actors',json={"name": "Big", "age": 10 ** 12},headers=headers)
+            self.assertEqual(res.status_code, 422)
+            rejected_id = outbox.enqueue('create', 'actor', None, {"name": "Big", "age": 10 ** 12}, 'auth0|exec', 'post:actors')
+            valid_id = outbox.enqueue('create', 'actor', None, self.new_actor2, 'auth0|exec', 'post:actors')
+            with mock.patch.object(Actor, 'validate', classmethod(lambda cls, item, partial=False: item)):
+                outbox.flush(app)
+            self.assertEqual((outbox.job(rejected_id)["status"], outbox.job(rejected_id)["result"]["error"]), ("failed", 422))
+            self.assertEqual(outbox.job(valid_id)["status"], "done")
+        finally:
+            outbox.init_app(self.app)
+            os.remove(outbox_file.name)
+
+    # A flusher stopping between the commit and the queue update leaves the jobs their real results
+    def test_write_behind_crash(self):
+        outbox_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        outbox_file.close()
+        actor_id = self.actor2.id
+        app = create_app({'OUTBOX_PATH': outbox_file.name})
+        start = mock.patch.object(outbox, 'start')
+        start.start()
+        self.addCleanup(start.stop)
+        try:
+            headers = dict(Authorization='bearer ' + self.jwt_exec_prod, Prefer='respond-async')
+            created_id = json.loads(app.test_client().post('/actors',json=self.new_actor1,headers=headers).data)["job"]
+            failed_id = json.loads(app.test_client().patch('/actors/%d' % actor_id,json={"age": 37},
+                                   headers=dict(headers, **{"If-Match": '"999"'})).data)["job"]
+            actors = Actor.query.filter_by(name=self.new_actor1["name"]).count()
+
+            with mock.patch.object(outbox, 'record_results', side_effect=RuntimeError('crashed')):
+                with self.assertRaises(RuntimeError):
+                    outbox.flush(app)
+            self.assertEqual(outbox.job(created_id)["status"], "queued")
+
+            self.assertEqual(outbox.flush(app), 2)
+            created = outbox.job(created_id)
+            self.assertEqual(created["status"], "done")
+            self.assertEqual(Actor.query.get(created["result"]["created"]).name, self.new_actor1["name"])
+            self.assertEqual(Actor.query.filter_by(name=self.new_actor1["name"]).count(), actors + 1)
+            self.assertEqual((outbox.job(failed_id)["status"], outbox.job(failed_id)["result"]["error"]), ("failed", 412))
+        finally:
+            outbox.init_app(self.app)
+            os.remove(outbox_file.name)
+
+    # The catalog snapshot answers the list routes and /stats like the database and follows writes
+    def test_catalog_snapshot(self):
+        headers = dict(Authorization='bearer ' + self.jwt_exec_prod)
+        actor_id, movie_id = self.actor1.id, self.movie2.id
+        app = create_app({'CATALOG_SNAPSHOT': True})
+        try:
+            rows, _ = catalog.table(Actor).page(1000, min_age=40)
+            expected = Actor.filtered(min_age=40).with_entities(*row_columns(Actor)) \
+                .order_by(Actor.id).limit(1000).all()
+            self.assertEqual(rows, row_dicts(expected))
+
+            app.test_client().patch('/actors/%d' % actor_id,json={"gender": "Female", "age": 19},headers=headers)
+            res = app.test_client().get('/actors?gender=Female&max_age=20&limit=1000',headers=headers)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn(actor_id, [actor["id"] for actor in data["actors"]])
+
+            app.test_client().delete('/movies/%d' % movie_id,headers=headers)
+            res = app.test_client().get('/movies?released_after=1980-01-01&limit=1000',headers=headers)
+            self.assertNotIn(movie_id, [movie["id"] for movie in json.loads(res.data)["movies"]])
+
+            self.assertEqual(catalog.read_stats(), count_stats())
+
+            # A write of another worker sharing the response cache reloads the table
+            Actor.query.filter(Actor.id == actor_id).update({"name": "Written elsewhere"})
+            db.session.commit()
+            response_cache.invalidate('actor')
+            rows, _ = catalog.table(Actor).page(1, actor_id - 1)
+            self.assertEqual(rows[0]["name"], "Written elsewhere")
+        finally:
+            catalog.init_app(self.app)
+
+    # The worker is ready once its warmup ran
+    def test_ready(self):
+        self.assertTrue(warmup.warm_up(self.app))
+        res = self.client().get('/ready')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["ready"], True)
+        self.assertIn("queries", data["warmup"])
+
+    # The auth, DB and serialization stages of a request are timed on /metrics
+    def test_metrics(self):
+        self.client().get('/actors', headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith("text/plain"))
+        for stage in ("auth.verify", "auth.permissions", "db", "serialize"):
+            self.assertGreater(stage_seconds.totals("get_actors", stage)[0], 0)
+        self.assertIn('http_request_duration_seconds_count{method="GET",endpoint="get_actors",status="200"}', text)
+        self.assertIn("db_pool_checkouts ", text)
+        self.assertIn("token_cache_hits ", text)
+
+    # Sampled slow requests are profiled into PROFILE_DIR
+    def test_slow_request_profile(self):
+        profile_dir = tempfile.mkdtemp()
+        app = create_app({"PROFILE_SAMPLE_RATE": 1, "PROFILE_SLOW_MS": 0, "PROFILE_DIR": profile_dir})
+        res = app.test_client().get('/health')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(os.listdir(profile_dir)), 1)
+
+    # Pool settings from the app config are turned into engine options
+    def test_engine_options(self):
+        options = engine_options({
+            "DB_POOL_SIZE": "5",
+            "DB_MAX_OVERFLOW": 2,
+            "DB_POOL_PRE_PING": "false",
+            "DB_STATEMENT_TIMEOUT": 3000
+        }, self.database_path)
+
+        self.assertEqual(options["pool_size"], 5)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertEqual(options["pool_pre_ping"], False)
+        self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=3000"})
+
     #---------------------
     #/actors Endpoint
     #---------------------
@@ -131,7 +372,7 @@ class CastingTestCase(unittest.TestCase):
         
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data["success"], False)
-        self.assertEqual(data["message"], "unprocessable")
+        self.assertEqual(data["message"], "name is required")
 
     # Error 403 unauthorized (Role: Casting Assistant)
     def test_auth_error_post_actor(self):
@@ -140,6 +381,58 @@ class CastingTestCase(unittest.TestCase):
         
         self.assertEqual(res.status_code, 403)
 
+    # ---- BULK ------
+    # Success (Role: Casting Director)
+    def test_bulk_create_actors(self):
+        res = self.client().post('/actors/bulk',json=[self.new_actor1, self.new_actor2],headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["created"], 2)
+        self.assertTrue(all(result["id"] for result in data["results"]))
+
+    # Error 422 - the whole batch is rejected with per item errors (Role: Casting Director)
+    def test_422_error_bulk_create_actors(self):
+        count = Actor.query.count()
+        res = self.client().post('/actors/bulk',json=[self.new_actor1, self.bad_actor],headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertNotIn("error", data["results"][0])
+        self.assertTrue(data["results"][1]["error"])
+        self.assertEqual(Actor.query.count(), count)
+
+    # Ages are stored as they were sent, fractions and strings are refused
+    def test_actor_validate_age(self):
+        self.assertEqual(Actor.validate({"name": "Actor", "age": 30.0})["age"], 30)
+        for age in (30.9, "30", True):
+            with self.assertRaisesRegex(ValueError, "age must be an integer"):
+                Actor.validate({"name": "Actor", "age": age})
+
+    # Success (Role: Casting Director)
+    def test_bulk_update_and_delete_actors(self):
+        ids = [self.actor1.id, self.actor2.id]
+        res = self.client().patch('/actors/bulk',json=[{"id": id, "age": 40} for id in ids],headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["updated"], 2)
+
+        res = self.client().delete('/actors/bulk',json=ids,headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["deleted"], 2)
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids), Actor.deleted_at.is_(None)).count(), 0)
+
+    # Error 403 unauthorized (Role: Casting Assistant)
+    def test_auth_error_bulk_create_actors(self):
+        res = self.client().post('/actors/bulk',json=[self.new_actor1],headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+
+        self.assertEqual(res.status_code, 403)
+
     # ---- PATCH ------
     # Success (Role: Executive Producer)
     def test_update_actor(self):
@@ -149,6 +442,30 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    # Success - If-Match guards against lost updates, a stale version gets 412 (Role: Casting Director)
+    def test_update_actor_if_match(self):
+        headers = dict(Authorization='bearer ' + self.jwt_cast_dir)
+        actor_id = self.actor1.id
+        res = self.client().patch('/actors/%d' % actor_id,json={"age": 57},headers=headers)
+        data = json.loads(res.data)
+        etag = res.headers["ETag"]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actor"]["age"], 57)
+        self.assertEqual(etag, '"%d"' % data["actor"]["version"])
+
+        res = self.client().patch('/actors/%d' % actor_id,json={"age": 58},headers=dict(headers, **{"If-Match": etag}))
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().patch('/actors/%d' % actor_id,json={"age": 59},headers=dict(headers, **{"If-Match": etag}))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data["message"], "precondition failed")
+        self.assertEqual(Actor.query.get(actor_id).age, 58)
+
+        res = self.client().patch('/actors/%d' % actor_id,json={"age": "old"},headers=headers)
+        self.assertEqual(res.status_code, 400)
+
     # Error 403 unauthorized (Role: Casting Assistant)
     def test_auth_error_update_actor(self):
         res = self.client().patch('/actors/2',json={"name":"my new name"},headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
@@ -156,14 +473,39 @@ class CastingTestCase(unittest.TestCase):
         
         self.assertEqual(res.status_code, 403)
 
-    #Error - 405 method not allowed
-    def test_405_error_get_actors(self):
-        res = self.client().get("/actors/10",headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+    #Error - 404 not found
+    def test_404_error_get_actor(self):
+        res = self.client().get("/actors/100000",headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 405)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
-        self.assertEqual(data["message"], "method not allowed")
+        self.assertEqual(data["message"], "resource not found")
+
+    # Success (Role: Casting Assistant), revalidated with the ETag and refreshed by writes
+    def test_get_actor(self):
+        headers = dict(Authorization='bearer ' + self.jwt_cast_asst)
+        actor_id = self.actor1.id
+        res = self.client().get('/actors/%d' % actor_id,headers=headers)
+        data = json.loads(res.data)
+        etag = res.headers["ETag"]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actor"]["name"], "Actor name 1")
+        self.assertEqual(etag, '"%d"' % data["actor"]["version"])
+
+        res = self.client().get('/actors/%d' % actor_id,headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertEqual(res.status_code, 304)
+
+        self.client().patch('/actors/%d' % actor_id,json={"age": 57},headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        res = self.client().get('/actors/%d' % actor_id,headers=dict(headers, **{"If-None-Match": etag}))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actor"]["age"], 57)
+
+        self.client().delete('/actors/%d' % actor_id,headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        res = self.client().get('/actors/%d' % actor_id,headers=headers)
+        self.assertEqual(res.status_code, 404)
 
     # ---- GET ------
     # Success (Role: Casting Assistant)
@@ -175,6 +517,108 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(data["actors"])
 
+    # Success - one page of actors (Role: Casting Assistant)
+    def test_get_actors_paginated(self):
+        res = self.client().get('/actors?limit=1',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["actors"]), 1)
+        self.assertTrue(data["next_cursor"])
+
+        res = self.client().get('/actors?limit=1&cursor=' + str(data["next_cursor"]),headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_page["actors"][0]["id"], data["actors"][0]["id"])
+
+    # Success - filtered by gender and age (Role: Casting Assistant)
+    def test_get_actors_filtered(self):
+        res = self.client().get('/actors?gender=Male&min_age=50',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for actor in data["actors"]:
+            self.assertEqual(actor["gender"], "Male")
+            self.assertGreaterEqual(actor["age"], 50)
+
+    #Error - 400 bad request
+    def test_400_error_get_actors_bad_limit(self):
+        res = self.client().get('/actors?limit=0',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+
+    # ---- EXPORT ------
+    # Success - NDJSON stream (Role: Casting Assistant)
+    def test_export_actors(self):
+        res = self.client().get('/actors/export',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        actors = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertTrue(actors)
+        self.assertEqual([actor["id"] for actor in actors], sorted(actor["id"] for actor in actors))
+
+    # Error 401 - missing authorization header
+    def test_auth_error_export_actors(self):
+        res = self.client().get('/actors/export')
+
+        self.assertEqual(res.status_code, 401)
+
+    # Success - cached list revalidates with the ETag (Role: Casting Assistant)
+    def test_get_actors_etag(self):
+        res = self.client().get('/actors',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        etag = res.headers["ETag"]
+
+        res = self.client().get('/actors',headers={"Authorization": 'bearer ' + self.jwt_cast_asst, "If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+
+        # Writes invalidate the cached list
+        Actor(name="Actor name 3", gender="Female", age=20).insert()
+        res = self.client().get('/actors',headers={"Authorization": 'bearer ' + self.jwt_cast_asst, "If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    # Success - compressed for clients accepting gzip, repeats send the cached compressed body
+    def test_get_actors_compressed(self):
+        actor_id = self.actor1.id
+        app = create_app({'COMPRESSION_MIN_SIZE': 1})
+        try:
+            headers = {"Authorization": 'bearer ' + self.jwt_cast_asst, "Accept-Encoding": "gzip"}
+            res = app.test_client().get('/actors?limit=1000',headers=headers)
+            etag = res.headers["ETag"]
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", res.headers["Vary"])
+            self.assertTrue(etag.endswith('-gzip"'))
+            self.assertTrue(json.loads(gzip.decompress(res.data))["actors"])
+
+            res_again = app.test_client().get('/actors?limit=1000',headers=headers)
+            self.assertEqual(res_again.data, res.data)
+            res = app.test_client().get('/actors?limit=1000',headers=dict(headers, **{"If-None-Match": etag}))
+            self.assertEqual(res.status_code, 304)
+
+            res = app.test_client().get('/actors?limit=1000',headers={"Authorization": 'bearer ' + self.jwt_cast_asst})
+            self.assertNotIn("Content-Encoding", res.headers)
+            self.assertTrue(json.loads(res.data)["actors"])
+
+            res = app.test_client().get('/health',headers={"Accept-Encoding": "gzip;q=0.5, identity"})
+            self.assertEqual(res.headers["Content-Encoding"], "gzip")
+            self.assertTrue(json.loads(gzip.decompress(res.data))["success"])
+
+            # The compressed ETag of a row is accepted back in If-Match
+            headers = {"Authorization": 'bearer ' + self.jwt_cast_dir, "Accept-Encoding": "gzip"}
+            etag = app.test_client().get('/actors/%d' % actor_id,headers=headers).headers["ETag"]
+            self.assertTrue(etag.endswith('-gzip"'))
+            res = app.test_client().patch('/actors/%d' % actor_id,json={"age": 61},headers=dict(headers, **{"If-Match": etag}))
+            self.assertEqual(res.status_code, 200)
+        finally:
+            compression.init_app(self.app)
+
     #Error - 405 method not allowed
     def test_405_error_delete_actors(self):
         res = self.client().delete('/actors',headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
@@ -194,7 +638,10 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
         self.assertEqual(data["deleted"], "1")
-        self.assertEqual(actor, None)
+        self.assertNotEqual(actor.deleted_at, None)
+
+        res = self.client().delete("/actors/1",headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        self.assertEqual(res.status_code, 404)
 
     #Error - 404 resource not found
     def test_404_error_delete_actor(self):
@@ -205,6 +652,234 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "resource not found")
 
+    # Success - search by name prefix, whole word matches first (Role: Casting Assistant)
+    def test_search_actors(self):
+        res = self.client().get('/actors/search?q=actor%20name%202',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actors"][0]["name"], "Actor name 2")
+
+        res = self.client().get('/actors/search?q=acto&limit=1',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+        self.assertEqual(len(data["actors"]), 1)
+        self.assertEqual(data["next_cursor"], 1)
+
+    # Success - search by title (Role: Casting Assistant)
+    def test_search_movies(self):
+        res = self.client().get('/movies/search?q=movie_title2',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["movies"][0]["title"], "movie_title2")
+
+    # Error 400 - nothing to search for
+    def test_400_error_search_actors(self):
+        res = self.client().get('/actors/search?q=%20-',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+
+        self.assertEqual(res.status_code, 400)
+
+    #---------------------
+    #Rate limit and admission control
+    #---------------------
+    # Error 429 - one subject over its rate limit, the others unaffected
+    def test_429_error_rate_limit(self):
+        rate_limiter = auth_module.rate_limiter
+        auth_module.rate_limiter = RateLimiter(MemoryStore(), rate=0.01, burst=1)
+        try:
+            res = self.client().get('/actors',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+            self.assertEqual(res.status_code, 200)
+
+            res = self.client().get('/actors',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(data["code"], "rate_limited")
+            self.assertGreater(int(res.headers["Retry-After"]), 1)
+
+            res = self.client().get('/actors',headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+            self.assertEqual(res.status_code, 200)
+        finally:
+            auth_module.rate_limiter = rate_limiter
+
+    # Error 503 - the worker is at its concurrency cap with a full queue
+    def test_503_error_overloaded(self):
+        admission = auth_module.admission
+        auth_module.admission = AdmissionControl(max_concurrent=1, max_queued=0)
+        try:
+            auth_module.admission.acquire()
+            res = self.client().get('/movies',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers["Retry-After"], "1")
+
+            auth_module.admission.release()
+            res = self.client().get('/movies',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(auth_module.admission.stats()["active"], 0)
+        finally:
+            auth_module.admission = admission
+
+    #---------------------
+    #/changes Endpoint
+    #---------------------
+    # Success - only the rows written since the token are returned, deleted ones as tombstones (Role: Exec Producer)
+    def test_changes(self):
+        client = create_app({"CHANGES_SETTLE_SECONDS": 0}).test_client()
+        headers = dict(Authorization='bearer ' + self.jwt_exec_prod)
+        actor_id, movie_id = self.actor1.id, self.movie1.id
+        since = None
+        more = True
+        while more:
+            res = client.get('/changes?limit=1000' + ('&since=' + since if since else ''), headers=headers)
+            data = json.loads(res.data)
+            since, more = data["since"], data["more"]
+
+        client.patch('/movies/%d' % movie_id, json={"title": "new title"}, headers=headers)
+        client.delete('/actors/%d' % actor_id, headers=headers)
+        res = client.get('/changes?since=' + since, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(actor["id"], actor["deleted_at"] is not None) for actor in data["actors"]], [(actor_id, True)])
+        self.assertEqual([(movie["id"], movie["title"]) for movie in data["movies"]], [(movie_id, "new title")])
+
+        res = client.get('/changes?since=' + data["since"], headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual((data["actors"], data["movies"], data["more"]), ([], [], False))
+
+        res = client.get('/changes?since=bogus', headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    # Rows held back by the settle window are delivered once settled, the poll isn't cached longer
+    def test_changes_settle_window(self):
+        actor_id = self.actor2.id
+        client = create_app({"CHANGES_SETTLE_SECONDS": 1}).test_client()
+        headers = dict(Authorization='bearer ' + self.jwt_exec_prod)
+        since = None
+        more = True
+        while more:
+            res = client.get('/changes?limit=1000' + ('&since=' + since if since else ''), headers=headers)
+            data = json.loads(res.data)
+            since, more = data["since"], data["more"]
+
+        client.patch('/actors/%d' % actor_id, json={"age": 38}, headers=headers)
+        res = client.get('/changes?since=' + since, headers=headers)
+        self.assertNotIn(actor_id, [actor["id"] for actor in json.loads(res.data)["actors"]])
+
+        time.sleep(1.1)
+        res = client.get('/changes?since=' + since, headers=headers)
+        self.assertIn(actor_id, [actor["id"] for actor in json.loads(res.data)["actors"]])
+
+    # Error - 403 without get:movies, also once the changes are cached
+    def test_changes_cached_403_error(self):
+        res = self.client().get('/changes', headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        self.assertEqual(res.status_code, 200)
+
+        token = self.limited_token(['get:actors'])
+        res = self.client().get('/changes', headers=dict(Authorization='bearer ' + token))
+        self.assertEqual(res.status_code, 403)
+
+    #---------------------
+    #/stats Endpoint
+    #---------------------
+    # Success - the summaries follow every kind of write (Role: Exec Producer)
+    def test_stats(self):
+        headers = dict(Authorization='bearer ' + self.jwt_exec_prod)
+        actor_id, other_actor_id, movie_id = self.actor1.id, self.actor2.id, self.movie1.id
+        self.client().patch('/actors/%d' % actor_id, json={"gender": "Female", "age": 61}, headers=headers)
+        self.client().patch('/movies/%d' % movie_id, json={"release_date": "2001-05-01"}, headers=headers)
+        res = self.client().post('/movies/bulk', json=[self.new_movie1, self.new_movie2], headers=headers)
+        ids = [result["id"] for result in json.loads(res.data)["results"]]
+        self.client().patch('/movies/bulk', json=[{"id": ids[0], "release_date": "1999-12-31"}], headers=headers)
+        self.client().delete('/movies/bulk', json=ids[1:], headers=headers)
+        self.client().delete('/actors/%d' % other_actor_id, headers=headers)
+
+        stats = count_stats()
+        self.assertEqual(read_stats(), stats)
+
+        res = self.client().get('/stats?age_bucket=5', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actors"]["count"], live(Actor).count())
+        self.assertEqual(data["movies"]["count"], live(Movie).count())
+        self.assertIn({"min_age": 60, "max_age": 64, "count": stats["actor_age"][61]}, data["actors"]["by_age"])
+        self.assertIn({"release_year": 1999, "count": stats["movie_release_year"][1999]}, data["movies"]["by_release_year"])
+
+        res = self.client().get('/stats?age_bucket=0', headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    # Error - 403 without get:movies, also once the stats are cached
+    def test_stats_cached_403_error(self):
+        res = self.client().get('/stats', headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        self.assertEqual(res.status_code, 200)
+
+        token = self.limited_token(['get:actors'])
+        res = self.client().get('/stats', headers=dict(Authorization='bearer ' + token))
+        self.assertEqual(res.status_code, 403)
+
+    #---------------------
+    #Cast Endpoints
+    #---------------------
+    # Success - cast an actor, list both sides and uncast (Role: Exec Producer)
+    def test_movie_cast(self):
+        headers = dict(Authorization='bearer ' + self.jwt_exec_prod)
+        movie_id, actor_id = self.movie1.id, self.actor1.id
+        res = self.client().put('/movies/%d/actors/%d' % (movie_id, actor_id), headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["created"], True)
+
+        res = self.client().get('/movies/%d/actors' % movie_id, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor["id"] for actor in json.loads(res.data)["actors"]], [actor_id])
+
+        res = self.client().get('/actors/%d/movies' % actor_id, headers=headers)
+        self.assertEqual([movie["id"] for movie in json.loads(res.data)["movies"]], [movie_id])
+
+        res = self.client().get('/actors?embed=movies&cursor=%d&limit=1' % (actor_id - 1), headers=headers)
+        self.assertEqual(json.loads(res.data)["actors"][0]["movies"][0]["title"], "movie_title1")
+
+        res = self.client().delete('/movies/%d/actors/%d' % (movie_id, actor_id), headers=headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/actors/%d/movies' % actor_id, headers=headers)
+        self.assertEqual(json.loads(res.data)["movies"], [])
+
+        res = self.client().delete('/movies/%d/actors/%d' % (movie_id, actor_id), headers=headers)
+        self.assertEqual(res.status_code, 404)
+
+    # Embedding takes the same number of queries whatever the page size (Role: Casting Assistant)
+    def test_embed_query_count(self):
+        headers = dict(Authorization='bearer ' + self.jwt_cast_asst)
+        for movie in (self.movie1, self.movie2):
+            movie.actors = [self.actor1, self.actor2]
+        self.movie1.update()
+
+        counts = []
+        for limit in (1, 2):
+            before = db_statements.value("get_movies")
+            res = self.client().get('/movies?embed=actors&limit=%d&cursor=%d' % (limit, self.movie1.id - 1), headers=headers)
+            counts.append(db_statements.value("get_movies") - before)
+            self.assertEqual(len(json.loads(res.data)["movies"][0]["actors"]), 2)
+
+        self.assertEqual(counts[0], counts[1])
+
+    # Error 400 - unknown embed
+    def test_400_error_embed(self):
+        res = self.client().get('/actors?embed=awards',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+
+        self.assertEqual(res.status_code, 400)
+
+    # Error 404 - movie not found
+    def test_404_error_movie_actors(self):
+        res = self.client().get('/movies/99999999/actors',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+
+        self.assertEqual(res.status_code, 404)
+
+    # Error 403 - Casting Assistant can't change the cast
+    def test_403_error_cast_actor(self):
+        res = self.client().put('/movies/%d/actors/%d' % (self.movie1.id, self.actor1.id), headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+
+        self.assertEqual(res.status_code, 403)
+
     #---------------------
     #/movies Endpoint
     #---------------------
@@ -245,7 +920,7 @@ class CastingTestCase(unittest.TestCase):
         
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data["success"], False)
-        self.assertEqual(data["message"], "unprocessable")
+        self.assertEqual(data["message"], "title is required")
 
     # Error 403 unauthorized (Role: Casting Director)
     def test_auth_error_post_movie(self):
@@ -254,6 +929,23 @@ class CastingTestCase(unittest.TestCase):
         
         self.assertEqual(res.status_code, 403)
 
+    # ---- BULK ------
+    # Success (Role: Executive Producer)
+    def test_bulk_create_movies(self):
+        res = self.client().post('/movies/bulk',json=[self.new_movie1, self.new_movie2],headers=dict(Authorization='bearer ' + self.jwt_exec_prod))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["created"], 2)
+
+    # Error 422 - unknown movie id (Role: Casting Director)
+    def test_422_error_bulk_update_movies(self):
+        res = self.client().patch('/movies/bulk',json=[{"id": self.movie1.id, "title": "new title"}, {"id": 100000, "title": "new title"}],headers=dict(Authorization='bearer ' + self.jwt_cast_dir))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["results"][1]["error"], "not found")
+
     # ---- PATCH ------
     # Success (Role: Casting Director)
     def test_update_movie(self):
@@ -272,14 +964,23 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
 
 
-    #Error - 405 method not allowed (Role: Casting Assistant)
-    def test_405_error_get_movies(self):
-        res = self.client().get("/movies/10",headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+    #Error - 404 not found (Role: Casting Assistant)
+    def test_404_error_get_movie(self):
+        res = self.client().get("/movies/100000",headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 405)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
-        self.assertEqual(data["message"], "method not allowed")
+        self.assertEqual(data["message"], "resource not found")
+
+    # Success (Role: Casting Assistant)
+    def test_get_movie(self):
+        res = self.client().get('/movies/%d' % self.movie1.id,headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["movie"]["title"], "movie_title1")
+        self.assertEqual(data["movie"]["release_date"], "1980-01-15")
     # ---- GET ------
     # Success (Role: Casting Assistant)
     def test_get_movies(self):
@@ -289,6 +990,35 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
         self.assertTrue(data["movies"])
+        self.assertEqual(data["movies"][0]["release_date"], "1980-01-15")
+
+    # Success - filtered by release date (Role: Casting Assistant)
+    def test_get_movies_filtered(self):
+        res = self.client().get('/movies?released_after=1981-01-01&released_before=1990-01-01',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["movies"])
+        self.assertNotIn("movie_title1", [movie["title"] for movie in data["movies"]])
+
+    #Error - 400 bad request
+    def test_400_error_get_movies_bad_date(self):
+        res = self.client().get('/movies?released_after=yesterday',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    # ---- EXPORT ------
+    # Success - JSON array (Role: Casting Assistant)
+    def test_export_movies_json(self):
+        res = self.client().get('/movies/export?format=json',headers=dict(Authorization='bearer ' + self.jwt_cast_asst))
+        movies = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(movies)
+        self.assertTrue(movies[0]["title"])
+        self.assertEqual(movies[0]["release_date"], "1980-01-15")
 
     #Error - 405 method not allowed (Role: Exec Producer)
     def test_405_error_delete_movies(self):
@@ -309,7 +1039,7 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
         self.assertEqual(data["deleted"], "2")
-        self.assertEqual(movie, None)
+        self.assertNotEqual(movie.deleted_at, None)
 
     #Error - 404 resource not found
     def test_404_error_delete_movie(self):
@@ -320,6 +1050,322 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "resource not found")
 
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.write_jwks('kid-1')
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def write_jwks(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [
+                {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'AQAB', 'e': 'AQAB'}
+                for kid in kids
+            ]}, f)
+
+    # Keys are served from memory until the TTL runs out
+    def test_keys_are_cached(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=600)
+        self.assertEqual(cache.get_key('kid-1')['kid'], 'kid-1')
+
+        os.remove(self.jwks_file.name)
+        self.assertEqual(cache.get_key('kid-1')['kid'], 'kid-1')
+        self.write_jwks('kid-1')
+
+    # An unknown kid refetches the JWKS once
+    def test_unknown_kid_refetches(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=600, min_refetch_interval=0)
+        cache.get_key('kid-1')
+
+        self.write_jwks('kid-1', 'kid-2')
+        self.assertEqual(cache.get_key('kid-2')['kid'], 'kid-2')
+
+    # Unknown kid refetches are rate limited
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=600, min_refetch_interval=600)
+        cache.get_key('kid-1')
+
+        self.write_jwks('kid-1', 'kid-2')
+        self.assertEqual(cache.get_key('kid-2'), None)
+
+    # Stale keys keep serving when the source is unavailable
+    def test_stale_keys_served_on_fetch_error(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=0, min_refetch_interval=0)
+        cache.get_key('kid-1')
+
+        os.remove(self.jwks_file.name)
+        self.assertEqual(cache.get_key('kid-1')['kid'], 'kid-1')
+        self.write_jwks('kid-1')
+
+
+class IssuerTestCase(unittest.TestCase):
+    """This class represents the configured token issuers test case"""
+
+    def setUp(self):
+        key = RSA.generate(2048)
+        self.private_pem = key.exportKey('PEM').decode('ascii')
+        self.key_file = tempfile.NamedTemporaryFile('w', suffix='.pem', delete=False)
+        self.key_file.write(key.publickey().exportKey('PEM').decode('ascii'))
+        self.key_file.close()
+
+        os.environ['TEST_SERVICE_SECRET'] = 'service-secret'
+        self.issuers = auth_module.issuers
+        auth_module.issuers = {issuer.issuer: issuer for issuer in [
+            issuer_from_config({'issuer': 'pem-issuer', 'keys_file': self.key_file.name}, 'casting-info'),
+            issuer_from_config({'issuer': 'service', 'secret_env': 'TEST_SERVICE_SECRET'}, 'casting-info'),
+        ]}
+
+    def tearDown(self):
+        auth_module.issuers = self.issuers
+        del os.environ['TEST_SERVICE_SECRET']
+        os.remove(self.key_file.name)
+
+    def claims(self, issuer):
+        return {'iss': issuer, 'aud': 'casting-info', 'sub': 'test', 'exp': int(time.time()) + 600}
+
+    # Tokens are verified with the keys of the issuer they claim
+    def test_local_keys(self):
+        token = jwt.encode(self.claims('pem-issuer'), self.private_pem, algorithm='RS256')
+        self.assertEqual(auth_module.verify_decode_jwt(token)['iss'], 'pem-issuer')
+
+        token = jwt.encode(self.claims('service'), 'service-secret', algorithm='HS256')
+        self.assertEqual(auth_module.verify_decode_jwt(token)['iss'], 'service')
+
+    # An issuer only accepts its own keys and algorithms, and unknown issuers are rejected
+    def test_wrong_issuer_or_key(self):
+        token = jwt.encode(self.claims('service'), self.private_pem, algorithm='RS256')
+        with self.assertRaises(auth_module.AuthError):
+            auth_module.verify_decode_jwt(token)
+
+        token = jwt.encode(self.claims('pem-issuer'), 'service-secret', algorithm='HS256')
+        with self.assertRaises(auth_module.AuthError):
+            auth_module.verify_decode_jwt(token)
+
+        token = jwt.encode(self.claims('other'), 'service-secret', algorithm='HS256')
+        with self.assertRaises(auth_module.AuthError) as raised:
+            auth_module.verify_decode_jwt(token)
+        self.assertEqual(raised.exception.status_code, 401)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.payload = {"sub": "user", "exp": time.time() + 600, "permissions": ["get:actors"]}
+
+    # Verified tokens are served from the cache
+    def test_cache_hit(self):
+        cache = TokenCache(max_entries=10)
+        self.assertEqual(cache.get("token"), None)
+        cache.put("token", self.payload)
+
+        payload, permissions = cache.get("token")
+        self.assertEqual(payload, self.payload)
+        self.assertEqual(permissions, frozenset(["get:actors"]))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    # A permissions claim that isn't a list grants nothing, cached or not
+    def test_string_permissions_claim(self):
+        payload = dict(self.payload, permissions="get:actors")
+        _, permissions = TokenCache(max_entries=10).put("token", payload)
+        self.assertEqual(permissions, frozenset())
+        with self.assertRaises(auth_module.AuthError):
+            auth_module.check_permissions("get:actors", payload)
+
+    # Entries expire with the token
+    def test_expired_token_is_dropped(self):
+        cache = TokenCache(max_entries=10)
+        cache.put("token", dict(self.payload, exp=time.time() - 1))
+        self.assertEqual(cache.get("token"), None)
+
+    # The least recently used token is evicted once the cache is full
+    def test_lru_eviction(self):
+        cache = TokenCache(max_entries=2)
+        cache.put("token1", self.payload)
+        cache.put("token2", self.payload)
+        cache.get("token1")
+        cache.put("token3", self.payload)
+
+        self.assertNotEqual(cache.get("token1"), None)
+        self.assertEqual(cache.get("token2"), None)
+        self.assertEqual(cache.stats()["size"], 2)
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """This class represents the rate limiter and admission control test case"""
+
+    # A bucket allows its burst, then one request per 1/rate seconds
+    def test_token_bucket(self):
+        store = MemoryStore()
+        self.assertEqual(store.take("key", 10, 2), 0)
+        self.assertEqual(store.take("key", 10, 2), 0)
+        self.assertAlmostEqual(store.take("key", 10, 2), 0.1, places=2)
+        self.assertEqual(store.take("other", 10, 2), 0)
+
+    # Two stores on the same file share their buckets
+    def test_sqlite_store_is_shared(self):
+        path = os.path.join(tempfile.mkdtemp(), "limits.db")
+        store1 = SQLiteStore(path)
+        store2 = SQLiteStore(path)
+
+        self.assertEqual(store1.take("key", 1, 1), 0)
+        self.assertGreater(store2.take("key", 1, 1), 0.9)
+
+    # Buckets are keyed by subject, permission or both
+    def test_rate_limit_key(self):
+        limiter = RateLimiter(MemoryStore(), rate=1, key="permission")
+        self.assertEqual(limiter.check({"sub": "a"}, "get:actors"), 0)
+        self.assertGreater(limiter.check({"sub": "b"}, "get:actors"), 0)
+        self.assertEqual(limiter.check({"sub": "a"}, "get:movies"), 0)
+        self.assertEqual(RateLimiter(MemoryStore()).check({"sub": "a"}, "get:actors"), 0)
+
+    # Requests over the cap wait in the queue, the ones beyond it are shed
+    def test_admission_control(self):
+        admission = AdmissionControl(max_concurrent=1, max_queued=1, queue_timeout=0.05)
+        self.assertTrue(admission.acquire())
+        self.assertFalse(admission.acquire())
+        admission.release()
+        self.assertTrue(admission.acquire())
+        self.assertEqual(admission.stats(), {"max_concurrent": 1, "active": 1, "queued": 0, "shed": 1})
+
+
+class CacheBackendTestCase(unittest.TestCase):
+    """This class represents the response cache backend test case"""
+
+    # Values expire after their TTL
+    def test_memory_backend(self):
+        backend = MemoryBackend()
+        backend.set("key", b"value", 60)
+        backend.set("expired", b"value", 0)
+
+        self.assertEqual(backend.get("key"), b"value")
+        self.assertEqual(backend.get("expired"), None)
+        self.assertEqual(backend.incr("version"), 1)
+        self.assertEqual(backend.counter("version"), 1)
+
+    # Two backends on the same file share values and counters
+    def test_sqlite_backend_is_shared(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.db")
+        backend1 = SQLiteBackend(path)
+        backend2 = SQLiteBackend(path)
+
+        backend1.set("key", b"value", 60)
+        backend1.incr("version")
+
+        self.assertEqual(backend2.get("key"), b"value")
+        self.assertEqual(backend2.counter("version"), 1)
+
+
+class PrefixIndexTestCase(unittest.TestCase):
+    """This class represents the in-process search index test case"""
+
+    # Every term matches a word prefix, whole word matches rank first
+    def test_search(self):
+        index = PrefixIndex()
+        index.add(1, "Jennifer Lawrence")
+        index.add(2, "Jenny Lee")
+        index.add(3, "Lee Jennings")
+        index.add(4, "Liam Neeson")
+        index.add(5, "Jen Park")
+
+        self.assertEqual(index.search("jen"), [5, 1, 2, 3])
+        self.assertEqual(index.search("jen", 2), [5, 1])
+        self.assertEqual(index.search("lee jen"), [2, 3])
+        self.assertEqual(index.search("Lawrence"), [1])
+        self.assertEqual(index.search("xyz"), [])
+
+    # Updated and removed texts leave no stale words behind
+    def test_update(self):
+        index = PrefixIndex()
+        index.add(1, "Liam Neeson")
+        index.add(1, "Bill Murray")
+        index.remove(2)
+
+        self.assertEqual(index.search("liam"), [])
+        self.assertEqual(index.search("bill"), [1])
+        index.remove(1)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.search("bill"), [])
+
+    # A rebuild doesn't hold up the searches, and keeps the writes made while it loaded
+    def test_column_index_rebuild(self):
+        rows = {1: "Tom Hanks"}
+        loading, started = threading.Event(), threading.Event()
+        loading.set()
+
+        def load_rows(ids=None):
+            if ids is not None:
+                return [(id, rows[id]) for id in ids if id in rows]
+            snapshot = list(rows.items())
+            started.set()
+            loading.wait(5)
+            return mock.Mock(yield_per=lambda size: snapshot)
+
+        index = ColumnSearchIndex(Actor, "name")
+        index._rows = load_rows
+        self.assertEqual(index.search("tom"), [1])
+
+        loading.clear()
+        index.invalidate()
+        rebuild = threading.Thread(target=index.search, args=("tom",))
+        rebuild.start()
+        self.assertTrue(started.wait(5))
+        rows[2] = "Tom Cruise"
+        index.invalidate([2])
+        self.assertEqual(index.search("tom"), [1, 2])
+        self.assertTrue(rebuild.is_alive())
+
+        loading.set()
+        rebuild.join(5)
+        self.assertEqual(index.search("tom"), [1, 2])
+
+
+class SerializationTestCase(unittest.TestCase):
+    """This class represents the JSON serialization test case"""
+
+    # The standard library and orjson encoders write the same compact JSON with ISO dates
+    def test_dumps(self):
+        value = {"id": 1, "title": "Movie", "release_date": date(1980, 1, 15), "next_cursor": None}
+        expected = b'{"id":1,"title":"Movie","release_date":"1980-01-15","next_cursor":null}'
+
+        self.assertEqual(serialization._dumps_json(value), expected)
+        if serialization.orjson is not None:
+            self.assertEqual(serialization._dumps_orjson(value), expected)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """This class represents the metrics test case"""
+
+    # Buckets are rendered cumulatively with the sum and count of the series
+    def test_histogram_samples(self):
+        histogram = Histogram("test_seconds", "Test.", labels=("stage",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "db")
+        histogram.observe(0.5, "db")
+        histogram.observe(5, "db")
+        samples = dict(histogram.samples())
+
+        self.assertEqual(samples['test_seconds_bucket{stage="db",le="0.1"}'], 1)
+        self.assertEqual(samples['test_seconds_bucket{stage="db",le="1.0"}'], 2)
+        self.assertEqual(samples['test_seconds_bucket{stage="db",le="+Inf"}'], 3)
+        self.assertEqual(samples['test_seconds_count{stage="db"}'], 3)
+        self.assertAlmostEqual(samples['test_seconds_sum{stage="db"}'], 5.55)
+
+    # A statement that raises leaves no start time behind on its connection
+    def test_failed_statement_timing(self):
+        engine = create_engine('sqlite://')
+        with engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.exec_driver_sql('SELECT * FROM missing_table')
+            self.assertEqual(connection.exec_driver_sql('SELECT 1').scalar(), 1)
+            self.assertNotIn('metrics_statement_start', connection.info)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
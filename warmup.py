@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime
+
+from auth.auth import load_keys
+from models import db, existing_ids, get_row, read_stats, row_columns, Actor, Movie
+from outbox import outbox
+from replicas import router
+from snapshot import catalog
+from serialization import dumps
+
+'''
+Worker warmup
+
+warm_up(app) does the work a worker would otherwise do on its first requests:
+- opens the connections of the pool, WARMUP_CONNECTIONS of them (by default the pool size),
+  and one to each read replica
+- loads the signing keys of every token issuer
+- runs the statements of the common reads once, so they are in SQLAlchemy's compiled cache
+- encodes a record with the JSON serializer
+- loads the catalog snapshot, when CATALOG_SNAPSHOT is on
+
+serve.py runs it in each worker before the worker accepts connections.  GET /ready answers
+503 until it has finished in the worker, and starts it in the background when nothing else
+did, e.g. under a plain `gunicorn app:app`.  A step that fails, like a database that can't
+be reached, leaves the worker not ready and is retried by the next /ready check.
+'''
+
+logger = logging.getLogger(__name__)
+
+_ready = threading.Event()
+_lock = threading.Lock()
+_running = False
+
+## Seconds spent in each step of the last warmup of this worker
+timings = {}
+
+def is_ready():
+    return _ready.is_set()
+
+def open_connections():
+    pool = db.engine.pool
+    count = int(os.environ.get('WARMUP_CONNECTIONS', 0)) or (pool.size() if hasattr(pool, 'size') else 1)
+    if hasattr(pool, 'size'):
+        ## Connections past the pool size would be overflow, closed as soon as they are returned
+        count = min(count, pool.size())
+    connections = [db.engine.connect() for _ in range(count)]
+    connections += [engine.connect() for engine in router.engines]
+    for connection in connections:
+        connection.close()
+
+def prime_queries():
+    try:
+        for model in (Actor, Movie):
+            get_row(model, 0)
+            existing_ids(model, [0])
+            db.session.query(*row_columns(model)) \
+                .filter(model.deleted_at.is_(None)) \
+                .order_by(model.id).limit(1).all()
+        read_stats()
+    finally:
+        db.session.remove()
+
+def prime_serializer():
+    dumps({'success': True, 'movie': {'id': 0, 'title': '', 'release_date': date.today(),
+                                      'updated_at': datetime.utcnow(), 'version': 1}})
+
+STEPS = (
+    ('connections', open_connections),
+    ('keys', load_keys),
+    ('queries', prime_queries),
+    ('serializer', prime_serializer),
+    ('snapshot', catalog.load),
+)
+
+## Runs every step, returns True once the worker is ready
+def warm_up(app):
+    global _running
+    with _lock:
+        if _ready.is_set() or _running:
+            return _ready.is_set()
+        _running = True
+
+    failed = False
+    try:
+        with app.app_context():
+            for name, step in STEPS:
+                start = time.perf_counter()
+                try:
+                    step()
+                except Exception:
+                    logger.exception('warmup step %s failed', name)
+                    failed = True
+                timings[name] = round(time.perf_counter() - start, 6)
+        if not failed:
+            ## Drains the jobs a previous worker left in the write-behind queue
+            outbox.start(app)
+            _ready.set()
+    finally:
+        with _lock:
+            _running = False
+    return _ready.is_set()
+
+## Starts warm_up on a background thread unless the worker is ready or already warming up
+def warm_up_in_background(app):
+    with _lock:
+        if _ready.is_set() or _running:
+            return
+    threading.Thread(target=warm_up, args=(app,), name='warmup', daemon=True).start()